@@ -0,0 +1,340 @@
+"""
+    Benchmark of the data loading path (per-slice read latency and throughput)
+"""
+import os
+import time
+import hashlib
+import argparse
+import tempfile
+import numpy as np
+import torch
+
+from torch.utils import data
+import tracemalloc
+import nibabel as nib
+from utils.data import readcfl, writecfl, read_hdr, cfl_dims, c2r, c2r_kdata, load_mat, load_nii
+from utils.packed import pack_slices, read_slice, packed_folders
+from loader.protocols import Protocol, protocols
+from loader.kdata_dataset import Kdata_dataset, Subject_batch_sampler
+from loader.slice_cache import Slice_cache
+from loader.batch_preprocess import Batch_preprocess, Kspace_simu
+from loader.kdata_multi_echo_MS import kdata_multi_echo_MS
+from loader.prefetcher import Prefetcher
+
+
+def readcfl_fromfile(name):
+    '''
+        readcfl reading the whole file with np.fromfile (reference of the memory-mapped utils.data.readcfl)
+    '''
+    h = open(name + ".hdr", "r")
+    h.readline()
+    dims = [int(i) for i in h.readline().split()]
+    h.close()
+    n = np.prod(dims)
+    dims = dims[:np.searchsorted(np.cumprod(dims), n)+1]
+    d = open(name + ".cfl", "r")
+    a = np.fromfile(d, dtype=np.complex64, count=n)
+    d.close()
+    return a.reshape(dims, order='F')
+
+
+def make_slices(dataFD, nslice, ncoil, necho, nrow, ncol):
+    '''
+        synthetic GE slice folder (fully_slice_, sensMaps_slice_, kdata_slice_, mask_slice_)
+    '''
+    os.makedirs(dataFD, exist_ok=True)
+    for idx in range(nslice):
+        writecfl(dataFD + 'fully_slice_{}'.format(idx), np.random.randn(nrow, ncol, necho) + 1j)
+        writecfl(dataFD + 'sensMaps_slice_{}'.format(idx), np.random.randn(nrow, ncol, ncoil) + 1j)
+        writecfl(dataFD + 'kdata_slice_{}'.format(idx), np.random.randn(nrow, ncol, ncoil, necho) + 1j)
+        writecfl(dataFD + 'mask_slice_{}'.format(idx), np.ones((nrow, ncol)))
+
+
+def make_mat(filename, varname, array):
+    '''
+        synthetic v7.3 (HDF5) .mat file as written by MATLAB: column-major, complex as a real&imag compound
+    '''
+    import h5py
+    with h5py.File(filename, 'w') as f:
+        if np.iscomplexobj(array):
+            stored = np.empty(array.shape[::-1], dtype=[('real', array.real.dtype), ('imag', array.real.dtype)])
+            stored['real'], stored['imag'] = array.real.T, array.imag.T
+            f[varname] = stored
+        else:
+            f[varname] = array.T
+
+
+def ge_dataset(dataFD, nslice, **kwargs):
+    '''
+        dataset of protocol 'multi_echo_GE' (kdata_multi_echo_GE) on the slices 0 to nslice-1 of dataFD
+    '''
+    protocol = Protocol(rootDir=dataFD, subjects={'train': [('', '')]}, slices={'train': (0, nslice)}, files=protocols['multi_echo_GE'].files)
+    return Kdata_dataset(protocol, split='train', **kwargs)
+
+
+def time_slices(fn, nslice):
+    '''
+        average latency (ms) per slice of fn(idx) over nslice slices
+    '''
+    t0 = time.time()
+    for idx in range(nslice):
+        fn(idx)
+    return (time.time() - t0) / nslice * 1000
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark_loader')
+    parser.add_argument('--rootDir', type=str, default=None)  # slice folder (e.g. .../megre_slice_GE/), synthetic slices if None
+    parser.add_argument('--nslice', type=int, default=50)  # number of slices to read
+    parser.add_argument('--ncoil', type=int, default=12)
+    parser.add_argument('--necho', type=int, default=10)
+    parser.add_argument('--nrow', type=int, default=206)
+    parser.add_argument('--ncol', type=int, default=80)
+    parser.add_argument('--ncoil_read', type=int, default=4)  # number of coils of the sub-block reads
+    parser.add_argument('--num_workers', type=int, default=0)  # data loader workers in 'packed'/'cache' modes
+    parser.add_argument('--nepoch', type=int, default=3)  # number of epochs in 'cache' mode
+    parser.add_argument('--cache_gb', type=float, default=1)  # slice cache bound in 'cache' mode
+    parser.add_argument('--batch_size', type=int, default=4)  # batch size in 'preprocess' / 'prefetch' modes
+    parser.add_argument('--slab', type=int, default=8)  # slices per batch and per read in 'slab' mode
+    parser.add_argument('--compute_iters', type=int, default=20)  # matmuls per batch standing for the forward/backward pass in 'prefetch' mode
+    parser.add_argument('--mode', type=str, default='cfl')  # 'cfl': np.fromfile vs memory-mapped vs sub-block cfl reads
+                                                            # 'packed': cfl slice folder vs packed folder, reads and GE data loader throughput
+                                                            # 'cache': GE data loader throughput per epoch without / with the shared-memory slice cache
+                                                            # 'preprocess': GE data loader throughput with per-sample numpy conversion vs Batch_preprocess on the device
+                                                            # 'prefetch': training loop throughput with synchronous .to(device) vs Prefetcher
+                                                            # 'slab': volume loading slice by slice vs slabs of consecutive slices with Subject_batch_sampler
+                                                            # 'simu': MS kspace simulation per sample on the cpu (generateKdata) vs in batch on the device (Kspace_simu)
+                                                            # 'mat': volume .mat / .nii files loaded in full vs read slice by slice (Lazy_mat, load_nii blocks)
+    opt = {**vars(parser.parse_args())}
+
+    if opt['rootDir'] is None:
+        tmpDir = tempfile.TemporaryDirectory()
+        dataFD = tmpDir.name + '/'
+        make_slices(dataFD, opt['nslice'], opt['ncoil'], opt['necho'], opt['nrow'], opt['ncol'])
+    else:
+        dataFD = opt['rootDir']
+    names = ['fully_slice_', 'sensMaps_slice_', 'kdata_slice_', 'mask_slice_']
+
+    if opt['mode'] == 'cfl':
+        # the four files of a slice read fully (np.fromfile and materialized memory map), as lazy memory maps,
+        # and as sub-blocks (first coils of kdata and csm, first echo of the target); run on cold page cache
+        # (e.g. network storage) for the I/O bound numbers, the second pass of each reader is cached
+        readers = {
+            'np.fromfile': lambda idx: [readcfl_fromfile(dataFD + name + str(idx)) for name in names],
+            'memmap': lambda idx: [np.array(readcfl(dataFD + name + str(idx))) for name in names],
+            'lazy memmap': lambda idx: [readcfl(dataFD + name + str(idx)) for name in names],
+            'sub-block': lambda idx: [readcfl(dataFD + 'fully_slice_' + str(idx), np.s_[..., :1]),
+                                      readcfl(dataFD + 'sensMaps_slice_' + str(idx), np.s_[..., :opt['ncoil_read']]),
+                                      readcfl(dataFD + 'kdata_slice_' + str(idx), np.s_[:, :, :opt['ncoil_read'], :]),
+                                      readcfl(dataFD + 'mask_slice_' + str(idx))]
+        }
+        print('{0} slices of {1}'.format(opt['nslice'], dataFD))
+        for name, reader in readers.items():
+            cfl_dims.clear()
+            latency = time_slices(reader, opt['nslice'])
+            print('{0:>12}: {1:8.3f} ms/slice'.format(name, latency))
+
+        for name in names:
+            ref = readcfl_fromfile(dataFD + name + '0')
+            out = readcfl(dataFD + name + '0')
+            print('{0:>16}: dims {1}, identical to np.fromfile: {2}'.format(name, read_hdr(dataFD + name + '0'), np.array_equal(ref, out)))
+
+        # chunked writecfl round trip
+        kdata = readcfl_fromfile(dataFD + 'kdata_slice_0')
+        writecfl(dataFD + 'kdata_chunked', kdata, chunk_size=2**16)
+        print('chunked writecfl round trip identical: {0}'.format(np.array_equal(readcfl(dataFD + 'kdata_chunked'), kdata)))
+
+    elif opt['mode'] == 'packed':
+        # slices of the cfl folder vs the packed folder (converted here if missing), single reads and
+        # kdata_multi_echo_GE throughput; drop the page cache between runs for the I/O bound numbers
+        if not os.path.exists(dataFD.rstrip('/') + '.pack'):
+            t0 = time.time()
+            pack_slices(dataFD, names, list(range(opt['nslice'])))
+            print('packed {0} slices in {1:.1f} s'.format(opt['nslice'], time.time() - t0))
+        for flag_packed in [0, 1]:
+            cfl_dims.clear()
+            packed_folders.clear()
+            # materialized arrays, the lazy cfl views would otherwise not be read
+            latency = time_slices(lambda idx: [np.array(read_slice(dataFD, name, idx, flag_packed=flag_packed)) for name in names], opt['nslice'])
+            print('{0:>7} folder: {1:8.3f} ms/slice'.format(['cfl', 'packed'][flag_packed], latency))
+        for name in names:
+            ref = readcfl(dataFD + name + '0')
+            print('{0:>16}: packed identical to cfl: {1}'.format(name, np.array_equal(ref, read_slice(dataFD, name, 0, flag_packed=1))))
+
+        for flag_packed in [0, 1]:
+            dataset = ge_dataset(dataFD, opt['nslice'], necho=opt['necho'], flag_packed=flag_packed)
+            loader = data.DataLoader(dataset, batch_size=1, shuffle=True, num_workers=opt['num_workers'])
+            t0 = time.time()
+            for batch in loader:
+                pass
+            print('{0:>7} folder: kdata_multi_echo_GE {1:8.1f} slices/s ({2} workers)'.format(
+                  ['cfl', 'packed'][flag_packed], opt['nslice'] / (time.time() - t0), opt['num_workers']))
+
+    elif opt['mode'] == 'cache':
+        # epochs of kdata_multi_echo_GE without and with Slice_cache, the cached epochs skip reading and decoding
+        for cache_gb in [0, opt['cache_gb']]:
+            dataset = ge_dataset(dataFD, opt['nslice'], necho=opt['necho'])
+            if cache_gb > 0:
+                dataset = Slice_cache(dataset, cache_gb)
+            loader = data.DataLoader(dataset, batch_size=1, shuffle=True, num_workers=opt['num_workers'])
+            for epoch in range(opt['nepoch']):
+                t0 = time.time()
+                for batch in loader:
+                    pass
+                rate = opt['nslice'] / (time.time() - t0)
+                if cache_gb > 0:
+                    print('cache {0:g} GB ({1} slots), epoch {2}: {3:8.1f} slices/s, hit rate {4:.3f}'.format(
+                          cache_gb, dataset.nslots, epoch, rate, dataset.hit_rate()))
+                    dataset.reset_stats()
+                else:
+                    print('   no cache, epoch {0}: {1:8.1f} slices/s'.format(epoch, rate))
+
+    elif opt['mode'] == 'preprocess':
+        # samples/s up to the tensors on the device, per-sample c2r / np.repeat / c2r_kdata in the loader (flag_raw = 0)
+        # vs complex64 slices converted in batch after the transfer (flag_raw = 1)
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        normalization = 100
+        preprocess = Batch_preprocess(necho=opt['necho'], normalization=normalization, device=device)
+        last_batch = {}
+        for flag_raw in [0, 1]:
+            dataset = ge_dataset(dataFD, opt['nslice'], necho=opt['necho'], normalization=normalization, flag_raw=flag_raw)
+            loader = data.DataLoader(dataset, batch_size=opt['batch_size'], shuffle=False, num_workers=opt['num_workers'],
+                                     pin_memory=torch.cuda.is_available())
+            for epoch in range(2):  # the first epoch warms up the page cache
+                t0 = time.time()
+                for batch in loader:
+                    if flag_raw:
+                        batch = preprocess(*batch)
+                    else:
+                        batch = [tensor.to(device, non_blocking=True) for tensor in batch]
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                rate = opt['nslice'] / (time.time() - t0)
+            last_batch[flag_raw] = batch
+            print('{0:>16}: {1:8.1f} samples/s (batch size {2}, {3} workers, {4})'.format(
+                  ['cpu conversion', 'batch_preprocess'][flag_raw], rate, opt['batch_size'], opt['num_workers'], device))
+        identical = all(torch.allclose(ref.float(), out.float()) for ref, out in zip(last_batch[0], last_batch[1]))
+        print('batch_preprocess identical to the cpu conversion: {0}'.format(identical))
+
+    elif opt['mode'] == 'prefetch':
+        # loop over the GE data loader with some device work per batch, tensors moved with .to(device)
+        # at the top of the iteration vs batches copied ahead by Prefetcher on a side stream
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        dataset = ge_dataset(dataFD, opt['nslice'], necho=opt['necho'], normalization=1)
+        loader = data.DataLoader(dataset, batch_size=opt['batch_size'], shuffle=False, num_workers=opt['num_workers'],
+                                 pin_memory=torch.cuda.is_available())
+        weight = torch.randn(opt['ncol'], opt['ncol'], device=device)
+        sums = {}
+        for flag_prefetch in [0, 1]:
+            for epoch in range(2):  # the first epoch warms up the page cache
+                t0 = time.time()
+                total = 0
+                for batch in (Prefetcher(loader, device) if flag_prefetch else loader):
+                    if not flag_prefetch:
+                        batch = [tensor.to(device) for tensor in batch]
+                    x = batch[1]
+                    for i in range(opt['compute_iters']):
+                        x = torch.tanh(torch.matmul(x, weight))
+                    total = total + batch[0].sum() + batch[1].sum()
+                total = total.item()  # synchronizes the device
+                rate = opt['nslice'] / (time.time() - t0)
+            sums[flag_prefetch] = total
+            print('{0:>14}: {1:8.1f} samples/s (batch size {2}, {3} workers, {4})'.format(
+                  ['.to(device)', 'Prefetcher'][flag_prefetch], rate, opt['batch_size'], opt['num_workers'], device))
+        print('same batches with Prefetcher: {0}'.format(np.isclose(sums[0], sums[1])))
+
+    elif opt['mode'] == 'slab':
+        # a volume (the nslice slices) loaded in order as for the test reconstruction: batches of one slice,
+        # and batches of slab slices of Subject_batch_sampler (one read per slab from the packed folder)
+        if not os.path.exists(dataFD.rstrip('/') + '.pack'):
+            pack_slices(dataFD, names, list(range(opt['nslice'])))
+        volumes = {}
+        for flag_packed, slab in [(0, 1), (0, opt['slab']), (1, 1), (1, opt['slab'])]:
+            cfl_dims.clear()
+            packed_folders.clear()
+            dataset = ge_dataset(dataFD, opt['nslice'], necho=opt['necho'], normalization=1, flag_packed=flag_packed, slab=slab)
+            loader = data.DataLoader(dataset, batch_sampler=Subject_batch_sampler(dataset, slab), num_workers=opt['num_workers'])
+            t0 = time.time()
+            digests = [hashlib.md5() for name in names]  # per field, independent of the batch size
+            for batch in loader:
+                for digest, tensor in zip(digests, batch):
+                    digest.update(tensor.numpy().tobytes())
+            volumes[flag_packed, slab] = tuple(digest.hexdigest() for digest in digests)
+            print('{0:>7} folder, batches of {1:3d} slices: {2:8.1f} slices/s'.format(
+                  ['cfl', 'packed'][flag_packed], slab, opt['nslice'] / (time.time() - t0)))
+        identical = len(set(volumes.values())) == 1
+        print('volumes identical: {0}'.format(identical))
+
+    elif opt['mode'] == 'simu':
+        # kdatas of kdata_multi_echo_MS (coil = 1, csm = 1) from synthetic targets, generateKdata per sample
+        # in the loader then copied to the device, vs the targets copied and simulated in batch by Kspace_simu
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        simu = Kspace_simu(echo_cat=1, device=device)
+        dataset = argparse.Namespace(nrow=opt['nrow'], ncol=opt['ncol'], necho=opt['necho'])  # attributes read by generateKdata
+        orgs = np.random.randn(opt['nslice'], opt['nrow'], opt['ncol'], opt['necho']) \
+               + 1j*np.random.randn(opt['nslice'], opt['nrow'], opt['ncol'], opt['necho'])
+        targets = torch.from_numpy(np.stack([c2r(org, 1) for org in orgs]))  # (nslice, 2*echo, row, col)
+        csms = torch.from_numpy(c2r_kdata(np.ones((1, 1, 1, opt['nrow'], opt['ncol']))))  # (1, coil, 1, row, col, 2)
+        batches = [np.arange(start, min(start + opt['batch_size'], opt['nslice'])) for start in range(0, opt['nslice'], opt['batch_size'])]
+        for flag_simu in [0, 1]:
+            for epoch in range(2):  # the first epoch warms up the device
+                t0 = time.time()
+                for idxs in batches:
+                    if flag_simu:
+                        kdatas = simu(targets[idxs], csms.expand(len(idxs), -1, -1, -1, -1, -1), torch.from_numpy(idxs))
+                    else:
+                        kdatas = np.stack([kdata_multi_echo_MS.generateKdata(dataset, orgs[idx][np.newaxis, ...]) for idx in idxs])
+                        kdatas = torch.from_numpy(kdatas).to(device)
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                rate = opt['nslice'] / (time.time() - t0)
+            print('{0:>14}: {1:8.1f} samples/s (batch size {2}, {3})'.format(
+                  ['generateKdata', 'Kspace_simu'][flag_simu], rate, opt['batch_size'], device))
+        # noise free kdatas against generateKdata, noise level, and same noise whatever the batching
+        idxs = batches[0]
+        ref = np.stack([kdata_multi_echo_MS.generateKdata(dataset, orgs[idx][np.newaxis, ...], sigma=0) for idx in idxs])
+        simu.sigma = 0
+        clean = simu(targets[idxs], csms.expand(len(idxs), -1, -1, -1, -1, -1), torch.from_numpy(idxs))
+        print('noise free kdatas identical to generateKdata: {0}'.format(
+              np.allclose(ref, clean.cpu().numpy(), rtol=1e-4, atol=1e-3)))
+        simu.sigma = 0.01
+        noisy = simu(targets[idxs], csms.expand(len(idxs), -1, -1, -1, -1, -1), torch.from_numpy(idxs))
+        print('noise std: {0:.4f} (expected {1:.4f})'.format(
+              (noisy - clean).std().item(), simu.sigma / np.sqrt(2.) * np.sqrt(opt['nrow']*opt['ncol'])))
+        single = torch.cat([simu(targets[idx:idx+1], csms, torch.tensor([idx])) for idx in idxs])
+        print('same noise per sample in batch and one by one: {0}'.format(torch.allclose(noisy, single)))
+
+    elif opt['mode'] == 'mat':
+        # iField-like volume (row, col, slice, echo) of a v7.3 .mat file and a .nii file, whole volume loaded
+        # then sliced as MultiEchoSimu did vs slices read on demand, time to the first slice and of all slices,
+        # and peak of the numpy allocations (md5 of the slices to check them)
+        volume = (np.random.randn(opt['nrow'], opt['ncol'], opt['nslice'], opt['necho'])
+                  + 1j*np.random.randn(opt['nrow'], opt['ncol'], opt['nslice'], opt['necho'])).astype(np.complex64)
+        make_mat(dataFD + 'iField.mat', 'iField', volume)
+        nib.save(nib.Nifti1Image(np.abs(volume), np.eye(4)), dataFD + 'mag.nii')
+        readers = {
+            'mat, load_mat': lambda: load_mat(dataFD + 'iField.mat', 'iField'),
+            'mat, Lazy_mat': lambda: load_mat(dataFD + 'iField.mat', 'iField', lazy=1),
+            'nii, load_nii': lambda: load_nii(dataFD + 'mag.nii'),
+            'nii, blocks': lambda: nib.load(dataFD + 'mag.nii').dataobj,
+        }
+        slices = {}
+        for name, reader in readers.items():
+            tracemalloc.start()
+            t0 = time.time()
+            data = reader()
+            first = data[:, :, 0, :]
+            t_first = time.time() - t0
+            digest = hashlib.md5()
+            for idx in range(opt['nslice']):
+                digest.update(np.ascontiguousarray(data[:, :, idx, :]).tobytes())
+            slices[name] = digest.hexdigest()
+            t_all = time.time() - t0
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            del data
+            print('{0:>14}: first slice {1:8.1f} ms, {2} slices {3:8.1f} ms, peak {4:8.1f} MB'.format(
+                  name, t_first * 1000, opt['nslice'], t_all * 1000, peak / 2**20))
+        identical = slices['mat, load_mat'] == slices['mat, Lazy_mat'] and slices['nii, load_nii'] == slices['nii, blocks']
+        print('slices identical: {0}'.format(identical))
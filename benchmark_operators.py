@@ -0,0 +1,689 @@
+"""
+    Benchmark of the multi-echo forward/backward operators (per-call latency and peak memory)
+"""
+import copy
+import time
+import argparse
+import torch
+import numpy as np
+
+from torch.utils import data
+from torch.cuda.amp import autocast, GradScaler
+from utils.data import coil_compress, c2r_kdata, torch_channel_concate, torch_channel_deconcate, cplx_mlpy, cplx_conj, \
+                       cplx_matmlpy, cplx_matconj, fft_shift_row
+from utils.operators import Back_forward, Back_forward_multiEcho, backward_multiEcho, forward_multiEcho, gradient, divergence, \
+                            Subspace_projector, compute_V
+from utils.operators_complex import Back_forward_multiEcho_complex
+from utils.loss import lossL2, ssim  # imports fits.fits before models.dc_blocks, as in the main scripts
+from utils.test import Metrices
+from models.dc_blocks import DC_layer_multiEcho
+from models.BCRNN import BCRNNlayer
+from models.resnet_with_dc import Resnet_with_DC2, compile_recon
+from loader.kdata_multi_echo_GE import kdata_multi_echo_GE
+from loader.kdata_multi_echo_CBIC import kdata_multi_echo_CBIC
+
+
+def make_inputs(batch, ncoil, necho, nrow, ncol, ratio, device):
+    '''
+        random csm, sampling mask, flip matrix and image in the layouts used by Resnet_with_DC2
+    '''
+    csm = torch.randn(batch, ncoil, necho, nrow, ncol, 2, device=device)
+    mask = (torch.rand(1, 1, 1, nrow, ncol, 1, device=device) < ratio).float()
+    mask = torch.cat((mask, torch.zeros(mask.shape, device=device)), -1).repeat(1, ncoil, necho, 1, 1, 1)
+    flip = torch.ones([necho, nrow, ncol, 1])
+    flip = torch.cat((flip, torch.zeros(flip.shape)), -1).to(device)
+    flip[:, ::2, ...] = - flip[:, ::2, ...]
+    flip[:, :, ::2, ...] = - flip[:, :, ::2, ...]
+    flip = flip[None, ...]  # (1, necho, nrow, ncol, 2)
+    img = torch.randn(batch, 2*necho, nrow, ncol, device=device)
+    return csm, mask, flip, img
+
+
+def make_coil_maps(ncoil, nrow, ncol):
+    '''
+        smooth synthetic coil sensitivity maps (coil, 1, row, col) placed on a ring around the FOV
+    '''
+    x, y = np.meshgrid(np.linspace(-1, 1, ncol), np.linspace(-1, 1, nrow))
+    csm = np.zeros((ncoil, 1, nrow, ncol), dtype=np.complex64)
+    for i in range(ncoil):
+        theta = 2 * np.pi * i / ncoil
+        dist2 = (x - 1.5*np.cos(theta))**2 + (y - 1.5*np.sin(theta))**2
+        csm[i, 0] = np.exp(- dist2 / 2) * np.exp(1j * (theta + 0.5*x*np.sin(theta) + 0.5*y*np.cos(theta)))
+    return csm / np.sqrt(np.sum(abs(csm)**2, axis=0, keepdims=True))
+
+
+def time_call(fn, niter, device, warmup=True):
+    '''
+        average latency (ms) and peak allocated memory (MB, cuda only) of fn()
+    '''
+    if warmup:
+        fn()  # cuFFT plans
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        mem0 = torch.cuda.memory_allocated()
+    t0 = time.time()
+    for _ in range(niter):
+        out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak = (torch.cuda.max_memory_allocated() - mem0) / 1024**2
+    else:
+        peak = float('nan')
+    return (time.time() - t0) / niter * 1000, peak, out
+
+
+def count_allocs(fn, device):
+    '''
+        number of tensor allocations and allocated MB of one fn() call
+        (caching allocator statistics on cuda, memory profiler on cpu)
+    '''
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        stats0 = torch.cuda.memory_stats()
+        fn()
+        torch.cuda.synchronize()
+        stats = torch.cuda.memory_stats()
+        nallocs = stats['allocation.all.allocated'] - stats0['allocation.all.allocated']
+        nbytes = stats['allocated_bytes.all.allocated'] - stats0['allocated_bytes.all.allocated']
+    else:
+        with torch.autograd.profiler.profile(profile_memory=True) as prof:
+            fn()
+        allocs = [e.self_cpu_memory_usage for e in prof.function_events if e.self_cpu_memory_usage > 0]
+        nallocs, nbytes = len(allocs), sum(allocs)
+    return nallocs, nbytes / 1024**2
+
+
+def backward_multiEcho_shift(kdata, csm, mask, flip, necho=10):
+    '''
+        GE backward_multiEcho with the row shift of the coil images after ifft (reference of the k-space modulation)
+    '''
+    temp = torch.ifft(cplx_mlpy(kdata, mask), 2)
+    temp = fft_shift_row(temp, kdata.size()[3], 1)
+    coilComb = cplx_mlpy(torch.sum(cplx_mlpy(temp, cplx_conj(csm)), dim=1), flip)
+    return torch_channel_concate(coilComb.permute(0, 4, 1, 2, 3), necho)
+
+
+def forward_multiEcho_shift(image, csm, mask, flip):
+    '''
+        GE forward_multiEcho with the row shift of the coil images before fft (reference of the k-space modulation)
+    '''
+    image = torch.stack((image[:, 0::2, ...], image[:, 1::2, ...]), dim=-1)  # (batch, echo, row, col, 2)
+    temp = cplx_mlpy(csm, cplx_mlpy(image, flip)[:, None, ...])
+    temp = fft_shift_row(temp, csm.size()[3], 1)
+    return cplx_mlpy(torch.fft(temp, 2), mask)
+
+
+def gradient_cat(x):
+    '''
+        2d gradient with torch.cat of shifted slices (reference of utils.operators.gradient)
+    '''
+    dx = torch.cat((x[:, :, :, 1:], x[:, :, :, -1:]), dim=3) - x
+    dy = torch.cat((x[:, :, 1:, :], x[:, :, -1:, :]), dim=2) - x
+    return torch.cat((dx[..., None], dy[..., None]), dim=-1)
+
+
+def divergence_cat(d):
+    '''
+        2d divergence with torch.cat of shifted slices (reference of utils.operators.divergence)
+    '''
+    dxx = d[..., 0] - torch.cat((d[:, :, :, :1, 0], d[:, :, :, :-1, 0]), dim=3)
+    dyy = d[..., 1] - torch.cat((d[:, :, :1, :, 1], d[:, :, :-1, :, 1]), dim=2)
+    return - dxx - dyy
+
+
+def low_rank_projection_permute(img, Ur, necho=10):
+    '''
+        Ur*Ur^H(img) through cplx_matmlpy on the permuted (echo, batch*row*col, 2) image
+        (reference of utils.operators.Subspace_projector)
+    '''
+    image = torch_channel_deconcate(img).permute(0, 3, 4, 2, 1)  # (batch, row, col, echo, 2)
+    s0 = image.size()
+    image = image.reshape(-1, necho, 2).permute(1, 0, 2)  # (echo, batch*row*col, 2)
+    image = cplx_matmlpy(Ur, cplx_matmlpy(cplx_matconj(Ur), image))
+    image = image.permute(1, 0, 2).reshape(s0)  # (batch, row, col, echo, 2)
+    return torch_channel_concate(image.permute(0, 4, 3, 1, 2), necho)
+
+
+def compute_V_pca(kdata, csm, k=10):
+    '''
+        compute_V with torch.pca_lowrank on cpu (reference of the on-device utils.operators.compute_V)
+    '''
+    nrow, ncol, necho = kdata.size()[3], kdata.size()[4], kdata.size()[2]
+    kdata = kdata[:, :, :, nrow//2-13:nrow//2+12, ncol//2-13:ncol//2+12, :]
+    mask = torch.ones_like(kdata[:1])
+    mask[..., 1] = 0
+    _, _, flip, _ = make_inputs(1, 1, necho, kdata.size()[3], kdata.size()[4], 1, kdata.device)
+    low_res_img = backward_multiEcho(kdata, csm, mask, flip, necho=necho).permute(0, 2, 3, 1).reshape(-1, 2*necho)
+    (_, _, V) = torch.pca_lowrank(low_res_img.cpu().detach(), q=k)
+    return V.to(kdata.device)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark_operators')
+    parser.add_argument('--gpu_id', type=str, default='0')
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--ncoil', type=int, default=12)
+    parser.add_argument('--necho', type=int, default=10)
+    parser.add_argument('--nrow', type=int, default=206)
+    parser.add_argument('--ncol', type=int, default=80)
+    parser.add_argument('--ratio', type=float, default=0.1)  # under-sampling ratio
+    parser.add_argument('--scanner', type=int, default=0)  # 0: GE scanner; 1: Siemens scanner
+    parser.add_argument('--niter', type=int, default=100)  # number of AtA calls to average
+    parser.add_argument('--mode', type=str, default='engine')  # 'engine': real vs complex AtA,
+                                                               # 'subject': current vs precomputed operators on a full subject
+                                                               # 'coils': accuracy vs speed of SVD coil compression
+                                                               # 'shared_csm': echo-replicated vs echo-shared csm
+                                                               # 'cg': global vs per-sample convergence of batched CG
+                                                               # 'implicit': unrolled vs implicit (adjoint CG) backward of the DC layer
+                                                               # 'precond': CG iterations to tolerance with the analytic preconditioners
+                                                               # 'fused': GE flip/row shifts as image copies vs folded into csm and k-space modulation
+                                                               # 'tv': torch.cat vs in-place finite differences of the TV terms (2d and 3d)
+                                                               # 'lowrank': permuted cplx_matmlpy vs cached Subspace_projector in the rank > 0 AtA
+                                                               # 'bcrnn': BCRNN layer forward+backward latency per echo loop vs time batched, vs nt and hidden_size
+                                                               # 'amp': Resnet_with_DC2 training step in fp32 vs fp16 autocast of the denoisers, PSNR/SSIM parity
+                                                               # 'compile': Resnet_with_DC2 inference latency in eager mode vs static CG, TorchScript trace and torch.compile
+                                                               # 'slab': Resnet_with_DC2 BCRNN recon of a batch of slices (main --slab) vs slice by slice
+    parser.add_argument('--nslice', type=int, default=200)  # number of slices of the test subject
+    parser.add_argument('--K', type=int, default=10)  # number of unrolls
+    parser.add_argument('--max_iter', type=int, default=10)  # number of CG iterations
+    parser.add_argument('--ncoil_vs', type=str, default='2,4,6,8')  # numbers of virtual coils to compare in 'coils' mode
+    parser.add_argument('--cg_tol', type=float, default=1e-3)  # relative residual tolerance of batched CG in 'cg'/'precond' modes
+    parser.add_argument('--dataset', type=str, default='synthetic')  # 'synthetic', 'GE' or 'CBIC' slices in 'precond' mode
+    parser.add_argument('--rootDir', type=str, default=None)  # root folder of the GE/CBIC data
+    parser.add_argument('--use_dll2', type=int, default=1)  # regularization of AtA in 'precond' mode
+    parser.add_argument('--lambdas', type=str, default='1e-3')  # lambda_dll2 of AtA in 'precond' mode, 1 value or 2/3 (per echo group as in AtA)
+    parser.add_argument('--rank', type=int, default=4)  # rank of the temporal subspace in 'lowrank' mode
+    parser.add_argument('--nts', type=str, default='4,7,10')  # numbers of time frames (echos) in 'bcrnn' mode
+    parser.add_argument('--hidden_sizes', type=str, default='32,64')  # hidden sizes in 'bcrnn' mode
+    parser.add_argument('--weights', type=str, default=None)  # state dict of a trained Resnet_with_DC2 in 'amp'/'compile' modes (random weights if None)
+    parser.add_argument('--export', type=str, default=None)  # file to save the TorchScript recon of 'compile' mode (torch.jit.load)
+    opt = {**vars(parser.parse_args())}
+
+    device = torch.device('cuda:'+opt['gpu_id'] if torch.cuda.is_available() else 'cpu')
+    csm, mask, flip, img = make_inputs(opt['batch'], opt['ncoil'], opt['necho'],
+                                       opt['nrow'], opt['ncol'], opt['ratio'], device)
+    lambda_dll2 = torch.ones(1, device=device)*1e-3
+
+    engines = {
+        'real': Back_forward_multiEcho,
+        'complex': Back_forward_multiEcho_complex
+    }
+
+    if opt['mode'] == 'engine':
+        outputs = {}
+        print('AtA of {0} coils, {1} echos, {2}x{3} on {4}'.format(
+              opt['ncoil'], opt['necho'], opt['nrow'], opt['ncol'], device))
+        with torch.no_grad():
+            for name, Operator in engines.items():
+                A = Operator(csm, mask, flip, lambda_dll2, necho=opt['necho'], scanner=opt['scanner'])
+                latency, peak, outputs[name] = time_call(lambda: A.AtA(img), opt['niter'], device)
+                print('{0:>10}: {1:8.3f} ms/call, peak memory {2:8.1f} MB'.format(name, latency, peak))
+
+        err = torch.norm(outputs['complex'] - outputs['real']) / torch.norm(outputs['real'])
+        print('relative difference between engines: {0:.3e}'.format(err))
+
+    elif opt['mode'] == 'subject':
+        # one operator per slice (batch), reused by all K unrolls and all CG iterations
+        def recon_subject(Operator, precompute):
+            for _ in range(opt['nslice']):
+                A = Operator(csm, mask, flip, lambda_dll2, necho=opt['necho'],
+                             scanner=opt['scanner'], precompute=precompute)
+                for _ in range(opt['K'] * opt['max_iter']):
+                    out = A.AtA(img)
+            return out
+
+        print('{0} slices x {1} unrolls x {2} CG iterations on {3}'.format(
+              opt['nslice'], opt['K'], opt['max_iter'], device))
+        with torch.no_grad():
+            for name, Operator in engines.items():
+                outputs = []
+                for precompute in [0, 1]:
+                    latency, peak, out = time_call(lambda: recon_subject(Operator, precompute), 1, device, warmup=False)
+                    outputs.append(out)
+                    print('{0:>10}, precompute={1}: {2:10.1f} s/subject, peak memory {3:8.1f} MB'.format(
+                          name, precompute, latency / 1000, peak))
+                err = torch.norm(outputs[1] - outputs[0]) / torch.norm(outputs[0])
+                print('{0:>10}: relative difference of precomputed AtA: {1:.3e}'.format(name, err))
+
+    elif opt['mode'] == 'coils':
+        # fully sampled multi-echo k-space of a random image through smooth coil maps,
+        # reconstructed from all physical coils and from the compressed virtual coils
+        necho, nrow, ncol = opt['necho'], opt['nrow'], opt['ncol']
+        csm_np = make_coil_maps(opt['ncoil'], nrow, ncol)
+        img_np = (np.random.randn(necho, nrow, ncol) + 1j*np.random.randn(necho, nrow, ncol)).astype(np.complex64)
+        kdata_np = np.fft.fft2(csm_np * img_np[None, ...], norm='ortho').astype(np.complex64)  # (coil, echo, row, col)
+
+        def to_operator_inputs(kdata, csm):
+            ncoil = kdata.shape[0]
+            kdata = torch.tensor(c2r_kdata(kdata)[None, ...], device=device).float()
+            csm = torch.tensor(c2r_kdata(csm)[None, ...], device=device).float()
+            return kdata, csm, mask[:, :1, ...].repeat(1, ncoil, 1, 1, 1, 1)
+
+        flip_ones = torch.zeros(flip.shape, device=device)
+        flip_ones[..., 0] = 1
+        print('SVD coil compression of {0} coils, {1} echos, {2}x{3} on {4}'.format(
+              opt['ncoil'], necho, nrow, ncol, device))
+        with torch.no_grad():
+            kdata, csm, mask_c = to_operator_inputs(kdata_np, csm_np)
+            A = Back_forward_multiEcho(csm, mask_c, flip_ones, lambda_dll2, necho=necho)
+            latency, _, AtA_ref = time_call(lambda: A.AtA(img), opt['niter'], device)
+            zf_ref = backward_multiEcho(kdata, csm, mask_c, flip_ones, necho=necho)
+            print('{0:>3} coils: {1:8.3f} ms/call'.format(opt['ncoil'], latency))
+            for ncoil_v in [int(n) for n in opt['ncoil_vs'].split(',')]:
+                kdata_v, csm_v = coil_compress(kdata_np, csm_np, ncoil_v)
+                kdata, csm, mask_c = to_operator_inputs(kdata_v, csm_v)
+                A = Back_forward_multiEcho(csm, mask_c, flip_ones, lambda_dll2, necho=necho)
+                latency, _, AtA_out = time_call(lambda: A.AtA(img), opt['niter'], device)
+                zf = backward_multiEcho(kdata, csm, mask_c, flip_ones, necho=necho)
+                err_zf = torch.norm(zf - zf_ref) / torch.norm(zf_ref)
+                err_AtA = torch.norm(AtA_out - AtA_ref) / torch.norm(AtA_ref)
+                print('{0:>3} coils: {1:8.3f} ms/call, relative error of A^H y {2:.3e}, of AtA {3:.3e}'.format(
+                      ncoil_v, latency, err_zf, err_AtA))
+
+    elif opt['mode'] == 'shared_csm':
+        # host-to-device transfer, operator footprint and AtA latency of an echo-replicated
+        # (batch, coil, echo, row, col, 2) csm vs an echo-shared (batch, coil, 1, row, col, 2) csm
+        csm_shared = csm[:, :, :1, ...].cpu()
+        csms = {
+            'replicated': csm_shared.repeat(1, 1, opt['necho'], 1, 1, 1),
+            'shared': csm_shared
+        }
+        outputs = {}
+        print('csm of {0} coils, {1} echos, {2}x{3} on {4}'.format(
+              opt['ncoil'], opt['necho'], opt['nrow'], opt['ncol'], device))
+        with torch.no_grad():
+            for name, csm_host in csms.items():
+                latency_h2d, _, csm_device = time_call(lambda: csm_host.to(device), opt['niter'], device)
+                for engine, Operator in engines.items():
+                    latency, peak, outputs[(name, engine)] = time_call(
+                        lambda: Operator(csm_device, mask, flip, lambda_dll2, necho=opt['necho'],
+                                         scanner=opt['scanner']).AtA(img), opt['niter'], device)
+                    print('{0:>10} csm ({1:6.2f} MB, {2:7.3f} ms host-to-device), {3:>7} AtA: {4:8.3f} ms/call, peak memory {5:8.1f} MB'.format(
+                          name, csm_host.numel()*4/1024**2, latency_h2d, engine, latency, peak))
+
+        for engine in engines:
+            err = torch.norm(outputs[('shared', engine)] - outputs[('replicated', engine)]) / torch.norm(outputs[('replicated', engine)])
+            print('{0:>10}: relative difference of shared csm AtA: {1:.3e}'.format(engine, err))
+
+    elif opt['mode'] == 'cg':
+        # a batch of slices with different conditioning (csm scaled per slice), solved by the
+        # current CG (one global rTr for the batch) and by the batched CG (per-sample convergence)
+        scales = torch.logspace(0, -2, opt['batch'], device=device)
+        csm_scaled = csm[:, :, :1, ...] * scales[:, None, None, None, None, None]
+        A = Back_forward_multiEcho(csm_scaled, mask, flip, lambda_dll2, necho=opt['necho'], scanner=opt['scanner'])
+        with torch.no_grad():
+            rhs = A.AtA(img)
+
+            def cg_global():
+                dc_layer = DC_layer_multiEcho(A, rhs, necho=opt['necho'])
+                return dc_layer.CG_iter(max_iter=opt['max_iter'])
+
+            def cg_per_slice():
+                x = []
+                for b in range(opt['batch']):
+                    dc_layer = DC_layer_multiEcho(A.batch_select(torch.tensor([b], device=device)), rhs[b:b+1], necho=opt['necho'])
+                    x.append(dc_layer.CG_iter(max_iter=opt['max_iter']))
+                return torch.cat(x, dim=0)
+
+            def cg_batched(tol):
+                dc_layer = DC_layer_multiEcho(A, rhs, necho=opt['necho'], flag_batch_cg=1, tol=tol)
+                x = dc_layer.CG_iter(max_iter=opt['max_iter'])
+                return x, dc_layer.niters, dc_layer.rTr_history
+
+            def residual(x):
+                r = rhs - A.AtA(torch_channel_concate(x, opt['necho']))
+                return torch.norm(r.reshape(opt['batch'], -1), dim=1) / torch.norm(rhs.reshape(opt['batch'], -1), dim=1)
+
+            print('CG on a batch of {0} slices, csm scales {1}, max_iter = {2} on {3}'.format(
+                  opt['batch'], [round(s, 3) for s in scales.tolist()], opt['max_iter'], device))
+            latency, _, x_global = time_call(cg_global, 1, device)
+            print('{0:>28}: {1:9.1f} ms, relative residuals {2}'.format(
+                  'global rTr', latency, ['{0:.1e}'.format(e) for e in residual(x_global).tolist()]))
+            latency, _, x_slice = time_call(cg_per_slice, 1, device)
+            print('{0:>28}: {1:9.1f} ms, relative residuals {2}'.format(
+                  'one slice at a time', latency, ['{0:.1e}'.format(e) for e in residual(x_slice).tolist()]))
+            for tol in [0, opt['cg_tol']]:
+                latency, _, (x, niters, history) = time_call(lambda: cg_batched(tol), 1, device)
+                print('{0:>28}: {1:9.1f} ms, relative residuals {2}'.format(
+                      'batched, tol = {0:g}'.format(tol), latency, ['{0:.1e}'.format(e) for e in residual(x).tolist()]))
+                print('{0:>28}  iterations {1}, {2} of {3} AtA sample applications'.format(
+                      '', niters.tolist(), int(torch.sum(niters)), opt['batch']*(len(history)-1)))
+                if tol == 0:
+                    err = torch.norm(x - x_slice) / torch.norm(x_slice)
+                    print('{0:>28}  relative difference to one slice at a time: {1:.3e}'.format('', err))
+
+    elif opt['mode'] == 'implicit':
+        # gradcheck of the implicit backward on a small double precision problem
+        csm_d, mask_d, flip_d, img_d = [t.double() for t in make_inputs(2, 2, 2, 16, 8, 0.5, device)]
+
+        def dc_solve(rhs, lambda_dll2):
+            A = Back_forward_multiEcho(csm_d, mask_d, flip_d, lambda_dll2, necho=2)
+            dc_layer = DC_layer_multiEcho(A, rhs, necho=2, flag_batch_cg=1, tol=1e-13, flag_implicit=1)
+            return dc_layer.CG_iter(max_iter=500)
+
+        rhs_d = img_d.clone().requires_grad_()
+        lambda_d = (torch.ones(1, device=device, dtype=torch.float64)*0.1).requires_grad_()
+        passed = torch.autograd.gradcheck(dc_solve, (rhs_d, lambda_d), eps=1e-6, atol=1e-6, rtol=1e-4)
+        print('gradcheck of the implicit CG backward w.r.t. rhs and lambda_dll2: {0}'.format(passed))
+
+        # unrolled vs implicit gradients, memory and time of forward + backward
+        w = torch.randn(csm.size()[0], 2, opt['necho'], opt['nrow'], opt['ncol'], device=device)
+        print('forward + backward of one DC layer, {0} coils, {1} echos, {2}x{3} on {4}'.format(
+              opt['ncoil'], opt['necho'], opt['nrow'], opt['ncol'], device))
+        for max_iter in sorted(set([opt['max_iter'], 3*opt['max_iter']])):
+            grads = {}
+            for flag_implicit in [0, 1]:
+                def forward_backward():
+                    rhs = img.clone().requires_grad_()
+                    lambda_dll2_ = lambda_dll2.clone().requires_grad_()
+                    A = Back_forward_multiEcho(csm, mask, flip, lambda_dll2_, necho=opt['necho'], scanner=opt['scanner'])
+                    dc_layer = DC_layer_multiEcho(A, rhs, necho=opt['necho'], flag_implicit=flag_implicit)
+                    torch.sum(dc_layer.CG_iter(max_iter=max_iter) * w).backward()
+                    return rhs.grad, lambda_dll2_.grad
+                latency, peak, grads[flag_implicit] = time_call(forward_backward, 1, device)
+                print('{0:>9}, max_iter = {1:3d}: {2:9.1f} ms, peak memory {3:8.1f} MB'.format(
+                      ['unrolled', 'implicit'][flag_implicit], max_iter, latency, peak))
+            err_rhs = torch.norm(grads[1][0] - grads[0][0]) / torch.norm(grads[0][0])
+            err_lambda = torch.abs(grads[1][1] - grads[0][1]) / torch.abs(grads[0][1])
+            print('{0:>9}  relative difference of the gradients: rhs {1:.3e}, lambda_dll2 {2:.3e}'.format(
+                  '', err_rhs, float(err_lambda)))
+
+    elif opt['mode'] == 'precond':
+        # iterations of batched CG to reach cg_tol for plain CG and the preconditioners of models/preconditioners.py,
+        # on A^H y of synthetic data or of a batch of GE/CBIC slices
+        lambda_dll2 = torch.tensor([float(l) for l in opt['lambdas'].split(',')], device=device)
+        if opt['dataset'] == 'synthetic':
+            scales = torch.logspace(0, -1, opt['batch'], device=device)
+            csm = torch.tensor(c2r_kdata(make_coil_maps(opt['ncoil'], opt['nrow'], opt['ncol']))[None, ...], device=device).float()
+            csm = csm * scales[:, None, None, None, None, None]
+            rhs = Back_forward_multiEcho(csm, mask, flip, lambda_dll2, necho=opt['necho'], scanner=opt['scanner']).AhA(img)
+        else:
+            if opt['dataset'] == 'GE':
+                dataLoader = kdata_multi_echo_GE(rootDir=opt['rootDir'], necho=opt['necho'], split='test', normalization=1)
+            else:
+                dataLoader = kdata_multi_echo_CBIC(rootDir=opt['rootDir'], necho=opt['necho'], split='val', scanner=opt['scanner'])
+            batch = data.DataLoader(dataLoader, batch_size=opt['batch'], shuffle=True).__iter__().__next__()
+            kdata, csm = batch[0].to(device).float(), batch[-4 if opt['dataset'] == 'CBIC' else 2].to(device).float()
+            mask = mask[:, :1, ...].repeat(1, csm.size()[1], 1, 1, 1, 1)
+            rhs = backward_multiEcho(kdata, csm, mask, flip, necho=opt['necho'], scanner=opt['scanner'])
+
+        print('{0} slices ({1}), lambda_dll2 {2}, tolerance {3:g}, max_iter {4} on {5}'.format(
+              opt['batch'], opt['dataset'], lambda_dll2.tolist(), opt['cg_tol'], opt['max_iter'], device))
+        names = ['plain CG', 'learned', 'Jacobi', 'circulant']
+        with torch.no_grad():
+            outputs = {}
+            for flag_precond in [0, 2, 3]:
+                def solve():
+                    A = Back_forward_multiEcho(csm, mask, flip, lambda_dll2, necho=opt['necho'], scanner=opt['scanner'])
+                    dc_layer = DC_layer_multiEcho(A, rhs, necho=opt['necho'], flag_precond=flag_precond,
+                                                  use_dll2=opt['use_dll2'], flag_batch_cg=1, tol=opt['cg_tol'])
+                    return dc_layer.CG_iter(max_iter=opt['max_iter']), dc_layer.niters
+                latency, _, (outputs[flag_precond], niters) = time_call(solve, 1, device)
+                print('{0:>10}: {1:9.1f} ms, iterations to tolerance {2}'.format(names[flag_precond], latency, niters.tolist()))
+            for flag_precond in [2, 3]:
+                err = torch.norm(outputs[flag_precond] - outputs[0]) / torch.norm(outputs[0])
+                print('{0:>10}: relative difference to plain CG solution {1:.3e}'.format(names[flag_precond], err))
+
+    elif opt['mode'] == 'fused':
+        # equivalence, latency and allocations per call of the GE operators with the flip and the
+        # fft_shift_row copies (precompute=0, reference functions) vs folded into csm and k-space (odd --nrow for the phase ramp)
+        kdata = forward_multiEcho_shift(img, csm, mask, flip)
+        print('{0} coils, {1} echos, {2}x{3} on {4}'.format(
+              opt['ncoil'], opt['necho'], opt['nrow'], opt['ncol'], device))
+        operators = {
+            'Back_forward.AtA': lambda precompute: (lambda A: lambda: A.AtA(img[:, :2, ...]))(
+                Back_forward(csm[:, :, 0, ...], mask[:, 0, 0, ...], lambda_dll2, precompute=precompute)),
+            'Back_forward_multiEcho.AtA': lambda precompute: (lambda A: lambda: A.AtA(img))(
+                Back_forward_multiEcho(csm, mask, flip, lambda_dll2, necho=opt['necho'], precompute=precompute)),
+            'backward_multiEcho': lambda fused: (lambda: backward_multiEcho(kdata, csm, mask, flip, necho=opt['necho'])) if fused
+                else (lambda: backward_multiEcho_shift(kdata, csm, mask, flip, necho=opt['necho'])),
+            'forward_multiEcho': lambda fused: (lambda: forward_multiEcho(img, csm, mask, flip)) if fused
+                else (lambda: forward_multiEcho_shift(img, csm, mask, flip))
+        }
+        with torch.no_grad():
+            for name, operator in operators.items():
+                outputs = {}
+                for fused in [0, 1]:
+                    fn = operator(fused)
+                    latency, peak, outputs[fused] = time_call(fn, opt['niter'], device)
+                    nallocs, nbytes = count_allocs(fn, device)
+                    print('{0:>27} {1:>7}: {2:8.3f} ms/call, {3:3d} allocations ({4:8.1f} MB) per call, peak memory {5:8.1f} MB'.format(
+                          name, ['shifted', 'fused'][fused], latency, nallocs, nbytes, peak))
+                err = torch.norm(outputs[1] - outputs[0]) / torch.norm(outputs[0])
+                print('{0:>27}: relative difference {1:.3e}'.format(name, err))
+
+    elif opt['mode'] == 'tv':
+        # l2-TV (use_dll2 = 2) and l1-TV (use_dll2 = 3) regularization terms of AtA with the torch.cat finite
+        # differences (gradient evaluated twice in l1-TV) vs the in-place ones of utils/operators.py
+        print('TV terms of {0}x{1}x{2}x{3} images on {4}'.format(
+              opt['batch'], 2*opt['necho'], opt['nrow'], opt['ncol'], device))
+        tv_terms = {
+            'l2-TV cat': lambda: divergence_cat(gradient_cat(img)),
+            'l2-TV': lambda: divergence(gradient(img)),
+            'l1-TV cat': lambda: divergence_cat(gradient_cat(img) / torch.sqrt(gradient_cat(img)**2+5e-4)),
+            'l1-TV': lambda: (lambda grad: divergence(grad / torch.sqrt(grad**2+5e-4)))(gradient(img))
+        }
+        outputs = {}
+        with torch.no_grad():
+            for name, fn in tv_terms.items():
+                latency, peak, outputs[name] = time_call(fn, opt['niter'], device)
+                nallocs, nbytes = count_allocs(fn, device)
+                print('{0:>10}: {1:8.3f} ms/call, {2:3d} allocations ({3:8.1f} MB) per call, peak memory {4:8.1f} MB'.format(
+                      name, latency, nallocs, nbytes, peak))
+        for name in ['l2-TV', 'l1-TV']:
+            err = torch.norm(outputs[name] - outputs[name+' cat']) / torch.norm(outputs[name+' cat'])
+            print('{0:>10}: relative difference {1:.3e}'.format(name, err))
+
+        # 3d differences of a (batch, 2, slice, row, col) volume: in-plane components as the 2d ones of
+        # each slice, slice component as the 2d row differences of the volume transposed
+        volume = torch.stack((img[:, 0::2, ...], img[:, 1::2, ...]), dim=1)  # echos as slices
+        grad = gradient(volume, ndims=3)
+        slices = volume.permute(0, 2, 1, 3, 4).reshape(-1, 2, opt['nrow'], opt['ncol'])
+        err_plane = torch.norm(grad[..., :2].permute(0, 2, 1, 3, 4, 5).reshape(-1, 2, opt['nrow'], opt['ncol'], 2) - gradient_cat(slices))
+        err_slice = torch.norm(grad[..., 2].transpose(2, 3) - gradient_cat(volume.transpose(2, 3).reshape(
+                               -1, 2, opt['necho'], opt['ncol']))[..., 1].reshape(volume.transpose(2, 3).size()))
+        err_div = torch.norm(divergence(grad[..., :2]).permute(0, 2, 1, 3, 4).reshape(slices.size()) - divergence_cat(gradient_cat(slices)))
+        print('3d gradient: in-plane difference {0:.3e}, slice difference {1:.3e}, in-plane divergence difference {2:.3e}'.format(
+              err_plane, err_slice, err_div))
+
+
+    elif opt['mode'] == 'lowrank':
+        # low rank projection Ur*Ur^H of the rank > 0 AtA and of low_rank_approx: permuted cplx_matmlpy
+        # vs the (2*echo, 2*echo) matmul of Subspace_projector, AtA with rank = 0 as baseline
+        U = torch.svd(torch.randn(opt['necho'], opt['necho'], 2, device=device)[..., 0])[0]
+        U = torch.stack((U, torch.zeros_like(U)), -1)  # real orthonormal temporal basis (echo, echo, 2)
+        U = cplx_mlpy(U, torch.stack((torch.cos(torch.arange(opt['necho'], device=device)[:, None] * 0.3),
+                                      torch.sin(torch.arange(opt['necho'], device=device)[:, None] * 0.3)), -1))  # complex basis
+        print('rank {0} of {1} echos, {2}x{3}x{4} images on {5}'.format(
+              opt['rank'], opt['necho'], opt['batch'], opt['nrow'], opt['ncol'], device))
+        projector = Subspace_projector(U=U, rank=opt['rank'])
+        Ur = U[:, :opt['rank'], :]
+        with torch.no_grad():
+            latency_ref, _, ref = time_call(lambda: low_rank_projection_permute(img, Ur, opt['necho']), opt['niter'], device)
+            latency, _, out = time_call(lambda: projector(img), opt['niter'], device)
+            print('projection Ur*Ur^H: permuted cplx_matmlpy {0:8.3f} ms/call, Subspace_projector {1:8.3f} ms/call, relative difference {2:.3e}'.format(
+                  latency_ref, latency, torch.norm(out - ref) / torch.norm(ref)))
+
+            for rank in [0, opt['rank']]:
+                A = Back_forward_multiEcho(csm, mask, flip, lambda_dll2, lambda_dll2, necho=opt['necho'], U=U, rank=rank,
+                                           projector=projector if rank else None)
+                latency, _, _ = time_call(lambda: A.AtA(img), opt['niter'], device)
+                print('AtA with rank {0:2d}: {1:8.3f} ms/call'.format(rank, latency))
+
+            # real principal directions (2*rank for the complex rank subspace) of the central k-space of images close to it
+            csm = torch.ones_like(csm[:, :, :1, ...]) / opt['ncoil']**0.5  # echo-shared csm keeps the echo subspace
+            kdata = forward_multiEcho(projector(img) + 0.01*img, csm, torch.ones_like(mask), flip)
+            csm = csm[:, :, :, opt['nrow']//2-13:opt['nrow']//2+12, opt['ncol']//2-13:opt['ncol']//2+12, :]  # low resolution csm
+            latency_ref, _, V_ref = time_call(lambda: compute_V_pca(kdata, csm, k=2*opt['rank']), 1, device)
+            latency, _, V = time_call(lambda: compute_V(kdata, csm, k=2*opt['rank']), 1, device)
+            # distance between the subspaces, |V*V^T - V_ref*V_ref^T|_F (pca_lowrank is randomized)
+            err = torch.norm(torch.matmul(V, V.t()) - torch.matmul(V_ref, V_ref.t()))
+            print('compute_V: pca_lowrank on cpu {0:8.3f} ms, on-device svd {1:8.3f} ms, subspace distance {2:.3e}'.format(
+                  latency_ref, latency, err))
+
+    elif opt['mode'] == 'bcrnn':
+        # BCRNN layer of Resnet_with_DC2 (flag_BCRNN = 1) on (nt, batch, 2, row, col) inputs, forward + backward:
+        # two loops of CRNNcell calls per echo vs i2h batched over time and the two directions stacked in the batch
+        print('{0}x{1}x{2} inputs on {3}'.format(opt['batch'], opt['nrow'], opt['ncol'], device))
+        for hidden_size in [int(n) for n in opt['hidden_sizes'].split(',')]:
+            bcrnn = BCRNNlayer(2, hidden_size, 3).to(device)
+            for nt in [int(n) for n in opt['nts'].split(',')]:
+                input = torch.randn(nt, opt['batch'], 2, opt['nrow'], opt['ncol'], device=device, requires_grad=True)
+                outputs, latencies = [], []
+                for flag_time_batch in [0, 1]:
+                    bcrnn.flag_time_batch = flag_time_batch
+                    def step():
+                        bcrnn.zero_grad()
+                        input.grad = None
+                        output = bcrnn(input)
+                        output.pow(2).sum().backward()
+                        # parameter gradients concatenated (those of the conv biases before GroupNorm are rounding noise)
+                        return [output.detach(), input.grad, torch.cat([p.grad.flatten() for p in bcrnn.parameters()])]
+                    latency, peak, out = time_call(step, opt['niter'], device)
+                    outputs.append(out)
+                    latencies.append((latency, peak))
+                err = max((torch.norm(b - a) / torch.norm(a)).item() for a, b in zip(*outputs))
+                print('hidden_size {0:3d}, nt {1:3d}: per echo {2:8.3f} ms ({3:7.1f} MB), time batched {4:8.3f} ms ({5:7.1f} MB), '
+                      'relative difference of output and gradients {6:.3e}'.format(
+                      hidden_size, nt, latencies[0][0], latencies[0][1], latencies[1][0], latencies[1][1], err))
+
+    elif opt['mode'] == 'amp':
+        # Resnet_with_DC2 of main_multi_echo_GE (BCRNN + unet denoisers, deep ADMM, checkpointed) in fp32 vs fp16 autocast
+        # of the denoisers (operators and CG in fp32): latency and peak memory of a training step on a batch, and
+        # PSNR/SSIM to the targets of the recons of nslice synthetic or GE/CBIC validation slices
+        netG_dc = Resnet_with_DC2(input_channels=2*opt['necho'], filter_channels=32*opt['necho'], necho=opt['necho'],
+                                  lambda_dll2=1e-3, nrow=opt['nrow'], ncol=opt['ncol'], ncoil=opt['ncoil'], K=opt['K'],
+                                  echo_cat=1, flag_solver=1, flag_BCRNN=1, flag_unet=1, flag_cp=1, flag_scanner=opt['scanner'],
+                                  cg_max_iter=opt['max_iter']).to(device)
+        if opt['weights'] is not None:
+            netG_dc.load_state_dict(torch.load(opt['weights'], map_location=device))
+        weights = copy.deepcopy(netG_dc.state_dict())
+
+        def val_batches():
+            '''
+                (kdata, target, csm, brain_mask) batches of the nslice slices
+            '''
+            if opt['dataset'] == 'synthetic':
+                generator = torch.Generator().manual_seed(0)
+                for start in range(0, opt['nslice'], opt['batch']):
+                    nbatch = min(opt['batch'], opt['nslice']-start)
+                    csm = torch.randn(nbatch, opt['ncoil'], opt['necho'], opt['nrow'], opt['ncol'], 2, generator=generator).to(device)
+                    target = torch.randn(nbatch, 2*opt['necho'], opt['nrow'], opt['ncol'], generator=generator).to(device)
+                    yield forward_multiEcho(target, csm, mask, flip, scanner=opt['scanner']), target, csm, torch.ones_like(target)
+            else:
+                if opt['dataset'] == 'GE':
+                    dataLoader = kdata_multi_echo_GE(rootDir=opt['rootDir'], necho=opt['necho'], split='val', normalization=1)
+                else:
+                    dataLoader = kdata_multi_echo_CBIC(rootDir=opt['rootDir'], necho=opt['necho'], split='val', scanner=opt['scanner'])
+                dataLoader = data.Subset(dataLoader, range(min(opt['nslice'], len(dataLoader))))
+                for batch in data.DataLoader(dataLoader, batch_size=opt['batch']):
+                    yield (batch[0].to(device).float(), batch[1].to(device).float(),
+                           batch[-4 if opt['dataset'] == 'CBIC' else 2].to(device).float(),
+                           batch[-2 if opt['dataset'] == 'CBIC' else 3].to(device).float())
+
+        print('{0} slices ({1}) of {2}x{3}, batch {4}, K {5} on {6}'.format(
+              opt['nslice'], opt['dataset'], opt['nrow'], opt['ncol'], opt['batch'], opt['K'], device))
+        loss = lossL2()
+        kdata, target, csm, brain_mask = next(val_batches())
+        mask = mask[:, :1, ...].repeat(1, csm.size()[1], 1, 1, 1, 1)
+        latencies = []
+        for flag_amp in [0, 1]:
+            netG_dc.load_state_dict(weights)
+            netG_dc.train()
+            optimizer = torch.optim.Adam(netG_dc.parameters(), lr=1e-3, betas=(0.9, 0.999))
+            scaler = GradScaler(enabled=bool(flag_amp))
+            def step():
+                optimizer.zero_grad()
+                with autocast(enabled=bool(flag_amp)):
+                    Xs = netG_dc(kdata, csm, None, mask, flip)
+                loss_sum = sum(loss(X*brain_mask, target*brain_mask) for X in Xs)
+                scaler.scale(loss_sum).backward()
+                scaler.step(optimizer)
+                scaler.update()
+                return loss_sum.detach()
+            latency, peak, _ = time_call(step, opt['niter'], device)
+            latencies.append((latency, peak))
+
+        netG_dc.load_state_dict(weights)
+        netG_dc.eval()
+        metrices, ssims, diff, norm = [Metrices(), Metrices()], [[], []], 0, 0
+        with torch.no_grad():
+            for kdata, target, csm, brain_mask in val_batches():
+                recons = []
+                for flag_amp in [0, 1]:
+                    with autocast(enabled=bool(flag_amp)):
+                        X = netG_dc(kdata, csm, None, mask, flip)[-1]
+                    metrices[flag_amp].get_metrices(X*brain_mask, target*brain_mask)
+                    ssims[flag_amp].append(ssim(X*brain_mask, target*brain_mask).item())
+                    recons.append(X)
+                diff += torch.sum((recons[1] - recons[0])**2).item()
+                norm += torch.sum(recons[0]**2).item()
+        for flag_amp in [0, 1]:
+            print('{0}: training step {1:9.1f} ms ({2:8.1f} MB), PSNR {3:.3f} dB, SSIM {4:.5f}'.format(
+                  'amp ' if flag_amp else 'fp32', latencies[flag_amp][0], latencies[flag_amp][1],
+                  np.mean(metrices[flag_amp].PSNRs), np.mean(ssims[flag_amp])))
+        print('relative difference of the amp to the fp32 recons {0:.3e}'.format(np.sqrt(diff / norm)))
+
+    elif opt['mode'] == 'compile':
+        # inference of the Resnet_with_DC2 of main_multi_echo_GE (BCRNN + unet denoisers, deep ADMM) on one slice of the
+        # protocol shapes: eager mode with the early-stopped CG loops vs max_iter CG iterations without python control flow
+        # on the data (flag_static_cg = 1), its TorchScript trace (compile_recon) and torch.compile when available (torch >= 2.0)
+        netG_dc = Resnet_with_DC2(input_channels=2*opt['necho'], filter_channels=32*opt['necho'], necho=opt['necho'],
+                                  lambda_dll2=1e-3, nrow=opt['nrow'], ncol=opt['ncol'], ncoil=opt['ncoil'], K=opt['K'],
+                                  echo_cat=1, flag_solver=1, flag_BCRNN=1, flag_unet=1, flag_scanner=opt['scanner'],
+                                  cg_max_iter=opt['max_iter']).to(device)
+        if opt['weights'] is not None:
+            netG_dc.load_state_dict(torch.load(opt['weights'], map_location=device))
+        netG_dc.eval()
+        csm, img = csm[:1], img[:1]  # one slice
+        kdata = forward_multiEcho(img, csm, mask, flip, scanner=opt['scanner'])
+        print('Resnet_with_DC2 inference of {0} coils, {1} echos, {2}x{3}, K {4}, {5} CG iterations on {6}'.format(
+              opt['ncoil'], opt['necho'], opt['nrow'], opt['ncol'], opt['K'], opt['max_iter'], device))
+
+        recons = {}
+        with torch.no_grad():
+            for name, flag_static_cg in [('eager', 0), ('eager static CG', 1)]:
+                netG_dc.flag_static_cg = flag_static_cg
+                latency, _, recons[name] = time_call(lambda: netG_dc(kdata, csm, None, mask, flip, test=True)[-1], opt['niter'], device)
+                print('{0:>16}: {1:9.3f} ms/slice'.format(name, latency))
+            t0 = time.time()
+            traced = compile_recon(netG_dc, kdata, csm, mask, flip, mode='trace')
+            print('{0:>16}: traced in {1:.1f} s'.format('TorchScript', time.time() - t0))
+            latency, _, recons['TorchScript'] = time_call(lambda: traced(kdata, csm, mask, flip), opt['niter'], device)
+            print('{0:>16}: {1:9.3f} ms/slice'.format('TorchScript', latency))
+            if hasattr(torch, 'compile'):
+                compiled = compile_recon(netG_dc, kdata, csm, mask, flip, mode='compile')
+                latency, _, recons['torch.compile'] = time_call(lambda: compiled(kdata, csm, mask, flip), opt['niter'], device)
+                print('{0:>16}: {1:9.3f} ms/slice'.format('torch.compile', latency))
+        for name, recon in recons.items():
+            if name != 'eager':
+                err = torch.norm(recon - recons['eager']) / torch.norm(recons['eager'])
+                print('relative difference of {0} to eager: {1:.3e}'.format(name, err))
+        if opt['export'] is not None:
+            traced.save(opt['export'])
+            print('TorchScript recon saved to {}'.format(opt['export']))
+
+    elif opt['mode'] == 'slab':
+        # test volume of main_multi_echo_GE --slab: a batch of opt['batch'] slices reconstructed in one call by the BCRNN
+        # branches of Resnet_with_DC2 (gradient descent with the CNN denoiser, deep ADMM with the unet) vs slice by slice,
+        # with batched CG (flag_batch_cg = 1) so that the step sizes and stopping of the CG loops are per slice
+        kdata = forward_multiEcho(img, csm, mask, flip, scanner=opt['scanner'])
+        print('Resnet_with_DC2 inference of {0} slices, {1} coils, {2} echos, {3}x{4}, K {5}, {6} CG iterations on {7}'.format(
+              opt['batch'], opt['ncoil'], opt['necho'], opt['nrow'], opt['ncol'], opt['K'], opt['max_iter'], device))
+        for solver in [0, 1]:
+            netG_dc = Resnet_with_DC2(input_channels=2*opt['necho'], filter_channels=32*opt['necho'], necho=opt['necho'],
+                                      lambda_dll2=1e-3, nrow=opt['nrow'], ncol=opt['ncol'], ncoil=opt['ncoil'], K=opt['K'],
+                                      echo_cat=1, flag_solver=solver, flag_BCRNN=1, flag_unet=solver, flag_scanner=opt['scanner'],
+                                      flag_batch_cg=1, cg_tol=opt['cg_tol'], cg_max_iter=opt['max_iter']).to(device)
+            if opt['weights'] is not None and solver == 1:
+                netG_dc.load_state_dict(torch.load(opt['weights'], map_location=device))
+            netG_dc.eval()
+            with torch.no_grad():
+                latency_slab, _, recon_slab = time_call(lambda: netG_dc(kdata, csm, None, mask, flip, test=True)[-1], opt['niter'], device)
+                latency_slices, _, recon_slices = time_call(lambda: torch.cat(
+                    [netG_dc(kdata[i:i+1], csm[i:i+1], None, mask, flip, test=True)[-1] for i in range(opt['batch'])]), opt['niter'], device)
+            err = torch.norm(recon_slab - recon_slices) / torch.norm(recon_slices)
+            print('solver {0}: {1:9.3f} ms/slice by slab, {2:9.3f} ms/slice slice by slice, relative difference {3:.3e}'.format(
+                  solver, latency_slab / opt['batch'], latency_slices / opt['batch'], err))
@@ -0,0 +1,23 @@
+"""
+    Convert cfl slice folders (one folder per subject) into packed folders read by the loaders with flag_packed = 1
+    e.g. python convert_packed.py --folders /data/Jinwei/QSM_raw_CBIC/data_cfl/jiahao2/full_cc_slices_sense_echo/
+"""
+import argparse
+
+from utils.packed import pack_slices
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Convert_packed')
+    parser.add_argument('--folders', type=str, nargs='+')  # cfl slice folders to pack
+    parser.add_argument('--names', type=str, default=None)  # e.g. 'fully_slice_,sensMaps_slice_,kdata_slice_,mask_slice_', all found if None
+    parser.add_argument('--start', type=int, default=None)  # slice range [start, end), all found if None
+    parser.add_argument('--end', type=int, default=None)
+    opt = {**vars(parser.parse_args())}
+
+    names = opt['names'].split(',') if opt['names'] is not None else None
+    idxs = list(range(opt['start'], opt['end'])) if opt['start'] is not None else None
+    for dataFD in opt['folders']:
+        index = pack_slices(dataFD if dataFD.endswith('/') else dataFD + '/', names, idxs)
+        print('{0}: {1} slices of {2}'.format(dataFD, len(index['slices']), ', '.join(index['names'])))
@@ -18,10 +18,10 @@ def fit_R2_LM(M, max_iter=10, tol=1e-2):
 
     # s0[s0==0] = 1e-8
     tr = torch.arange(0, nechos)[:, None, None]  # 1st dim: real = 1
-    tr = tr.repeat(1, 1, numvox).to('cuda')  # echo time
-    tc = torch.cat((tr, torch.zeros(tr.size()).to('cuda')), dim=1) # complex t, (nechos, 2, nvoxels)
+    tr = tr.repeat(1, 1, numvox).to(M.device, M.dtype)  # echo time
+    tc = torch.cat((tr, torch.zeros_like(tr)), dim=1) # complex t, (nechos, 2, nvoxels)
 
-    y = torch.zeros(4, numvox).to('cuda')  # 0st dimension: 0:2 for R2s, 2:4 for water
+    y = M.new_zeros(4, numvox)  # 0st dimension: 0:2 for R2s, 2:4 for water
     y[2, :] = torch.sqrt(s0[0, 0, :]**2 + s0[0, 1, :]**2)
 
     y_times_t = mlpy_in_cg(y[None, 0:2, :].repeat(nechos, 1, 1), tc)
@@ -95,10 +95,10 @@ def arlo(te, y, flag_water=0):
     if sz[edx-1] != nte:
         raise Exception("Number of echoes does not match mGRE images")
 
-    yy = torch.zeros(sz[:-1]).to('cuda')
-    yx = torch.zeros(sz[:-1]).to('cuda')
-    beta_yx = torch.zeros(sz[:-1]).to('cuda')
-    beta_xx = torch.zeros(sz[:-1]).to('cuda')
+    yy = y.new_zeros(sz[:-1])
+    yx = y.new_zeros(sz[:-1])
+    beta_yx = y.new_zeros(sz[:-1])
+    beta_xx = y.new_zeros(sz[:-1])
 
     for j in range(nte-2):
         alpha = (te[j+2]-te[j])*(te[j+2]-te[j])/2/(te[j+1]-te[j])
@@ -117,7 +117,7 @@ def arlo(te, y, flag_water=0):
     r2[torch.isinf(r2)] = 0
 
     if flag_water:
-        A = torch.exp(-r2[..., None] * torch.tensor(np.array(te)[None, None, None, :]).to('cuda'))
+        A = torch.exp(-r2[..., None] * torch.tensor(np.array(te)[None, None, None, :]).to(y.device, y.dtype))
         water = torch.sum(A * y, dim=-1) / torch.sum(A * A, dim=-1)
         return [r2, water]
     else:
@@ -148,8 +148,8 @@ def fit_complex(M, max_iter=30):
         Y[cd<-pi, n+1:] = Y[cd<-pi, n+1:] + 2*pi
         Y[cd>pi, n+1:] = Y[cd>pi, n+1:] - 2*pi
 
-    A = torch.tensor([[1.0, 0.0], [1.0, 1.0], [1.0, 2.0]]).to('cuda')
-    AA_inv = torch.tensor([[5/6, -1/2], [-1/2, 1/2]]).to('cuda')
+    A = torch.tensor([[1.0, 0.0], [1.0, 1.0], [1.0, 2.0]]).to(M.device, M.dtype)
+    AA_inv = torch.tensor([[5/6, -1/2], [-1/2, 1/2]]).to(M.device, M.dtype)
     ip = torch.matmul(AA_inv, A.permute(1, 0))
     ip = torch.matmul(ip, Y.permute(1, 0))
     p0 = ip[0, :]
@@ -160,9 +160,9 @@ def fit_complex(M, max_iter=30):
     idx_iter = 0
 
     # weigthed least square, calculation of WA'*WA
-    v1 = torch.ones((1, nechos)).to('cuda')
-    v2 = torch.range(0, nechos-1)[None, :].to('cuda')
-    tmp = torch.ones((s[0], 1)).to('cuda')
+    v1 = M.new_ones((1, nechos))
+    v2 = torch.range(0, nechos-1)[None, :].to(M.device, M.dtype)
+    tmp = M.new_ones((s[0], 1))
     abs_M = torch.sqrt(M[:, 0, :]**2 + M[:, 1, :]**2)
 
     a11 = torch.sum(abs_M**2 * (torch.matmul(tmp, v1**2)), dim=1)
@@ -176,9 +176,9 @@ def fit_complex(M, max_iter=30):
     ai22 = a11/d
 
     tmp1 = torch.matmul(tmp, v1)[:, None, :]
-    tmp1 = torch.cat((tmp1, torch.zeros(tmp1.size()).to('cuda')), dim=1)  # (nvoxel, 2, necho)
+    tmp1 = torch.cat((tmp1, torch.zeros_like(tmp1)), dim=1)  # (nvoxel, 2, necho)
     tmp2 = torch.matmul(tmp, v2)[:, None, :]
-    tmp2 = torch.cat((tmp2, torch.zeros(tmp2.size()).to('cuda')), dim=1)  # (nvoxel, 2, necho)
+    tmp2 = torch.cat((tmp2, torch.zeros_like(tmp2)), dim=1)  # (nvoxel, 2, necho)
 
     abs_M = abs_M[:, None, :]
 
@@ -231,7 +231,7 @@ def fit_complex_all(iField, TE):
     delta_TE = TE[1] - TE[0]
     
     te = TE
-    TE = torch.tensor(TE).to('cuda')
+    TE = torch.tensor(TE).to(iField.device)
     numte = len(TE)
 
     # make the first echo phase all zeros
@@ -242,7 +242,7 @@ def fit_complex_all(iField, TE):
     numvox = S.size()[0]
     t = TE[None, :].repeat(numvox, 1)
 
-    y = torch.zeros(4, numvox).to('cuda')
+    y = torch.zeros(4, numvox, device=iField.device)
 
     # initialization of m0 and r2s
     [R2s, water] = arlo(te, iField.abs(), flag_water=1)
@@ -256,12 +256,12 @@ def fit_complex_all(iField, TE):
     Y = Y.view(matrix_size[0], matrix_size[1], matrix_size[2], 3).cpu().numpy()
     for i in range(3):
         Y[0, :, :, i] = unwrap_phase(Y[0, :, :, i])
-    Y = torch.tensor(Y).to('cuda')
+    Y = torch.tensor(Y).to(iField.device)
     Y = Y.view(-1, 3)
     c = Y[:, 1] - Y[:, 0]
 
     # initial of f0 and p (using the first two echos)
-    A = torch.tensor([[1.0, te[0]], [1.0, te[1]]]).to('cuda')
+    A = torch.tensor([[1.0, te[0]], [1.0, te[1]]]).to(iField.device)
     ip = torch.matmul(torch.inverse(A), Y[:, :2].permute(1, 0))
     y[2, :] = ip[0, :]
     y[3, :] = ip[1, :]
@@ -276,7 +276,7 @@ def fit_complex_all(iField, TE):
             [12, 23, 34, 41], [13, 24, 32, 41], [14, 22, 33, 41],
             [14, 23, 32, 41], [13, 22, 34, 41], [12, 24, 33, 41] ]
 
-    cf_sign = torch.ones(np.shape(cf)[0]).to('cuda')
+    cf_sign = torch.ones(np.shape(cf)[0], device=iField.device)
     cf_sign[3:9] = - cf_sign[3:9]
     cf_sign[15:21] = - cf_sign[15:21]
 
@@ -316,7 +316,7 @@ def fit_complex_all(iField, TE):
         a33 += lambda_l2
         a44 += lambda_l2
 
-        determ = torch.zeros(a11.size()).to('cuda')
+        determ = torch.zeros_like(a11)
         for idx in range(np.shape(cf)[0]):
             cdeterm = eval('a{}'.format(cf[idx][0]))
             for idx2 in range(1, np.shape(cf)[1]):
@@ -420,11 +420,11 @@ class fit_T1T2M0(nn.Module):
         self.num_iter = num_iter
 
         temp = torch.ones(sz[:-1]) * 1000
-        self.T1 = nn.Parameter(temp, requires_grad=True).to('cuda')
+        self.T1 = nn.Parameter(temp, requires_grad=True).to(s.device)
         temp = torch.ones(sz[:-1]) * 100
-        self.T2 = nn.Parameter(temp, requires_grad=True).to('cuda')
+        self.T2 = nn.Parameter(temp, requires_grad=True).to(s.device)
         temp = s[..., -1] * torch.exp(self.TE_T2PREP/100)
-        self.M0 = nn.Parameter(temp, requires_grad=True).to('cuda')
+        self.M0 = nn.Parameter(temp, requires_grad=True).to(s.device)
 
     def forward(self, M2, M3, M5):
         # # saturated net magnetization of TR1
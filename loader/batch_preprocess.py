@@ -0,0 +1,147 @@
+import numpy as np
+import torch
+from utils.data import cplx_mlpy
+
+
+def random_phase(kdatas, orgs, csms, brain_masks):
+    '''
+        augmentation example: random global phase per sample applied to the data and the target
+        (the forward model is linear, so the phase rotated pair stays consistent with the csm)
+    '''
+    phase = torch.rand(kdatas.shape[0], device=kdatas.device) * 2 * np.pi
+    rotation = torch.stack((torch.cos(phase), torch.sin(phase)), -1)  # (batch, 2)
+    kdatas = kdatas * rotation[:, 0].view(-1, 1, 1, 1, 1, 1) + \
+             torch.stack((-kdatas[..., 1], kdatas[..., 0]), -1) * rotation[:, 1].view(-1, 1, 1, 1, 1, 1)
+    if orgs.dim() == 4:
+        # (batch, 2*echo, row, col) with real&imag interleaved
+        re, im = orgs[:, 0::2, ...], orgs[:, 1::2, ...]
+        cos, sin = rotation[:, 0].view(-1, 1, 1, 1), rotation[:, 1].view(-1, 1, 1, 1)
+        orgs = torch.stack((re*cos - im*sin, re*sin + im*cos), 2).reshape(orgs.shape)
+    else:
+        # (batch, 2, echo, row, col)
+        re, im = orgs[:, 0, ...], orgs[:, 1, ...]
+        cos, sin = rotation[:, 0].view(-1, 1, 1, 1), rotation[:, 1].view(-1, 1, 1, 1)
+        orgs = torch.stack((re*cos - im*sin, re*sin + im*cos), 1)
+    return kdatas, orgs, csms, brain_masks
+
+
+class Batch_preprocess():
+    '''
+        pipeline stage applied to the batches of a loader with flag_raw = 1 (e.g. kdata_multi_echo_GE):
+        complex64 slices are transferred as they are read and converted on the device in batch,
+        giving the tensors of the loader with flag_raw = 0:
+            kdatas: (batch, coil, echo, row, col, 2)
+            orgs: (batch, 2*echo, row, col) for echo_cat = 1, (batch, 2, echo, row, col) for echo_cat = 0
+            csms: (batch, coil, 1, row, col, 2)
+            brain_masks: same shape as orgs (broadcast view of the (batch, row, col) mask)
+        augmentations are callables (or None) of (kdatas, orgs, csms, brain_masks) on the whole batch,
+        cycled over the batches as the loaders cycle self.augmentations
+    '''
+
+    def __init__(self,
+        necho = 10,  # number of echos
+        normalization = 0,  # normalization factor of the data (as in the loader)
+        echo_cat = 1,  # flag to concatenate echo dimension into channel
+        augmentations = [None],
+        device = None  # cuda if available by default
+    ):
+
+        self.necho = necho
+        self.normalization = normalization
+        self.echo_cat = echo_cat
+        self.augmentations = augmentations
+        self.augSize = len(self.augmentations)
+        self.augIndex = 0
+        if device is None:
+            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.device = device
+
+    def __call__(self, kdatas, orgs, csms, brain_masks):
+
+        non_blocking = kdatas.is_pinned()
+        kdatas = torch.view_as_real(kdatas.to(self.device, non_blocking=non_blocking))  # (batch, coil, echo, row, col, 2)
+        csms = torch.view_as_real(csms.to(self.device, non_blocking=non_blocking))  # (batch, coil, 1, row, col, 2)
+        orgs = torch.view_as_real(orgs.to(self.device, non_blocking=non_blocking))  # (batch, row, col, echo, 2)
+        brain_masks = brain_masks.to(self.device, non_blocking=non_blocking)  # (batch, row, col)
+
+        nbatch, nrow, ncol, necho = orgs.shape[:4]
+        if self.echo_cat:
+            orgs = orgs.permute(0, 3, 4, 1, 2).reshape(nbatch, 2*necho, nrow, ncol)
+            brain_masks = brain_masks[:, None, ...].expand(nbatch, 2*necho, nrow, ncol)
+        else:
+            orgs = orgs.permute(0, 4, 3, 1, 2).contiguous()
+            brain_masks = brain_masks[:, None, None, ...].expand(nbatch, 2, necho, nrow, ncol)
+        kdatas = kdatas * self.normalization
+        orgs = orgs * self.normalization
+
+        augmentation = self.augmentations[self.augIndex]
+        self.augIndex = (self.augIndex + 1) % self.augSize
+        if augmentation is not None:
+            kdatas, orgs, csms, brain_masks = augmentation(kdatas, orgs, csms, brain_masks)
+        return kdatas, orgs, csms, brain_masks
+
+
+class Kspace_simu():
+    '''
+        pipeline stage applied to the batches of the MS loaders with flag_simu = 1 (kdata_multi_echo_MS,
+        kdata_multi_echo_MS075, kdata_T1T2QSM_MS): the k-space is simulated on the device for the whole
+        batch from the targets as generateKdata does per sample on the cpu (coil multiplication, fft2,
+        complex gaussian noise of std sigma in the image domain, fftshift), the loaders returning the
+        sample indices in place of the kdatas:
+            orgs: (batch, 2*echo, row, col) for echo_cat = 1, (batch, 2, echo, row, col) for echo_cat = 0
+            csms: (batch, coil, 1, row, col, 2)
+            idxs: (batch,) sample indices
+            kdatas (returned): (batch, coil, echo, row, col, 2)
+        the noise of a sample is drawn from its own generator seeded by (seed, epoch, idx), so that the
+        kdatas only depend on the seed, the epoch and the sample and not on the batching or the workers
+    '''
+
+    def __init__(self,
+        sigma = 0.01,  # noise level (as in generateKdata)
+        echo_cat = 1,  # flag to concatenate echo dimension into channel
+        seed = 0,  # base seed of the per-sample noise generators
+        device = None  # cuda if available by default
+    ):
+
+        self.sigma = sigma
+        self.echo_cat = echo_cat
+        self.seed = seed
+        if device is None:
+            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.device = torch.device(device)
+
+    def sample_seed(self, idx, epoch=0):
+        '''
+            seed of the noise of sample idx in epoch
+        '''
+        return int(np.random.SeedSequence([self.seed, epoch, int(idx)]).generate_state(1)[0])
+
+    def noise(self, shape, idxs, epoch=0):
+        '''
+            (batch,) + shape noise of the samples idxs, real&imag parts of std sigma / sqrt(2) * sqrt(row*col)
+            (the std of the fft2 of an image domain noise of std sigma)
+        '''
+        noises = []
+        generator = torch.Generator(device=self.device)
+        for idx in idxs.tolist():
+            generator.manual_seed(self.sample_seed(idx, epoch))
+            noises.append(torch.randn(shape, generator=generator, device=self.device))
+        nrow, ncol = shape[-3], shape[-2]
+        return torch.stack(noises, 0) * (self.sigma / np.sqrt(2.) * np.sqrt(nrow*ncol))
+
+    def __call__(self, orgs, csms, idxs, epoch=0):
+
+        non_blocking = orgs.is_pinned()
+        orgs = orgs.to(self.device, non_blocking=non_blocking)
+        csms = csms.to(self.device, non_blocking=non_blocking)
+
+        if self.echo_cat:
+            nbatch, nchannel, nrow, ncol = orgs.shape
+            images = orgs.view(nbatch, nchannel//2, 2, nrow, ncol).permute(0, 1, 3, 4, 2)  # (batch, echo, row, col, 2)
+        else:
+            nrow, ncol = orgs.shape[-2:]
+            images = orgs.permute(0, 2, 3, 4, 1)  # (batch, echo, row, col, 2)
+        kdatas = torch.fft(cplx_mlpy(csms, images[:, None, ...]), 2)  # (batch, coil, echo, row, col, 2)
+        if self.sigma > 0:
+            kdatas = kdatas + self.noise(kdatas.shape[1:], idxs, epoch)
+        return torch.roll(kdatas, shifts=(nrow//2, ncol//2), dims=(3, 4))  # fftshift
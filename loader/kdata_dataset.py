@@ -0,0 +1,259 @@
+import numpy as np
+import torch
+from torch.utils import data
+from utils.data import c2r, c2r_kdata, coil_compress, load_mat
+from utils.packed import read_slice
+from loader.protocols import Protocol, protocols
+
+
+class Kdata_dataset(data.Dataset):
+    '''
+        Dataloader of the slices of a registered protocol (loader.protocols), samples are the protocol fields among
+            kdata: (coil, echo, row, col, 2)
+            org, recon_input: (2*echo, row, col) for echo_cat = 1, (2, echo, row, col) for echo_cat = 0
+            csm: (coil, echo, row, col, 2) for echo-wise csms, (coil, 1, row, col, 2) otherwise
+            csm_lowres: (coil, 1, row, col, 2)
+            brain_mask, brain_mask_erode: same shape as org
+        without the echo dimension for the single-echo protocols, or with flag_raw = 1 the complex64 arrays
+        returned by read_raw
+    '''
+
+    def __init__(self,
+        protocol = 'multi_echo_GE',  # name of a registered protocol, or a Protocol
+        rootDir = None,  # root of the protocol folders (default of the protocol if None)
+        split = 'train',
+        subject = 0,  # subject of the test split
+        necho = 10, # number of echos
+        normalization = 0,  # normalization factor, or factors of the echos (flag with the protocols of a fixed scale)
+        echo_cat = 1, # flag to concatenate echo dimension into channel
+        batchSize = 1,
+        augmentations = [None],
+        ncoil_compress = 0,  # number of virtual coils after SVD coil compression (0: no compression)
+        flag_packed = 0,  # flag to read the slices from the packed folders (convert_packed.py)
+        flag_raw = 0,  # flag to return the complex64 slices, converted in batch on the device by Batch_preprocess
+        slab = 1,  # number of consecutive slices read per I/O call from the packed folders (with Subject_batch_sampler)
+        nslice = None,  # number of slices per subject (default of the protocol if None)
+        startIdx = None,  # first slice of the subjects (default of the protocol if None)
+        slice_stride = 1,  # stride between the slices read from each subject
+        echos = None,  # indices of the echos kept from the slices, e.g. [0, 2, 4, 9, 10] (all if None)
+        num_subs = None,  # number of training subjects (all if None)
+        params = {}  # parameters of the folder names (e.g. {'loupe': 0})
+    ):
+
+        if not isinstance(protocol, Protocol):
+            protocol = protocols[protocol]
+        self.protocol = protocol
+        self.rootDir = protocol.rootDir if rootDir is None else rootDir
+        self.split = split
+        self.necho = necho
+        self.normalization = normalization
+        self.echo_cat = echo_cat
+        self.ncoil_compress = ncoil_compress
+        self.flag_packed = flag_packed
+        self.flag_raw = flag_raw
+        self.slab = slab
+        self.slice_stride = slice_stride
+        self.echos = echos
+
+        subjects = protocol.subjects[split]
+        if split == 'test':
+            subjects = [subjects[subject]]
+            print("Test on {}".format(subjects[0][0].format(**params)))
+        if num_subs is not None:
+            subjects = subjects[:num_subs]
+        roots = (self.rootDir, self.rootDir if protocol.shared_rootDir is None else protocol.shared_rootDir)
+        self.subjects = [tuple(None if folder is None else root + folder.format(**params) for root, folder in zip(roots, folders))
+                         for folders in subjects]
+        self.startIdx, self.nslice = protocol.slices[split]
+        if startIdx is not None:
+            self.startIdx = startIdx
+        if nslice is not None:
+            self.nslice = nslice
+        self.nsamples = self.nslice * len(self.subjects)
+
+        self.augmentations = augmentations
+        self.augmentation = self.augmentations[0]
+        self.augSize = len(self.augmentations)
+        self.augIndex = 0
+        self.batchSize = batchSize
+        self.batchIndex = 0
+
+        if 'recon_input' in protocol.fields:
+            self.recon_inputs = None
+            for i, filename in enumerate(protocol.recon_inputs[split]):
+                recon_input = load_mat(self.rootDir + filename, 'Recons')
+                if self.recon_inputs is None:
+                    # complex64, the samples are converted to float32 by c2r
+                    self.recon_inputs = np.zeros((self.nsamples,) + recon_input.shape[1:], dtype=np.complex64)
+                self.recon_inputs[i*self.nslice:(i+1)*self.nslice, ...] = recon_input
+
+    def __len__(self):
+
+        return self.nsamples * self.augSize
+
+    def read_field(self, field, idx):
+        '''
+            complex array of field for sample idx as stored in the slice folders
+        '''
+        folder, shared = self.subjects[idx // self.nslice]
+        slice_idx = idx % self.nslice * self.slice_stride + self.startIdx
+        role, name = self.protocol.files[field]
+        if role == 'shared':
+            folder = shared
+            if self.protocol.shared_modulo > 0:
+                slice_idx = slice_idx % self.protocol.shared_modulo
+        block = np.s_[..., :self.necho] if field in self.protocol.echo_block else None
+        if self.protocol.file_format == 'mat':
+            return load_mat(folder + name + self.protocol.slice_name.format(slice_idx) + '.mat', name[:-1], block)
+        # echos split into several folders are concatenated, the masks are read from the first one
+        folders = self.protocol.echo_folders
+        if field in ['brain_mask', 'brain_mask_erode']:
+            folders = folders[:1]
+        slices = [read_slice(folder + suffix, name, slice_idx, block, flag_packed=self.flag_packed, nslab=self.slab,
+                             slice_name=self.protocol.slice_name) for suffix in folders]
+        return slices[0] if len(slices) == 1 else np.concatenate(slices, axis=-1)
+
+    def read_raw(self, idx):
+        '''
+            complex64 fields of sample idx before real&imag conversion, mask broadcasting and normalization:
+            kdata (coil, echo, row, col), org and recon_input (row, col, echo), csm (coil, echo or 1, row, col),
+            csm_lowres (coil, 1, row, col), real float32 brain_mask and brain_mask_erode (row, col)
+        '''
+        fields = self.protocol.fields
+        sample = {}
+        for field in fields:
+            if field in self.protocol.computed:
+                continue
+            elif field == 'recon_input':
+                sample[field] = self.recon_inputs[idx, ...]
+            elif field in ['brain_mask', 'brain_mask_erode']:
+                sample[field] = np.real(self.read_field(field, idx)).astype(np.float32, copy=False)  # (row, col)
+            else:
+                sample[field] = self.read_field(field, idx)
+
+        if not self.protocol.echo_axis:
+            for field in ['org', 'kdata']:
+                sample[field] = sample[field][..., np.newaxis]  # echo dimension of one echo
+        elif self.echos is not None:
+            for field in ['org', 'kdata', 'csm'] if self.protocol.csm_per_echo else ['org', 'kdata']:
+                sample[field] = sample[field][..., self.echos]
+        for field, compute in self.protocol.computed.items():
+            sample[field] = compute(self, sample)
+
+        if self.protocol.csm_per_echo:
+            csm = np.transpose(sample['csm'], (2, 3, 0, 1))  # (coil, echo, row, col)
+            csm[:, :self.necho, ...] *= np.exp(-1j * np.angle(csm[0:1, :self.necho, ...]))
+        else:
+            csm = np.transpose(sample['csm'], (2, 0, 1))[:, np.newaxis, ...]  # (coil, 1, row, col)
+        sample['csm'] = csm
+        sample['kdata'] = np.transpose(sample['kdata'], (2, 3, 0, 1))  # (coil, echo, row, col)
+        if 'csm_lowres' in fields:
+            sample['csm_lowres'] = np.transpose(sample['csm_lowres'], (2, 0, 1))[:, np.newaxis, ...]  # (coil, 1, row, col)
+
+        if self.ncoil_compress > 0:
+            if 'csm_lowres' in fields:
+                sample['kdata'], sample['csm'], sample['csm_lowres'] = coil_compress(
+                    sample['kdata'], sample['csm'], self.ncoil_compress, sample['csm_lowres'])  # (vcoil, ...)
+            else:
+                sample['kdata'], sample['csm'] = coil_compress(sample['kdata'], sample['csm'], self.ncoil_compress)
+        for field in fields:
+            if np.iscomplexobj(sample[field]):
+                sample[field] = sample[field].astype(np.complex64, copy=False)
+        return sample
+
+    def scale_factor(self):
+        '''
+            factor of kdata and org, scalar or array of the factors of the echos
+        '''
+        if self.protocol.scale is None:
+            return self.normalization
+        return self.protocol.scale if self.normalization else 1
+
+    def __getitem__(self, idx):
+
+        idx = int(idx / self.augSize)
+
+        if (self.batchIndex == self.batchSize):
+            self.batchIndex = 0
+            self.augIndex += 1
+            self.augIndex = self.augIndex % self.augSize
+            self.augmentation = self.augmentations[self.augIndex]
+        self.batchIndex += 1
+
+        sample = self.read_raw(idx)
+        if self.flag_raw:
+            # transposed views, copied once into the batch by the collate function
+            return tuple(sample[field] for field in self.protocol.fields)
+
+        for field in ['org', 'recon_input']:
+            if field in sample:
+                sample[field] = c2r(sample[field], self.echo_cat)  # echo_cat == 1: (2*echo, row, col) with first dimension real&imag concatenated for all echos
+                                                                  # echo_cat == 0: (2, row, col, echo)
+                if self.echo_cat == 0:
+                    sample[field] = np.transpose(sample[field], (0, 3, 1, 2))  # (2, echo, row, col)
+        for field in ['kdata', 'csm', 'csm_lowres']:
+            if field in sample:
+                sample[field] = c2r_kdata(sample[field])  # (coil, echo or 1, row, col, 2) with last dimension real&imag
+        for field in ['brain_mask', 'brain_mask_erode']:
+            if field in sample:
+                if self.echo_cat:
+                    sample[field] = np.repeat(sample[field][np.newaxis, ...], self.necho*2, axis=0) # (2*echo, row, col)
+                else:
+                    sample[field] = np.repeat(sample[field][np.newaxis, ...], 2, axis=0) # (2, row, col)
+                    sample[field] = np.repeat(sample[field][:, np.newaxis, ...], self.necho, axis=1)# (2, echo, row, col)
+
+        scale = self.scale_factor()
+        if np.ndim(scale) == 0:
+            sample['kdata'] = sample['kdata'] * scale
+            sample['org'] = sample['org'] * scale
+        else:
+            scale = np.asarray(scale, dtype=np.float32)
+            sample['kdata'] = sample['kdata'] * scale[:, np.newaxis, np.newaxis, np.newaxis]
+            if self.echo_cat:
+                sample['org'] = sample['org'] * np.repeat(scale, 2)[:, np.newaxis, np.newaxis]
+            else:
+                sample['org'] = sample['org'] * scale[:, np.newaxis, np.newaxis]
+
+        if not self.protocol.echo_axis:
+            for field in ['kdata', 'csm', 'csm_lowres']:
+                if field in sample:
+                    sample[field] = sample[field][:, 0, ...]  # (coil, row, col, 2)
+            if self.echo_cat == 0:
+                for field in ['org', 'brain_mask', 'brain_mask_erode']:
+                    if field in sample:
+                        sample[field] = sample[field][:, 0, ...]  # (2, row, col)
+        return tuple(sample[field] for field in self.protocol.fields)
+
+
+class Subject_batch_sampler(data.Sampler):
+    '''
+        batch sampler of a Kdata_dataset with batches of consecutive slices of one subject, so that
+        a batch is one slab read from the packed folders (dataset slab = batch_size) and a volume
+        is reconstructed batch by batch; batches in subject and slice order, or shuffled
+    '''
+
+    def __init__(self, dataset, batch_size, shuffle=False, drop_last=False):
+
+        self.shuffle = shuffle
+        self.batches = []
+        for subject in range(len(dataset.subjects)):
+            end = (subject + 1) * dataset.nslice
+            for start in range(subject * dataset.nslice, end, batch_size):
+                batch = list(range(start, min(start + batch_size, end)))
+                if drop_last and len(batch) < batch_size:
+                    continue
+                for aug in range(dataset.augSize):
+                    self.batches.append([idx * dataset.augSize + aug for idx in batch])
+
+    def __len__(self):
+
+        return len(self.batches)
+
+    def __iter__(self):
+
+        if self.shuffle:
+            order = torch.randperm(len(self.batches)).tolist()
+        else:
+            order = range(len(self.batches))
+        for i in order:
+            yield self.batches[i]
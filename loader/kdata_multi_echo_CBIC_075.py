@@ -1,14 +1,11 @@
 import os
 import numpy as np
-from torch.utils import data
-from utils.data import *
-from utils.loss import *
-from utils.operators import *
+from loader.kdata_dataset import Kdata_dataset
 
 
-class kdata_multi_echo_CBIC_075(data.Dataset):
+class kdata_multi_echo_CBIC_075(Kdata_dataset):
     '''
-        Dataloader of multi-echo GRE data from GE scanner (CBIC scanner)
+        Dataloader of multi-echo GRE data from GE scanner (CBIC scanner), protocol 'multi_echo_CBIC_075'
     '''
 
     def __init__(self,
@@ -27,129 +24,19 @@ class kdata_multi_echo_CBIC_075(data.Dataset):
         augmentations = [None]
     ):
 
-        self.rootDir = rootDir
+        super(kdata_multi_echo_CBIC_075, self).__init__(
+            protocol='multi_echo_CBIC_075',
+            rootDir=rootDir,
+            split=split,
+            subject=subject,
+            necho=necho,
+            normalization=normalization,
+            echo_cat=echo_cat,
+            batchSize=batchSize,
+            augmentations=augmentations,
+            nslice=nslice,
+            num_subs=num_subs if split == 'train' else None
+        )
         self.contrast = contrast
-        self.necho = necho
-        self.normalization = normalization
-        self.echo_cat = echo_cat
-        self.split = split
         self.nrow = nrow
         self.ncol = ncol
-        self.nslice = nslice
-        if contrast == 'MultiEcho':
-            if split == 'train':
-                self.nsamples = self.nslice * num_subs
-            elif split == 'val':
-                self.nsamples = self.nslice
-            elif split == 'test':
-                self.nsamples = self.nslice
-                if subject == 0:
-                    self.subject = 'thanh'
-                elif subject == 1:
-                    self.subject = 'liangdong'
-                elif subject == 5:
-                    self.subject = 'jiahao'
-                print("Test on {}".format(self.subject))
-        self.augmentations = augmentations
-        self.augmentation = self.augmentations[0]
-        self.augSize = len(self.augmentations)
-        self.augIndex = 0
-        self.batchSize = batchSize
-        self.batchIndex = 0
-
-    def __len__(self):
-
-        return self.nsamples * self.augSize
-
-
-    def __getitem__(self, idx):
-        if self.split == 'train':
-            subject = 0
-            while (True):
-                if (idx - self.nslice < 0):
-                    break
-                else:
-                    idx -= self.nslice
-                    subject += 1
-            if subject == 0:
-                # dataFD_sense_echo = self.rootDir + '/data_cfl/junghun/full_cc_slices_sense_echo_pad/'
-                dataFD_sense_echo = self.rootDir + '/data_cfl/junghun/full_cc_slices_sense_echo/'
-            elif subject == 1:
-                # dataFD_sense_echo = self.rootDir + '/data_cfl/chao/full_cc_slices_sense_echo_pad/'
-                dataFD_sense_echo = self.rootDir + '/data_cfl/chao/full_cc_slices_sense_echo/'
-            elif subject == 2:
-                # dataFD_sense_echo = self.rootDir + '/data_cfl/alexey/full_cc_slices_sense_echo_pad/'
-                dataFD_sense_echo = self.rootDir + '/data_cfl/alexey/full_cc_slices_sense_echo/'
-            elif subject == 3:
-                # dataFD_sense_echo = self.rootDir + '/data_cfl/qihao/full_cc_slices_sense_echo_pad/'
-                dataFD_sense_echo = self.rootDir + '/data_cfl/qihao/full_cc_slices_sense_echo/'
-            elif subject == 4:
-                # dataFD_sense_echo = self.rootDir + '/data_cfl/liangdong/full_cc_slices_sense_echo_pad/'
-                dataFD_sense_echo = self.rootDir + '/data_cfl/liangdong/full_cc_slices_sense_echo/'
-            elif subject == 5:
-                # dataFD_sense_echo = self.rootDir + '/data_cfl/dom/full_cc_slices_sense_echo_pad/'
-                dataFD_sense_echo = self.rootDir + '/data_cfl/dom/full_cc_slices_sense_echo/'
-            elif subject == 6:
-                # dataFD_sense_echo = self.rootDir + '/data_cfl/kelly/full_cc_slices_sense_echo_pad/'
-                dataFD_sense_echo = self.rootDir + '/data_cfl/kelly/full_cc_slices_sense_echo/'
-            elif subject == 7:
-                # dataFD_sense_echo = self.rootDir + '/data_cfl/hangwei/full_cc_slices_sense_echo_pad/'
-                dataFD_sense_echo = self.rootDir + '/data_cfl/hangwei/full_cc_slices_sense_echo/'
-
-        elif self.split == 'val':
-            # dataFD_sense_echo = self.rootDir + '/data_cfl/thanh/full_cc_slices_sense_echo_pad/'
-            dataFD_sense_echo = self.rootDir + '/data_cfl/jiahao/full_cc_slices_sense_echo/'
-        
-        elif self.split == 'test':
-            # dataFD_sense_echo = self.rootDir + '/data_cfl/' + self.subject + '/full_cc_slices_sense_echo_pad/'
-            dataFD_sense_echo = self.rootDir + '/data_cfl/' + self.subject + '/full_cc_slices_sense_echo/'
-            # dataFD_sense_echo = self.rootDir + '/data_cfl/' + self.subject + '/full_cc_slices_sense_echo_ellipt/'
-            # dataFD_sense_echo = self.rootDir + '/data_cfl/' + self.subject + '/full_cc_slices_sense_echo_ellipt_fa=25/'
-
-        if (self.batchIndex == self.batchSize):
-            self.batchIndex = 0
-            self.augIndex += 1
-            self.augIndex = self.augIndex % self.augSize
-            self.augmentation = self.augmentations[self.augIndex]
-        self.batchIndex += 1
-
-        org = readcfl(dataFD_sense_echo + 'fully_slice_{}'.format(idx))  # (row, col, echo)
-        org =  c2r(org, self.echo_cat)  # echo_cat == 1: (2*echo, row, col) with first dimension real&imag concatenated for all echos 
-                                        # echo_cat == 0: (2, row, col, echo)
-
-        if self.echo_cat == 0:
-            org = np.transpose(org, (0, 3, 1, 2)) # (2, echo, row, col)
-
-        # Option 2: csms estimated from each echo
-        csm = readcfl(dataFD_sense_echo + 'sensMaps_slice_{}'.format(idx))
-        csm = np.transpose(csm, (2, 3, 0, 1))  # (coil, echo, row, col)
-        for i in range(self.necho):
-            csm[:, i, :, :] = csm[:, i, :, :] * np.exp(-1j * np.angle(csm[0:1, i, :, :]))
-    
-        csm = c2r_kdata(csm) # (coil, echo, row, col, 2) with last dimension real&imag
-
-        # Fully sampled kspace data
-        kdata = readcfl(dataFD_sense_echo + 'kdata_slice_{}'.format(idx))
-        kdata = np.transpose(kdata, (2, 3, 0, 1))  # (coil, echo, row, col)
-        kdata = c2r_kdata(kdata) # (coil, echo, row, col, 2) with last dimension real&imag
-
-        # brain tissue mask
-        brain_mask = np.real(readcfl(dataFD_sense_echo + 'mask_slice_{}'.format(idx)))  # (row, col)
-        if self.echo_cat:
-            brain_mask = np.repeat(brain_mask[np.newaxis, ...], self.necho*2, axis=0) # (2*echo, row, col)
-        else:
-            brain_mask = np.repeat(brain_mask[np.newaxis, ...], 2, axis=0) # (2, row, col)
-            brain_mask = np.repeat(brain_mask[:, np.newaxis, ...], self.necho, axis=1)# (2, echo, row, col)
-        
-        return kdata*self.normalization, org*self.normalization, csm, brain_mask
-
-
-
-
-
-        
-
-        
-
-
-    
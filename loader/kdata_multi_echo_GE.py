@@ -1,27 +1,29 @@
 import os
+import hashlib
 import numpy as np
-from torch.utils import data
 from utils.data import *
-from utils.loss import *
-from utils.operators import *
+from loader.kdata_dataset import Kdata_dataset
 
 
-class kdata_multi_echo_GE(data.Dataset):
+targets_gen = {}  # generated targets opened by gen_target, keyed by the checksum of their inputs
+
+
+def checksum(filenames):
     '''
-        Dataloader of multi-echo GRE data from DHK GE scanner (12-coil scanner)
+        md5 of the paths, sizes and modification times of filenames, the files themselves are not read
+        (a rewritten input changes its mtime, so the cache of the previous contents is not reused)
     '''
+    md5 = hashlib.md5()
+    for filename in filenames:
+        stat = os.stat(filename)
+        md5.update('{}:{}:{}'.format(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns).encode())
+    return md5.hexdigest()
 
-    folderMatcher = {
-        'MultiEcho': '/megre_slice_GE/'
-    }
 
-    dataRange = {
-        'train': ['200', '800'], 
-        'val': ['0', '200'],
-        # 'test': ['800', '1000']
-        'test': ['200', '400']
-    }
-    
+class kdata_multi_echo_GE(Kdata_dataset):
+    '''
+        Dataloader of multi-echo GRE data from DHK GE scanner (12-coil scanner), protocol 'multi_echo_GE'
+    '''
 
     def __init__(self,
         rootDir = '/data/Jinwei/Multi_echo_slice_recon_GE',
@@ -31,126 +33,71 @@ class kdata_multi_echo_GE(data.Dataset):
         normalization = 0,  # flag to normalize the data
         echo_cat = 1, # flag to concatenate echo dimension into channel
         batchSize = 1,
-        augmentations = [None]
+        augmentations = [None],
+        ncoil_compress = 0,  # number of virtual coils after SVD coil compression (0: no compression)
+        flag_packed = 0,  # flag to read the slices from the packed folders (convert_packed.py)
+        flag_raw = 0,  # flag to return the complex64 slices, converted in batch on the device by Batch_preprocess
+        slab = 1  # number of consecutive slices read per I/O call from the packed folders (with Subject_batch_sampler)
     ):
 
-        self.rootDir = rootDir
-        self.dataFD = rootDir + self.folderMatcher[contrast]
+        super(kdata_multi_echo_GE, self).__init__(
+            protocol='multi_echo_GE',
+            rootDir=rootDir,
+            split=split,
+            necho=necho,
+            normalization=normalization,
+            echo_cat=echo_cat,
+            batchSize=batchSize,
+            augmentations=augmentations,
+            ncoil_compress=ncoil_compress,
+            flag_packed=flag_packed,
+            flag_raw=flag_raw,
+            slab=slab
+        )
         self.contrast = contrast
-        self.necho = necho
-        self.normalization = normalization
-        self.echo_cat = echo_cat
-        if contrast == 'MultiEcho':
-            self.startIdx = int(self.dataRange[split][0])
-            self.endIdx = int(self.dataRange[split][1])
-        self.nsamples = self.endIdx - self.startIdx
-        self.augmentations = augmentations
-        self.augmentation = self.augmentations[0]
-        self.augSize = len(self.augmentations)
-        self.augIndex = 0
-        self.batchSize = batchSize
-        self.batchIndex = 0
 
         # self.gen_target()
 
 
-    def gen_target(self):
+    def gen_target(self, rootDir='/data/Jinwei/Multi_echo_kspace/data_parameters', cacheDir=None):
         '''
-            generate target from calculated m0, R2s, f0 and p
+            generate target from calculated m0, R2s, f0 and p (200 slices per subject), computed once in complex64
+            and cached in cacheDir (rootDir by default) as orgs_gen_<checksum of the inputs>.npy, memory mapped
+            read-only so that the slices are read lazily and shared by all datasets and processes
         '''
-        rootDir = '/data/Jinwei/Multi_echo_kspace/data_parameters'
         subject_IDs = ['sub1', 'sub2', 'sub3', 'sub4', 'sub5']
-        TEs = [0.003224, 0.007108, 0.010992, 0.014876, 0.018760, 0.022644, 0.026528, 0.030412, 0.034296, 0.038180]
-        self.orgs_gen = np.zeros([1000, 206, 80, self.necho]) + 1j * np.zeros([1000, 206, 80, self.necho])
-
-        for idx, subject_ID in enumerate(subject_IDs):
-            print('Processing {}'.format(subject_ID))
-            dataFD = rootDir + '/' + subject_ID
-            if subject_ID == 'sub1':
-                # for the fully-sampled parameters
-                m0 = load_mat(dataFD+'/m0.mat', 'm0')[np.newaxis, 15:215, ...]
-                r2s = load_mat(dataFD+'/R2s.mat', 'R2s')[np.newaxis, 15:215, ...]
-                f0 = load_mat(dataFD+'/f0.mat', 'f0')[np.newaxis, 15:215, ...]
-                p = load_mat(dataFD+'/p.mat', 'p')[np.newaxis, 15:215, ...]
-                # for the fully-sampled parameters
-                for i, te in enumerate(TEs):
-                    self.orgs_gen[idx*200:(idx+1)*200, :, :, i] = - m0 * np.exp(- r2s * te) * np.exp(1j * (f0 + p * te))
-
-                # m0 = load_mat(dataFD+'/0.2/m0_10.mat', 'm0')
-                # r2s = load_mat(dataFD+'/0.2/R2s_10.mat', 'R2s')
-                # f0 = load_mat(dataFD+'/0.2/f0_10.mat', 'f0')
-                # p = load_mat(dataFD+'/0.2/p_10.mat', 'p')
-
-                # for i, te in enumerate(TEs):
-                #     self.orgs_gen[idx*200:(idx+1)*200, :, :, i] = m0 * np.exp(- r2s * te) * np.exp(1j * (f0 + p * te))
-
-            else:
-                # for the fully-sampled parameters
-                m0 = load_mat(dataFD+'/m0.mat', 'm0')[np.newaxis, 30:230, ...]
-                r2s = load_mat(dataFD+'/R2s.mat', 'R2s')[np.newaxis, 30:230, ...]
-                f0 = load_mat(dataFD+'/f0.mat', 'f0')[np.newaxis, 30:230, ...]
-                p = load_mat(dataFD+'/p.mat', 'p')[np.newaxis, 30:230, ...]
-
-                # m0 = load_mat(dataFD+'/0.2/m0_10.mat', 'm0')
-                # r2s = load_mat(dataFD+'/0.2/R2s_10.mat', 'R2s')
-                # f0 = load_mat(dataFD+'/0.2/f0_10.mat', 'f0')
-                # p = load_mat(dataFD+'/0.2/p_10.mat', 'p')
-                
-                for i, te in enumerate(TEs):
-                    self.orgs_gen[idx*200:(idx+1)*200, :, :, i] = m0 * np.exp(- r2s * te) * np.exp(1j * (f0 + p * te))
-
-        self.orgs_gen[0::2, ...] = - self.orgs_gen[0::2, ...]
-
-
-    def __len__(self):
-
-        return self.nsamples * self.augSize
-
-
-    def __getitem__(self, idx):
-
-        idx = int(idx / self.augSize) + self.startIdx
-
-        if (self.batchIndex == self.batchSize):
-            self.batchIndex = 0
-            self.augIndex += 1
-            self.augIndex = self.augIndex % self.augSize
-            self.augmentation = self.augmentations[self.augIndex]
-        self.batchIndex += 1
-
-        org = readcfl(self.dataFD + 'fully_slice_{}'.format(idx))  # (row, col, echo)
-        org =  c2r(org, self.echo_cat)  # echo_cat == 1: (2*echo, row, col) with first dimension real&imag concatenated for all echos 
-                                        # echo_cat == 0: (2, row, col, echo)
-        # org_gen = self.orgs_gen[idx, ...]
-        # org_gen = c2r(org_gen, self.echo_cat)
-        org_gen = org
-
-        if self.echo_cat == 0:
-            org = np.transpose(org, (0, 3, 1, 2)) # (2, echo, row, col)
-            org_gen = np.transpose(org_gen, (0, 3, 1, 2))
-            
-        csm = readcfl(self.dataFD + 'sensMaps_slice_{}'.format(idx))
-        csm = np.transpose(csm, (2, 0, 1))[:, np.newaxis, ...]  # (coil, 1, row, col)
-        csm = np.repeat(csm, self.necho, axis=1)  # (coil, echo, row, col)
-        csm = c2r_kdata(csm) # (coil, echo, row, col, 2) with last dimension real&imag
-
-        kdata = readcfl(self.dataFD + 'kdata_slice_{}'.format(idx))
-        kdata = np.transpose(kdata, (2, 3, 0, 1))  # (coil, echo, row, col)
-        kdata = c2r_kdata(kdata) # (coil, echo, row, col, 2) with last dimension real&imag
-
-        brain_mask = np.real(readcfl(self.dataFD + 'mask_slice_{}'.format(idx)))  # (row, col)
-        if self.echo_cat:
-            brain_mask = np.repeat(brain_mask[np.newaxis, ...], self.necho*2, axis=0) # (2*echo, row, col)
-        else:
-            brain_mask = np.repeat(brain_mask[np.newaxis, ...], 2, axis=0) # (2, row, col)
-            brain_mask = np.repeat(brain_mask[:, np.newaxis, ...], self.necho, axis=1)# (2, echo, row, col)
-
-        return kdata*self.normalization, org*self.normalization, csm, brain_mask
-
-
-        
-
-        
-
-
-    
+        TEs = np.array([0.003224, 0.007108, 0.010992, 0.014876, 0.018760, 0.022644, 0.026528, 0.030412, 0.034296, 0.038180],
+                       dtype=np.float32)[:self.necho]
+        names = ['m0', 'R2s', 'f0', 'p']
+        filenames = [rootDir + '/' + subject_ID + '/' + name + '.mat' for subject_ID in subject_IDs for name in names]
+        key = checksum(filenames) + '_necho={}'.format(self.necho)
+        if key in targets_gen:
+            self.orgs_gen = targets_gen[key]
+            return
+        cacheDir = rootDir if cacheDir is None else cacheDir
+        cacheName = cacheDir + '/orgs_gen_{}.npy'.format(key)
+
+        if not os.path.exists(cacheName):
+            orgs_gen = None
+            for idx, subject_ID in enumerate(subject_IDs):
+                print('Processing {}'.format(subject_ID))
+                dataFD = rootDir + '/' + subject_ID
+                # slices 15:215 of sub1 and 30:230 of the others, for the fully-sampled parameters
+                slices = slice(15, 215) if subject_ID == 'sub1' else slice(30, 230)
+                m0, r2s, f0, p = [load_mat(dataFD + '/' + name + '.mat', name)[slices, ..., np.newaxis].astype(np.float32)
+                                  for name in names]
+                if orgs_gen is None:
+                    tmpName = cacheName + '.{}.tmp'.format(os.getpid())
+                    orgs_gen = np.lib.format.open_memmap(tmpName, mode='w+', dtype=np.complex64,
+                                                         shape=(200*len(subject_IDs),) + m0.shape[1:3] + (self.necho,))
+                org_gen = m0 * np.exp(- r2s * TEs) * np.exp(1j * (f0 + p * TEs))  # (slice, row, col, echo)
+                if subject_ID == 'sub1':
+                    org_gen = - org_gen
+                org_gen[0::2, ...] = - org_gen[0::2, ...]  # even slices of the subjects (200 slices each)
+                orgs_gen[idx*200:(idx+1)*200, ...] = org_gen
+            orgs_gen.flush()
+            del orgs_gen
+            os.replace(tmpName, cacheName)  # atomic, concurrent datasets never read a partial cache
+
+        self.orgs_gen = np.load(cacheName, mmap_mode='r')  # (1000, row, col, echo)
+        targets_gen[key] = self.orgs_gen
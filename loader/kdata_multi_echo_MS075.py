@@ -24,7 +24,8 @@ class kdata_multi_echo_MS075(data.Dataset):
         normalization = 0,  # flag to normalize the data
         echo_cat = 1, # flag to concatenate echo dimension into channel
         batchSize = 1,
-        augmentations = [None]
+        augmentations = [None],
+        flag_simu = 0  # flag to return the sample index in place of kdata, simulated in batch on the device by Kspace_simu
     ):
 
         self.rootDir = rootDir
@@ -32,6 +33,7 @@ class kdata_multi_echo_MS075(data.Dataset):
         self.necho = necho
         self.normalization = normalization
         self.echo_cat = echo_cat
+        self.flag_simu = flag_simu
         self.split = split
         self.nrow = nrow
         self.ncol = ncol
@@ -106,7 +108,10 @@ class kdata_multi_echo_MS075(data.Dataset):
         self.batchIndex += 1
 
         org = self.iField[idx, ...]  # (row, col, echo)
-        kdata = self.generateKdata(org[np.newaxis, ...]) # (coil, echo, row, col, 2) with last dimension real&imag
+        if self.flag_simu:
+            kdata = idx  # seed of the noise of Kspace_simu
+        else:
+            kdata = self.generateKdata(org[np.newaxis, ...]) # (coil, echo, row, col, 2) with last dimension real&imag
         org = c2r(org, self.echo_cat)  # echo_cat == 1: (2*echo, row, col) with first dimension real&imag concatenated for all echos 
                                         # echo_cat == 0: (2, row, col, echo)
         recon_input = org
@@ -115,13 +120,11 @@ class kdata_multi_echo_MS075(data.Dataset):
             recon_input = np.transpose(recon_input, (0, 3, 1, 2))
         # Coil sensitivity maps
         csm = np.ones((1, 1, self.nrow, self.ncol))  # (coil, 1, row, col)
-        csm = np.repeat(csm, self.necho, axis=1)  # (coil, echo, row, col)
-        csm = c2r_kdata(csm) # (coil, echo, row, col, 2) with last dimension real&imag
+        csm = c2r_kdata(csm) # (coil, 1, row, col, 2) shared by all echos with last dimension real&imag
 
         # Coil sensitivity maps from central kspace data
         csm_lowres = np.ones((1, 1, 25, 25))  # (coil, 1, row, col)
-        csm_lowres = np.repeat(csm_lowres, self.necho, axis=1)  # (coil, echo, row, col)
-        csm_lowres = c2r_kdata(csm_lowres) # (coil, echo, row, col, 2) with last dimension real&imag
+        csm_lowres = c2r_kdata(csm_lowres) # (coil, 1, row, col, 2) shared by all echos with last dimension real&imag
 
         # brain tissue mask
         brain_mask = np.transpose(self.Mask[idx, ...], (2, 0, 1))  # (echo, row, col)
@@ -30,48 +30,40 @@ class MultiEchoSimu(data.Dataset):
         self.num_echos = num_echos
 
     def load_subjects(self):
-        M_0, R_2, phi_0, phi_1, iField, phase, mask = [], [], [], [], [], [], []
-        M_0_under, R_2_under, phi_0_under, phi_1_under = [], [], [], []
+        '''
+            variables of the subjects kept as Lazy_mat (v7.3 files) and read slice by slice in __getitem__,
+            the masks and the under-sampled parameters only read in full, one subject at a time, for the
+            means and stds of the training set
+        '''
+        self.M_0, self.R_2, self.phi_0, self.phi_1, self.iField, self.mask = [], [], [], [], [], []
+        self.M_0_under, self.R_2_under, self.phi_0_under, self.phi_1_under = [], [], [], []
         self.num_subjects = len(self.subject_IDs)
         self.num_slices = np.zeros(self.num_subjects)
         for idx, subject_ID in enumerate(self.subject_IDs):
             print('Loading case: {0}'.format(idx))
             dataFD = self.rootDir + '/' + subject_ID
-            M_0.append(np.real(load_mat(dataFD+'/m0.mat', 'm0'))[np.newaxis, ..., 0:68])
-            M_0_under.append(np.real(load_mat(dataFD+'/m0_{0}.mat'.format(self.num_echos), 'm0'))[np.newaxis, ..., 0:68])
+            self.M_0.append(load_mat(dataFD+'/m0.mat', 'm0', lazy=1))
+            self.M_0_under.append(load_mat(dataFD+'/m0_{0}.mat'.format(self.num_echos), 'm0', lazy=1))
             # r_2 = load_mat(dataFD+'/R2s.mat', 'R2s')[np.newaxis, ...]
             # r_2[r_2 > 1e+1] = 0
             # r_2[r_2 < -1e+1] = 0
             # R_2.append(r_2)
-            R_2.append(load_mat(dataFD+'/R2s.mat', 'R2s')[np.newaxis, ..., 0:68])
-            R_2_under.append(load_mat(dataFD+'/R2s_{0}.mat'.format(self.num_echos), 'R2s')[np.newaxis, ..., 0:68])
-            phi_0.append(load_mat(dataFD+'/f0.mat', 'f0')[np.newaxis, ..., 0:68])
-            phi_0_under.append(load_mat(dataFD+'/f0_{0}.mat'.format(self.num_echos), 'f0')[np.newaxis, ..., 0:68])
-            phi_1.append(load_mat(dataFD+'/p.mat', 'p')[np.newaxis, ..., 0:68])
-            phi_1_under.append(load_mat(dataFD+'/p_{0}.mat'.format(self.num_echos), 'p')[np.newaxis, ..., 0:68])
+            self.R_2.append(load_mat(dataFD+'/R2s.mat', 'R2s', lazy=1))
+            self.R_2_under.append(load_mat(dataFD+'/R2s_{0}.mat'.format(self.num_echos), 'R2s', lazy=1))
+            self.phi_0.append(load_mat(dataFD+'/f0.mat', 'f0', lazy=1))
+            self.phi_0_under.append(load_mat(dataFD+'/f0_{0}.mat'.format(self.num_echos), 'f0', lazy=1))
+            self.phi_1.append(load_mat(dataFD+'/p.mat', 'p', lazy=1))
+            self.phi_1_under.append(load_mat(dataFD+'/p_{0}.mat'.format(self.num_echos), 'p', lazy=1))
             # phi_1.append(load_mat(dataFD+'/p1_unwrap.mat', 'p1')[np.newaxis, ...])
-            iField.append(load_mat(dataFD+'/iField.mat', 'iField')[np.newaxis, :, :, 0:68, :])
+            self.iField.append(load_mat(dataFD+'/iField.mat', 'iField', lazy=1))
             # phase.append(load_mat(dataFD+'/phase_unwrapped.mat', 'phase_unwrapped')[np.newaxis, ...])
             # # crop the brain mask
             # Mask = load_mat(dataFD+'/Mask.mat', 'Mask')[..., 0:68]
             # Mask = SMV(Mask, [512, 512, 68], [0.4688, 0.4688, 2], 2) > 0.999
             # mask.append(Mask[np.newaxis, ...])
-            mask.append(load_mat(dataFD+'/Mask.mat', 'Mask')[np.newaxis, ..., 0:68])
+            self.mask.append(load_mat(dataFD+'/Mask.mat', 'Mask', lazy=1))
             self.num_slices[idx] = 68
 
-        self.M_0 = np.concatenate(M_0, axis=0)
-        self.M_0_under = np.concatenate(M_0_under, axis=0)
-        self.R_2 = np.concatenate(R_2, axis=0)
-        self.R_2_under = np.concatenate(R_2_under, axis=0)
-        self.phi_0 = np.concatenate(phi_0, axis=0)
-        self.phi_0_under = np.concatenate(phi_0_under, axis=0)
-        self.phi_1 = np.concatenate(phi_1, axis=0)
-        self.phi_1_under = np.concatenate(phi_1_under, axis=0)
-        self.iField = np.concatenate(iField, axis=0)
-        # self.phase = np.concatenate(phase, axis=0)
-        # # conj of iField because in fit_ppm_complex code there was M = conj(M)
-        # self.iField, self.phase = np.conjugate(self.iField), -self.phase
-        self.mask = np.concatenate(mask, axis=0)
         self.num_samples = np.sum(self.num_slices)
         # sampling pattern
         self.sampling_mask = load_mat(self.rootDir+'/sampling_pattern_30.mat', 'mask')
@@ -80,17 +72,22 @@ class MultiEchoSimu(data.Dataset):
         self.sampling_mask = np.tile(self.sampling_mask, [1, 1, 1, self.num_echos])
         
         if self.flag_train:
-            # compute mean
-            self.mean_M_0_under = np.mean(self.M_0_under[self.mask==1])
-            self.mean_R_2_under = np.mean(self.R_2_under[self.mask==1])
-            self.mean_phi_0_under = np.mean(self.phi_0_under[self.mask==1])
-            self.mean_phi_1_under = np.mean(self.phi_1_under[self.mask==1])
-
-            # compute std
-            self.std_M_0_under = np.std(self.M_0_under[self.mask==1])
-            self.std_R_2_under = np.std(self.R_2_under[self.mask==1])
-            self.std_phi_0_under = np.std(self.phi_0_under[self.mask==1])
-            self.std_phi_1_under = np.std(self.phi_1_under[self.mask==1])
+            # means and stds in the brain masks of all subjects, pooled subject by subject
+            parameters_under = [self.M_0_under, self.R_2_under, self.phi_0_under, self.phi_1_under]
+            means, variances, count = np.zeros(4), np.zeros(4), 0
+            for idx in range(self.num_subjects):
+                mask = np.asarray(self.mask[idx][..., 0:68]) == 1
+                n = np.sum(mask)
+                if n == 0:
+                    continue  # no brain voxel in slices 0:68
+                for i, parameter_under in enumerate(parameters_under):
+                    values = np.real(parameter_under[idx][..., 0:68][mask])
+                    delta = np.mean(values) - means[i]
+                    variances[i] = (count*variances[i] + n*np.var(values)) / (count+n) + delta**2 * count*n / (count+n)**2
+                    means[i] += delta * n / (count+n)
+                count += n
+            self.mean_M_0_under, self.mean_R_2_under, self.mean_phi_0_under, self.mean_phi_1_under = means
+            self.std_M_0_under, self.std_R_2_under, self.std_phi_0_under, self.std_phi_1_under = np.sqrt(variances)
 
             self.parameters_means = [self.mean_M_0_under, self.mean_R_2_under, 
                                      self.mean_phi_0_under, self.mean_phi_1_under]
@@ -110,22 +107,22 @@ class MultiEchoSimu(data.Dataset):
             else:
                 idx_slice -= int(self.num_slices[idx_subject])
                 idx_subject += 1
-        M_0_slice = self.M_0[idx_subject, :, :, idx_slice][np.newaxis, ...]
-        M_0_under_slice = self.M_0_under[idx_subject, :, :, idx_slice][np.newaxis, ...]
+        M_0_slice = np.real(self.M_0[idx_subject][:, :, idx_slice])[np.newaxis, ...]
+        M_0_under_slice = np.real(self.M_0_under[idx_subject][:, :, idx_slice])[np.newaxis, ...]
 
-        R_2_slice = self.R_2[idx_subject, :, :, idx_slice][np.newaxis, ...]
-        R_2_under_slice = self.R_2_under[idx_subject, :, :, idx_slice][np.newaxis, ...]
+        R_2_slice = self.R_2[idx_subject][:, :, idx_slice][np.newaxis, ...]
+        R_2_under_slice = self.R_2_under[idx_subject][:, :, idx_slice][np.newaxis, ...]
 
-        phi_0_slice = self.phi_0[idx_subject, :, :, idx_slice][np.newaxis, ...]
-        phi_0_under_slice = self.phi_0_under[idx_subject, :, :, idx_slice][np.newaxis, ...]
+        phi_0_slice = self.phi_0[idx_subject][:, :, idx_slice][np.newaxis, ...]
+        phi_0_under_slice = self.phi_0_under[idx_subject][:, :, idx_slice][np.newaxis, ...]
 
-        phi_1_slice = self.phi_1[idx_subject, :, :, idx_slice][np.newaxis, ...]
-        phi_1_under_slice = self.phi_1_under[idx_subject, :, :, idx_slice][np.newaxis, ...]
+        phi_1_slice = self.phi_1[idx_subject][:, :, idx_slice][np.newaxis, ...]
+        phi_1_under_slice = self.phi_1_under[idx_subject][:, :, idx_slice][np.newaxis, ...]
 
-        mask_slice = self.mask[idx_subject, :, :, idx_slice][np.newaxis, ...]
+        mask_slice = self.mask[idx_subject][:, :, idx_slice][np.newaxis, ...]
 
         # assuming 1 coil and num_echos
-        iField_slice = self.iField[idx_subject, :, :, idx_slice, np.newaxis, 0:self.num_echos]
+        iField_slice = self.iField[idx_subject][:, :, idx_slice, 0:self.num_echos][:, :, np.newaxis, :]
         targets = np.concatenate((M_0_slice, R_2_slice, phi_0_slice, phi_1_slice), axis=0)
         mask_slice = np.tile(mask_slice, [4, 1, 1])  # brain mask
         if self.flag_input == 1:
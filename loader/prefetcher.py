@@ -0,0 +1,63 @@
+import torch
+
+
+def to_device(batch, device, non_blocking=False):
+    '''
+        tensors of a (nested) tuple/list batch copied to device, other elements as they are
+    '''
+    if torch.is_tensor(batch):
+        if non_blocking and not batch.is_pinned():
+            batch = batch.pin_memory()
+        return batch.to(device, non_blocking=non_blocking)
+    elif isinstance(batch, (tuple, list)):
+        return [to_device(b, device, non_blocking) for b in batch]
+    return batch
+
+
+class Prefetcher():
+    '''
+        iterator over the batches of a DataLoader already on device (e.g. the kdatas, targets, recon_input,
+        csms, csm_lowres, brain_masks, brain_masks_erode of kdata_multi_echo_CBIC), double buffered:
+        the host to device copies of batch i+1 are issued from pinned memory on a side cuda stream
+        while batch i is processed; on cpu the batches are returned as they are
+    '''
+
+    def __init__(self, loader, device):
+
+        self.loader = loader
+        self.device = torch.device(device)
+        if self.device.type == 'cuda':
+            self.stream = torch.cuda.Stream(device=self.device)
+        else:
+            self.stream = None
+
+    def __len__(self):
+
+        return len(self.loader)
+
+    def preload(self, iterator):
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None
+        if self.stream is None:
+            return to_device(batch, self.device)
+        with torch.cuda.stream(self.stream):
+            return to_device(batch, self.device, non_blocking=True)
+
+    def __iter__(self):
+
+        iterator = iter(self.loader)
+        batch = self.preload(iterator)
+        while batch is not None:
+            if self.stream is not None:
+                # wait for the copies of this batch, whose memory (allocated on the side stream)
+                # must not be reused before the compute stream is done with it
+                stream = torch.cuda.current_stream(self.device)
+                stream.wait_stream(self.stream)
+                for tensor in batch:
+                    if torch.is_tensor(tensor):
+                        tensor.record_stream(stream)
+            next_batch = self.preload(iterator)
+            yield batch
+            batch = next_batch
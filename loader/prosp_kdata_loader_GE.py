@@ -1,12 +1,12 @@
 import os
 import numpy as np
-from torch.utils import data
-from utils.data import *
-from utils.loss import *
+from loader.kdata_dataset import Kdata_dataset
 
 
-class prosp_kdata_loader_GE(data.Dataset):
-
+class prosp_kdata_loader_GE(Kdata_dataset):
+    '''
+        Dataloader of single-echo T1 data from DHK GE scanner with prospective under-sampling, protocol 'GE_prosp'
+    '''
 
     def __init__(self,
         rootDir = '/data/Jinwei/T1_slice_recon_GE/prospective_data',
@@ -16,55 +16,12 @@ class prosp_kdata_loader_GE(data.Dataset):
         augmentations = [None]
     ):
 
-        self.dataFD = rootDir + '/' + subject + '_' + mask + '/'
-        self.startIdx = 0
-        self.endIdx = 206
-        self.nsamples = self.endIdx - self.startIdx
-
-        self.augmentations = augmentations
-        self.augmentation = self.augmentations[0]
-        self.augSize = len(self.augmentations)
-        self.augIndex = 0
-        self.batchSize = batchSize
-        self.batchIndex = 0
-
-
-    def __len__(self):
-
-        return self.nsamples * self.augSize
-
-
-    def __getitem__(self, idx):
-
-        idx = int(idx / self.augSize) + self.startIdx
-
-        if (self.batchIndex == self.batchSize):
-
-            self.batchIndex = 0
-            self.augIndex += 1
-            self.augIndex = self.augIndex % self.augSize
-            self.augmentation = self.augmentations[self.augIndex]
-
-        self.batchIndex += 1
-        org = load_mat(self.dataFD + 'fully_slice_%d.mat' %(idx), 'fully_slice')
-        org =  c2r(org)
-        csm = load_mat(self.dataFD + 'sensMaps_slice_%d.mat' %(idx), 'sensMaps_slice')
-        csm = np.transpose(csm, (2, 0, 1))
-        csm = c2r_kdata(csm)
-        kdata = load_mat(self.dataFD + 'kdata_slice_%d.mat' %(idx), 'kdata_slice')
-        kdata = np.transpose(kdata, (2, 0, 1))
-        kdata = c2r_kdata(kdata)
-
-        brain_mask = np.ones(org.shape, dtype=np.float32)
-        
-        return kdata, org, csm, brain_mask
-
-
-
-
-        
-
-        
-
-
-    
+        super(prosp_kdata_loader_GE, self).__init__(
+            protocol='GE_prosp',
+            rootDir=rootDir,
+            split='test',
+            necho=1,
+            batchSize=batchSize,
+            augmentations=augmentations,
+            params={'subject': subject, 'mask': mask}
+        )
@@ -0,0 +1,361 @@
+"""
+    Site / scanner / acquisition protocol descriptors of the slice folders (multi-echo GRE, T1w/T2w+mGRE,
+    single-echo GE and cardiac), read by loader.kdata_dataset.Kdata_dataset (register new protocols
+    with register_protocol)
+"""
+import numpy as np
+
+
+class Protocol():
+    '''
+        descriptor of the slice folders of one protocol: a sample is slice startIdx + i of the folders
+        of one subject, the folders of the subjects of each split are paths relative to rootDir
+        (formatted with the params of the dataset, e.g. {loupe})
+    '''
+    def __init__(self,
+        rootDir,  # default root of the folders
+        subjects,  # {split: [(folder, shared_folder), ...]}, or {subject: (folder, shared_folder)} for the test split
+        slices,  # {split: (startIdx, nslice)}, first slice and number of slices of each subject
+        files,  # {field: (folder role, file name)} with folder role 'folder' or 'shared'
+        fields = ('kdata', 'org', 'csm', 'brain_mask'),  # fields of the samples, in the returned order
+        shared_modulo = 0,  # slice index modulo in the shared folder (0: same index as in the folder)
+        echo_block = (),  # fields read as their first necho echos (last dimension)
+        csm_per_echo = 0,  # flag of csms estimated from each echo (phase referenced to the first coil)
+        scale = None,  # factor of kdata and org when normalization != 0 (None: normalization is the factor)
+        recon_inputs = {},  # {split: [mat file, ...]} with the 'Recons' of nslice samples each (recon_input field)
+        computed = {},  # {field: function(dataset, sample)} of the fields computed from the read ones instead of read
+        echo_axis = 1,  # 0 for single-echo slices, without echo axis in the files and in the samples
+        echo_folders = ('',),  # suffixes of the folders of the echo ranges of a slice, concatenated along the echos
+        file_format = 'cfl',  # 'cfl', or 'mat' for one .mat file per slice (variable of the name without the last '_')
+        slice_name = '{}',  # format of the slice numbers in the file names (e.g. '{:03d}')
+        shared_rootDir = None  # root of the shared folders (rootDir of the dataset if None)
+    ):
+
+        self.rootDir = rootDir
+        self.subjects = subjects
+        self.slices = slices
+        self.files = files
+        self.fields = fields
+        self.shared_modulo = shared_modulo
+        self.echo_block = echo_block
+        self.csm_per_echo = csm_per_echo
+        self.scale = scale
+        self.recon_inputs = recon_inputs
+        self.computed = computed
+        self.echo_axis = echo_axis
+        self.echo_folders = echo_folders
+        self.file_format = file_format
+        self.slice_name = slice_name
+        self.shared_rootDir = shared_rootDir
+
+
+protocols = {}  # registered protocols, keyed by name
+
+
+def register_protocol(name, protocol):
+    protocols[name] = protocol
+    return protocol
+
+
+# fields computed from the raw samples of Kdata_dataset.read_raw, org (row, col, echo) and the others as read
+
+def mask_ones(dataset, sample):
+    return np.ones(sample['org'].shape[:2], dtype=np.float32)
+
+
+def mask_org(dataset, sample):
+    '''
+        voxels of the non-zero first echo of org
+    '''
+    return (np.abs(sample['org'][..., 0]) > 0).astype(np.float32)
+
+
+def mask_cardiac(dataset, sample):
+    '''
+        voxels of the first echo of the scaled org with magnitude in (0.002, 1)
+    '''
+    magnitude = np.abs(sample['org'][..., 0]) * dataset.scale_factor()
+    return ((magnitude > 0.002) & (magnitude < 1)).astype(np.float32)
+
+
+def csm_as_lowres(dataset, sample):
+    return sample['csm']
+
+
+files_GE = {
+    'org': ('folder', 'fully_slice_'),
+    'csm': ('folder', 'sensMaps_slice_'),
+    'kdata': ('folder', 'kdata_slice_'),
+    'brain_mask': ('folder', 'mask_slice_')
+}
+
+files_CBIC = {
+    'org': ('folder', 'fully_slice_'),
+    'csm': ('folder', 'sensMaps_slice_'),
+    'csm_lowres': ('shared', 'sensMaps_lowres_slice_'),
+    'kdata': ('folder', 'kdata_slice_'),
+    'brain_mask': ('folder', 'mask_slice_'),
+    'brain_mask_erode': ('shared', 'mask_erode_slice_')
+}
+
+fields_CBIC = ('kdata', 'org', 'recon_input', 'csm', 'csm_lowres', 'brain_mask', 'brain_mask_erode')
+
+recon_inputs_CBIC = {
+    'train': ['/data_cfl/20%train2/iField_bcrnn=1_loupe=0_solver=1_sub=0_train2.mat',
+              '/data_cfl/20%train2/iField_bcrnn=1_loupe=0_solver=1_sub=1_train2.mat',
+              '/data_cfl/20%train2/iField_bcrnn=1_loupe=0_solver=1_sub=2_train2.mat'],
+    'val': ['/data_cfl/20%train2/iField_bcrnn=1_loupe=0_solver=1_sub=0_val2.mat'],
+    'test': ['/data_cfl/20%train2/iField_bcrnn=1_loupe=0_solver=1_sub=2_test2.mat']
+}
+
+subjects_CBIC = {
+    'train': [('/data_cfl/{}2/full_cc_slices_sense_echo/'.format(name), '/data_cfl/jiahao2/full_cc_slices/')
+              for name in ['thanh', 'jinwei', 'qihao', 'hang', 'dominick', 'hangwei', 'kelly', 'feng']],
+    'val': [('/data_cfl/jiahao2/full_cc_slices_sense_echo/', '/data_cfl/jiahao2/full_cc_slices/')],
+    'test': {subject: ('/data_cfl/{}/full_cc_slices_sense_echo_FA=25/'.format(name), '/data_cfl/jiahao2/full_cc_slices/')
+             for subject, name in {0: 'junghun2', 1: 'chao2', 2: 'alexey2', 3: 'liangdong2', 5: 'jiahao2'}.items()}
+}
+
+
+# DHK GE scanner (12-coil), one folder of 1000 slices
+register_protocol('multi_echo_GE', Protocol(
+    rootDir = '/data/Jinwei/Multi_echo_slice_recon_GE',
+    subjects = {split: [('/megre_slice_GE/', '/megre_slice_GE/')] for split in ['train', 'val', 'test']},
+    slices = {'train': (200, 600), 'val': (0, 200), 'test': (200, 200)},
+    files = files_GE
+))
+
+# CBIC GE scanner, echo-wise csms, 200 slices from slice 30 per subject
+register_protocol('multi_echo_CBIC', Protocol(
+    rootDir = '/data/Jinwei/QSM_raw_CBIC',
+    subjects = subjects_CBIC,
+    slices = {split: (30, 200) for split in ['train', 'val', 'test']},
+    files = files_CBIC,
+    fields = fields_CBIC,
+    shared_modulo = 256,
+    echo_block = ('org', 'csm', 'csm_lowres', 'kdata', 'brain_mask', 'brain_mask_erode'),
+    csm_per_echo = 1,
+    scale = 0.62e7,  # for Siemens2 (0.5e7 for Siemens)
+    recon_inputs = recon_inputs_CBIC
+))
+
+# CBIC Siemens scanner, test subjects from the Siemens2 folders, 200 slices from slice 150
+register_protocol('multi_echo_CBIC_Siemens', Protocol(
+    rootDir = '/data/Jinwei/QSM_raw_CBIC',
+    subjects = {**subjects_CBIC, 'test': {
+        subject: ('/data_cfl/{}/full_cc_slices_sense_echo_Siemens2/'.format(name), '/data_cfl/jiahao2/full_cc_slices/')
+        for subject, name in {0: 'junghun2', 1: 'chao2', 2: 'alexey2', 3: 'liangdong2', 5: 'jiahao2'}.items()}},
+    slices = {split: (150, 200) for split in ['train', 'val', 'test']},
+    files = files_CBIC,
+    fields = fields_CBIC,
+    shared_modulo = 256,
+    echo_block = ('org', 'csm', 'csm_lowres', 'kdata', 'brain_mask', 'brain_mask_erode'),
+    csm_per_echo = 1,
+    scale = 0.62e7,
+    recon_inputs = recon_inputs_CBIC
+))
+
+# CBIC GE scanner with 0.75 mm resolution, 512 slices per subject
+register_protocol('multi_echo_CBIC_075', Protocol(
+    rootDir = '/data2/Jinwei/QSM_raw_CBIC',
+    subjects = {
+        'train': [('/data_cfl/{}/full_cc_slices_sense_echo/'.format(name), None)
+                  for name in ['junghun', 'chao', 'alexey', 'qihao', 'liangdong', 'dom', 'kelly', 'hangwei']],
+        'val': [('/data_cfl/jiahao/full_cc_slices_sense_echo/', None)],
+        'test': {subject: ('/data_cfl/{}/full_cc_slices_sense_echo/'.format(name), None)
+                 for subject, name in {0: 'thanh', 1: 'liangdong', 5: 'jiahao'}.items()}
+    },
+    slices = {split: (0, 512) for split in ['train', 'val', 'test']},
+    files = files_GE,
+    csm_per_echo = 1
+))
+
+# CBIC GE scanner with prospective under-sampling (loupe: 0 variable density, 1 optimal), csm and kdata
+# from the under-sampled acquisition, target and masks from the fully sampled one
+register_protocol('multi_echo_CBIC_prosp', Protocol(
+    rootDir = '/data/Jinwei/QSM_raw_CBIC',
+    subjects = {
+        'train': [('/data_cfl/{}2/10_loupe={{loupe}}_cc_slices_sense_echo/'.format(name), '/data_cfl/jiahao2/full_cc_slices_sense_echo/')
+                  for name in ['fenglei', 'jiahao', 'wenxin', 'hanxuan']],
+        'test': {subject: ('/data_cfl/{}/10_loupe={{loupe}}_cc_slices_sense_echo_Necho=7/'.format(name), '/data_cfl/jiahao2/full_cc_slices/')
+                 for subject, name in {0: 'junghun2', 1: 'chao2', 2: 'alexey2', 3: 'liangdong2', 4: 'fenglei2', 5: 'jiahao2',
+                                       6: 'dom2', 7: 'hangwei2', 8: 'wenxin2', 9: 'hanxuan2', 10: 'qihao2'}.items()}
+    },
+    slices = {split: (30, 200) for split in ['train', 'test']},
+    files = {**files_CBIC, 'org': ('shared', 'fully_slice_'), 'brain_mask': ('shared', 'mask_slice_')},
+    fields = fields_CBIC,
+    echo_block = ('org',),
+    csm_per_echo = 1,
+    scale = 0.62e7,
+    recon_inputs = recon_inputs_CBIC
+))
+
+# CBIC GE scanner with 0.75 mm resolution and prospective under-sampling (loupe: 0 variable density, 1 optimal),
+# brain masks of the non-zero voxels of the target (not used for prospective testing)
+register_protocol('multi_echo_CBIC_075_prosp', Protocol(
+    rootDir = '/data/Jinwei/QSM_raw_CBIC',
+    subjects = {
+        'train': [('/data_cfl/{}2/full_cc_slices/'.format(name), None) for name in ['thanh', 'jinwei', 'qihao']],
+        'val': [('/data_cfl/jiahao2/full_cc_slices/', None)],
+        'test': {subject: ('/data_cfl/{}/10_loupe={{loupe}}_cc_slices_sense_echo_new/'.format(name), None)
+                 for subject, name in {0: 'thanh', 1: 'liangdong', 5: 'jiahao'}.items()}
+    },
+    slices = {split: (0, 512) for split in ['train', 'val', 'test']},
+    files = {field: files_GE[field] for field in ['org', 'csm', 'kdata']},
+    computed = {'brain_mask': mask_org},
+    csm_per_echo = 1
+))
+
+# DHK GE scanner, single-echo slices of one contrast (one .mat file per slice), brain masks of ones
+folders_GE = {
+    'T1': '/Total_slices_T1/',
+    'T2': '/Total_slices_T2/',
+    'CardiacQSM': '/Total_slices_CardiacQSM/',
+    'CardiacSub6': '/Total_slices_multi_echo_sub6/'  # cardiac sub6 with multi-echo data
+}
+
+slices_GE = {
+    'T1': {'train': (0, 300), 'val': (300, 100), 'test': (440, 1)},
+    'T2': {'train': (0, 300), 'val': (300, 100), 'test': (400, 100)},
+    'CardiacQSM': {'train': (0, 90), 'val': (90, 18), 'test': (98, 1)},
+    'CardiacSub6': {'test': (0, 90)}
+}
+
+for contrast, folder in folders_GE.items():
+    register_protocol('GE_' + contrast, Protocol(
+        rootDir = '/data/Jinwei/T2_slice_recon_GE',
+        subjects = {split: [(folder, None)] for split in slices_GE[contrast]},
+        slices = slices_GE[contrast],
+        files = {field: files_GE[field] for field in ['org', 'csm', 'kdata']},
+        computed = {'brain_mask': mask_ones},
+        echo_axis = 0,
+        file_format = 'mat',
+        scale = 1
+    ))
+
+# DHK GE scanner, T1 slices with prospective under-sampling, one folder per subject and sampling mask
+register_protocol('GE_prosp', Protocol(
+    rootDir = '/data/Jinwei/T1_slice_recon_GE/prospective_data',
+    subjects = {'test': {0: ('/{subject}_{mask}/', None)}},
+    slices = {'test': (0, 206)},
+    files = {field: files_GE[field] for field in ['org', 'csm', 'kdata']},
+    computed = {'brain_mask': mask_ones},
+    echo_axis = 0,
+    file_format = 'mat',
+    scale = 1
+))
+
+files_T1T2QSM = {
+    'org': ('folder', 'fully_slice_'),
+    'csm': ('folder', 'sensMaps_slice_'),
+    'kdata': ('folder', 'kdata_slice_'),
+    'brain_mask': ('shared', 'mask_slice_')
+}
+
+# CBIC GE scanner, mGRE+T1w+T2w echos (dataset id of the folders), test subjects fully sampled (under = 'full')
+# or with prospective under-sampling (under = 'kt', masks of the fully sampled folders)
+register_protocol('T1T2QSM_CBIC', Protocol(
+    rootDir = '/data4/Jinwei/T1T2QSM',
+    subjects = {
+        'train': [('/data_cfl{{id}}/{}/full_cc_slices_sense_echo/'.format(name),) * 2
+                  for name in ['chao', 'jiahao', 'hangwei', 'dom']],
+        'val': [('/data_cfl{id}/qihao/full_cc_slices_sense_echo/',) * 2],
+        'test': {subject: ('/data_cfl{{id}}/{}/{{under}}_cc_slices_sense_echo/'.format(name),
+                           '/data_cfl{{id}}/{}/full_cc_slices_sense_echo/'.format(name))
+                 for subject, name in {0: 'qihao', 1: 'jiahao', 2: 'chao', 3: 'qihao'}.items()}
+    },
+    slices = {split: (0, 256) for split in ['train', 'val', 'test']},
+    files = files_T1T2QSM,
+    csm_per_echo = 1
+))
+
+# CBIC GE scanner with 1 mm isotropic resolution, mGRE+T1w+T2w echos, padded slices (_pad) with the echos
+# split into three folders and brain masks of the non-zero voxels of the first echo
+subjects_T1T2QSM_1iso = {
+    'train': [('/data_cfl/{{id}}/{}/full_cc_slices_sense_echo'.format(name),) * 2
+              for name in ['chao13', 'hangwei13', 'jiahao13', 'dom13', 'qihao13', 'liangdong13', 'kelly13', 'mert13']],
+    'val': [('/data_cfl/{id}/qihao8/full_cc_slices_sense_echo',) * 2],
+    'test': {subject: ('/data_cfl/{{id}}/{}/{{under}}_cc_slices_sense_echo'.format(name),) * 2
+             for subject, name in enumerate(['liangdong13', 'chao13', 'hangwei13', 'jiahao13', 'dom13', 'alexey13',
+                                             'qihao13', 'carly13', 'mert13', 'kelly13', 'thanh13', 'daniel13'])}
+}
+
+register_protocol('T1T2QSM_CBIC_1iso', Protocol(
+    rootDir = '/data4/Jinwei/T1T2QSM',
+    subjects = subjects_T1T2QSM_1iso,
+    slices = {split: (0, 256) for split in ['train', 'val', 'test']},
+    files = files_T1T2QSM,
+    csm_per_echo = 1,
+    echo_folders = ('/',)
+))
+
+register_protocol('T1T2QSM_CBIC_1iso_pad', Protocol(
+    rootDir = '/data4/Jinwei/T1T2QSM',
+    subjects = subjects_T1T2QSM_1iso,
+    slices = {split: (0, 436) for split in ['train', 'val', 'test']},
+    files = {field: files_T1T2QSM[field] for field in ['org', 'csm', 'kdata']},
+    computed = {'brain_mask': mask_org},
+    csm_per_echo = 1,
+    echo_folders = ('_pad_1-4/', '_pad_5-8/', '_pad_9-11/')
+))
+
+# test subjects with prospective under-sampling, masks of the fully sampled folder of jiahao13 on /data3
+register_protocol('T1T2QSM_CBIC_1iso_prosp', Protocol(
+    rootDir = '/data4/Jinwei/T1T2QSM',
+    subjects = {'test': {subject: (folder, '/data_cfl/{id}/jiahao13/full_cc_slices_sense_echo')
+                         for subject, (folder, shared) in subjects_T1T2QSM_1iso['test'].items()}},
+    slices = {'test': (0, 256)},
+    files = files_T1T2QSM,
+    csm_per_echo = 1,
+    echo_folders = ('/',),
+    shared_rootDir = '/data3/Jinwei/T1T2QSM'
+))
+
+# CBIC GE scanner with 0.75 mm resolution, mGRE+T1w echos, padded slices (_pad) as T1T2QSM_CBIC_1iso,
+# test subjects fully sampled (under = 'full') or with prospective under-sampling (under = 'under')
+subjects_T1QSM_075 = {
+    'train': [('/data_cfl/{{id}}/{}/full_cc_slices_sense_echo'.format(name),) * 2 for name in ['jiahao', 'chao', 'hangwei']],
+    'val': [('/data_cfl/{id}/qihao/full_cc_slices_sense_echo',) * 2],
+    'test': {subject: ('/data_cfl/{{id}}/{}/{{under}}_cc_slices_sense_echo'.format(name),) * 2
+             for subject, name in {0: 'qihao', 1: 'jiahao', 2: 'chao', 3: 'qihao'}.items()}
+}
+
+register_protocol('T1QSM_CBIC_075', Protocol(
+    rootDir = '/data4/Jinwei/T1T2QSM',
+    subjects = subjects_T1QSM_075,
+    slices = {split: (0, 320) for split in ['train', 'val', 'test']},
+    files = files_T1T2QSM,
+    csm_per_echo = 1,
+    echo_folders = ('/',)
+))
+
+register_protocol('T1QSM_CBIC_075_pad', Protocol(
+    rootDir = '/data4/Jinwei/T1T2QSM',
+    subjects = subjects_T1QSM_075,
+    slices = {split: (0, 480) for split in ['train', 'val', 'test']},
+    files = {field: files_T1T2QSM[field] for field in ['org', 'csm', 'kdata']},
+    computed = {'brain_mask': mask_org},
+    csm_per_echo = 1,
+    echo_folders = ('_pad_1-3/', '_pad_4-6/', '_pad_7-9/')
+))
+
+# GE scanner, multi-echo cardiac slices 2 to 25 of each subject, csms of the first echo used as csm_lowres,
+# brain masks thresholded on the first echo of the target
+register_protocol('me_cardiac', Protocol(
+    rootDir = '/data3/Jiahao/cardiacQSM/data',
+    subjects = {
+        'train': [('/{}/'.format(name), None) for name in ['001', '002', '003', '004', '013', '006', '007', '008', '009', '010', '011']],
+        'val': [('/012/', None)],
+        'test': {subject: ('/005/', None) for subject in range(4)}
+    },
+    slices = {split: (2, 24) for split in ['train', 'val', 'test']},
+    files = {
+        'org': ('folder', 'image_full_slice_'),
+        'csm': ('folder', 'sensMaps_slice_'),
+        'kdata': ('folder', 'kspace_full_slice_')
+    },
+    fields = ('kdata', 'org', 'csm', 'csm_lowres', 'brain_mask', 'brain_mask_erode'),
+    computed = {'csm_lowres': csm_as_lowres, 'brain_mask': mask_cardiac, 'brain_mask_erode': mask_ones},
+    slice_name = '{:03d}',
+    scale = 1e-5
+))
@@ -0,0 +1,85 @@
+import numpy as np
+import torch
+import multiprocessing
+from torch.utils import data
+
+
+class Slice_cache(data.Dataset):
+    '''
+        in-RAM LRU cache of the samples of a Dataset (e.g. kdata_multi_echo_CBIC), kept in shared memory
+        so that all DataLoader workers (forked in every epoch) read and fill the same cache;
+        samples must be tuples of numpy arrays of fixed shapes that only depend on idx
+    '''
+
+    def __init__(self,
+        dataset,
+        cache_gb = 8,  # bound of the cached samples in GB, least recently used ones are evicted
+    ):
+
+        self.dataset = dataset
+        # layout of a sample from the first one, the buffers are allocated before the workers fork
+        sample = dataset[0]
+        self.shapes = [a.shape for a in sample]
+        self.dtypes = [a.dtype for a in sample]
+        self.nbytes = [a.nbytes for a in sample]
+        self.offsets = np.cumsum([0] + self.nbytes)
+        self.nslots = int(min(len(dataset), cache_gb * 1024**3 // max(1, self.offsets[-1])))
+        self.buffer = torch.empty(self.nslots, int(self.offsets[-1]), dtype=torch.uint8).share_memory_()
+        self.slot_of = torch.full((len(dataset),), -1, dtype=torch.int64).share_memory_()  # slot of each sample
+        self.owner = torch.full((max(1, self.nslots),), -1, dtype=torch.int64).share_memory_()  # sample in each slot
+        self.last_used = torch.zeros(max(1, self.nslots), dtype=torch.int64).share_memory_()
+        self.counters = torch.zeros(3, dtype=torch.int64).share_memory_()  # clock, hits, misses
+        self.lock = multiprocessing.Lock()
+        self.put(0, sample)
+
+    def __len__(self):
+
+        return len(self.dataset)
+
+    def get(self, idx):
+        '''
+            copy of the cached sample idx (None if not cached)
+        '''
+        with self.lock:
+            slot = int(self.slot_of[idx])
+            if slot < 0:
+                self.counters[2] += 1
+                return None
+            self.counters[0] += 1
+            self.counters[1] += 1
+            self.last_used[slot] = self.counters[0]
+            record = self.buffer[slot].numpy()
+            return tuple(record[self.offsets[i]:self.offsets[i+1]].view(self.dtypes[i]).reshape(self.shapes[i]).copy()
+                         for i in range(len(self.shapes)))
+
+    def put(self, idx, sample):
+        if self.nslots == 0:
+            return
+        with self.lock:
+            if self.slot_of[idx] >= 0:
+                return
+            slot = int(torch.argmin(self.last_used))  # free slots were never used
+            if self.owner[slot] >= 0:
+                self.slot_of[self.owner[slot]] = -1
+            record = self.buffer[slot].numpy()
+            for i, a in enumerate(sample):
+                record[self.offsets[i]:self.offsets[i+1]] = np.ascontiguousarray(a, dtype=self.dtypes[i]).reshape(-1).view(np.uint8)
+            self.counters[0] += 1
+            self.last_used[slot] = self.counters[0]
+            self.owner[slot] = idx
+            self.slot_of[idx] = slot
+
+    def hit_rate(self):
+        hits, misses = int(self.counters[1]), int(self.counters[2])
+        return hits / max(1, hits + misses)
+
+    def reset_stats(self):
+        self.counters[1:] = 0
+
+    def __getitem__(self, idx):
+
+        sample = self.get(idx)
+        if sample is None:
+            sample = self.dataset[idx]
+            self.put(idx, sample)
+        return sample
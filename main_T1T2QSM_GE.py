@@ -10,6 +10,7 @@ import scipy.io as sio
 import numpy as np
 
 from torch.optim.lr_scheduler import MultiStepLR
+from torch.cuda.amp import autocast, GradScaler
 from IPython.display import clear_output
 from torch.utils import data
 from loader.kdata_T1T2QSM_CBIC import kdata_T1T2QSM_CBIC
@@ -91,6 +92,8 @@ if __name__ == '__main__':
     parser.add_argument('--normalizations', type=list, default=[5, 30, 30])  # normalization factors of multi-contrast images 
                                                                              # ([5, 30, 30] for dataset_id=5;
                                                                              #  [5, 10, 10] for other dataset_ids)
+    parser.add_argument('--packed', type=int, default=0)  # flag to read the slices from the packed folders (convert_packed.py)
+    parser.add_argument('--flag_amp', type=int, default=0)  # 1: fp16 autocast of the denoisers with a GradScaler (operators and CG in fp32)
     opt = {**vars(parser.parse_args())}
     K = opt['K']
     norm_last = opt['norm_last']
@@ -185,7 +188,8 @@ if __name__ == '__main__':
             dataset_id=opt['dataset_id'],
             t2w_redesign_flag=opt['t2w_redesign'],
             normalizations=opt['normalizations'],
-            echo_cat=opt['echo_cat']
+            echo_cat=opt['echo_cat'],
+            flag_packed=opt['packed']
         )
         trainLoader = data.DataLoader(dataLoader, batch_size=batch_size, shuffle=True, num_workers=1)
 
@@ -196,7 +200,8 @@ if __name__ == '__main__':
             dataset_id=opt['dataset_id'],
             t2w_redesign_flag=opt['t2w_redesign'],
             normalizations=opt['normalizations'],
-            echo_cat=opt['echo_cat']
+            echo_cat=opt['echo_cat'],
+            flag_packed=opt['packed']
         )
         valLoader = data.DataLoader(dataLoader_val, batch_size=batch_size, shuffle=True, num_workers=1)
 
@@ -261,6 +266,7 @@ if __name__ == '__main__':
         ms = [0.2, 0.4, 0.6, 0.8]
         ms = [np.floor(m * niter).astype(int) for m in ms]
         scheduler = MultiStepLR(optimizerG_dc, milestones = ms, gamma = 0.2)
+        scaler = GradScaler(enabled=opt['flag_amp'])  # loss scaling of the fp16 gradients (no-op without AMP)
 
         # logger
         logger = Logger(rootName+'/'+opt['weights_dir'], opt)
@@ -319,10 +325,11 @@ if __name__ == '__main__':
                 brain_masks = brain_masks.to(device)
 
                 optimizerG_dc.zero_grad()
-                if opt['temporal_pred'] == 1:
-                    Xs = netG_dc(kdatas, csms, None, masks, flip, x_input=None)
-                else:
-                    Xs = netG_dc(kdatas, csms, None, masks, flip)
+                with autocast(enabled=opt['flag_amp']):
+                    if opt['temporal_pred'] == 1:
+                        Xs = netG_dc(kdatas, csms, None, masks, flip, x_input=None)
+                    else:
+                        Xs = netG_dc(kdatas, csms, None, masks, flip)
 
                 if lambda1 == 1:
                     # compute paremeters label
@@ -340,8 +347,9 @@ if __name__ == '__main__':
                         # L1 or L2 loss
                         lossl2_sum += loss(Xs[i]*brain_masks, targets*brain_masks)
 
-                lossl2_sum.backward()
-                optimizerG_dc.step()
+                scaler.scale(lossl2_sum).backward()
+                scaler.step(optimizerG_dc)
+                scaler.update()
 
                 errL2_dc_sum += lossl2_sum.item()
 
@@ -372,10 +380,11 @@ if __name__ == '__main__':
                     csms = csms.to(device)
                     brain_masks = brain_masks.to(device)
 
-                    if opt['temporal_pred'] == 1:
-                        Xs = netG_dc(kdatas, csms, None, masks, flip, x_input=None)
-                    else:
-                        Xs = netG_dc(kdatas, csms, None, masks, flip)
+                    with autocast(enabled=opt['flag_amp']):
+                        if opt['temporal_pred'] == 1:
+                            Xs = netG_dc(kdatas, csms, None, masks, flip, x_input=None)
+                        else:
+                            Xs = netG_dc(kdatas, csms, None, masks, flip)
 
                     metrices_val.get_metrices(Xs[-1]*brain_masks, targets*brain_masks)
                     lossl2_sum = loss(Xs[-1]*brain_masks, targets*brain_masks)
@@ -468,7 +477,8 @@ if __name__ == '__main__':
             t2w_redesign_flag=opt['t2w_redesign'],
             subject=opt['test_sub'],
             normalizations=opt['normalizations'],
-            echo_cat=opt['echo_cat']
+            echo_cat=opt['echo_cat'],
+            flag_packed=opt['packed']
         )
         testLoader = data.DataLoader(dataLoader_test, batch_size=batch_size, shuffle=False)
 
@@ -492,10 +502,11 @@ if __name__ == '__main__':
                 csms = csms.to(device)
                 brain_masks = brain_masks.to(device)
 
-                if opt['temporal_pred'] == 1:
-                    Xs_1 = netG_dc(kdatas, csms, None, masks, flip, x_input=None)[-1]
-                else:
-                    Xs_1 = netG_dc(kdatas, csms, None, masks, flip)[-1]
+                with autocast(enabled=opt['flag_amp']):
+                    if opt['temporal_pred'] == 1:
+                        Xs_1 = netG_dc(kdatas, csms, None, masks, flip, x_input=None)[-1]
+                    else:
+                        Xs_1 = netG_dc(kdatas, csms, None, masks, flip)[-1]
                 precond = netG_dc.precond
                 if opt['echo_cat']:
                     targets = torch_channel_deconcate(targets)
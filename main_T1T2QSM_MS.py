@@ -13,6 +13,7 @@ from torch.optim.lr_scheduler import MultiStepLR
 from IPython.display import clear_output
 from torch.utils import data
 from loader.kdata_T1T2QSM_MS import kdata_T1T2QSM_MS
+from loader.batch_preprocess import Kspace_simu
 from utils.data import r2c, save_mat, save_nii, readcfl, memory_pre_alloc, torch_channel_deconcate, torch_channel_concate, Logger
 from utils.loss import lossL1, lossL2, SSIM, snr_gain, CrossEntropyMask, FittingError
 from utils.test import Metrices
@@ -71,6 +72,7 @@ if __name__ == '__main__':
     parser.add_argument('--att', type=int, default=0)  # flag to use attention-based denoiser
     parser.add_argument('--random', type=int, default=0)  # flag to multiply the input data with a random complex number
     parser.add_argument('--normalization', type=int, default=0)  # 0 for no normalization
+    parser.add_argument('--flag_simu', type=int, default=0)  # flag to simulate the kspace data in batch on the device (Kspace_simu)
     opt = {**vars(parser.parse_args())}
     K = opt['K']
     norm_last = opt['norm_last']
@@ -104,6 +106,7 @@ if __name__ == '__main__':
     os.environ['CUDA_VISIBLE_DEVICES'] = opt['gpu_id']
     rootName = '/data2/Jinwei/T1T2QSM_MS'
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    kspace_simu = Kspace_simu(echo_cat=opt['echo_cat'], device=device)  # kdatas of the loaders with flag_simu = 1
     # torch.manual_seed(0)
 
     if opt['loupe'] == -2:
@@ -142,7 +145,8 @@ if __name__ == '__main__':
             contrast='MultiContrast', 
             split='train',
             normalization=opt['normalization'],
-            echo_cat=opt['echo_cat']
+            echo_cat=opt['echo_cat'],
+            flag_simu=opt['flag_simu']
         )
         trainLoader = data.DataLoader(dataLoader, batch_size=batch_size, shuffle=True, num_workers=1)
 
@@ -151,7 +155,8 @@ if __name__ == '__main__':
             contrast='MultiContrast', 
             split='val',
             normalization=opt['normalization'],
-            echo_cat=opt['echo_cat']
+            echo_cat=opt['echo_cat'],
+            flag_simu=opt['flag_simu']
         )
         valLoader = data.DataLoader(dataLoader_val, batch_size=batch_size, shuffle=True, num_workers=1)
 
@@ -226,6 +231,8 @@ if __name__ == '__main__':
             netG_dc.train()
             metrices_train = Metrices()
             for idx, (kdatas, targets, csms, brain_masks) in enumerate(trainLoader):
+                if opt['flag_simu']:
+                    kdatas = kspace_simu(targets, csms, kdatas, epoch)  # k-space simulated in batch from the sample indices
                 kdatas = kdatas[:, :, :necho, ...]  # temporal undersampling
                 csms = csms[:, :, :necho, ...]  # temporal undersampling
                 if opt['temporal_pred'] == 0:
@@ -311,6 +318,8 @@ if __name__ == '__main__':
             loss_total_list = []
             with torch.no_grad():  # to solve memory exploration issue
                 for idx, (kdatas, targets, csms, brain_masks) in enumerate(valLoader):
+                    if opt['flag_simu']:
+                        kdatas = kspace_simu(targets, csms, kdatas, 0)  # k-space simulated in batch from the sample indices
                     kdatas = kdatas[:, :, :necho, ...]  # temporal undersampling
                     csms = csms[:, :, :necho, ...]  # temporal undersampling
                     if opt['temporal_pred'] == 0:
@@ -414,12 +423,15 @@ if __name__ == '__main__':
             split='test',
             subject_test=opt['test_sub'],
             normalization=opt['normalization'],
-            echo_cat=opt['echo_cat']
+            echo_cat=opt['echo_cat'],
+            flag_simu=opt['flag_simu']
         )
         testLoader = data.DataLoader(dataLoader_test, batch_size=batch_size, shuffle=False)
 
         with torch.no_grad():
             for idx, (kdatas, targets, csms, brain_masks) in enumerate(testLoader):
+                if opt['flag_simu']:
+                    kdatas = kspace_simu(targets, csms, kdatas, 0)  # k-space simulated in batch from the sample indices
                 kdatas = kdatas[:, :, :necho, ...]  # temporal undersampling
                 csms = csms[:, :, :necho, ...]  # temporal undersampling
 
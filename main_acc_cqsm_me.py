@@ -17,6 +17,7 @@ from loader.kdata_multi_echo_GE import kdata_multi_echo_GE
 from loader.kdata_multi_echo_CBIC import kdata_multi_echo_CBIC
 from loader.kdata_me_cardiac import kdata_me_cardiac
 from loader.kdata_multi_echo_CBIC_prosp import kdata_multi_echo_CBIC_prosp
+from loader.prefetcher import Prefetcher
 from utils.data import r2c, save_mat, readcfl, memory_pre_alloc, torch_channel_deconcate, torch_channel_concate, Logger, c2r_kdata
 from utils.loss import lossL1, lossL2, SSIM, snr_gain, CrossEntropyMask, FittingError
 from utils.test_cqsm import Metrices
@@ -218,7 +219,7 @@ if __name__ == '__main__':
             normalization=opt['normalization'],
             echo_cat=opt['echo_cat']
         )
-        trainLoader = data.DataLoader(dataLoader, batch_size=batch_size, shuffle=True, num_workers=1)
+        trainLoader = data.DataLoader(dataLoader, batch_size=batch_size, shuffle=True, num_workers=1, pin_memory=torch.cuda.is_available())
 
         # dataLoader_val = kdata_multi_echo_GE(
         # dataLoader_val = kdata_multi_echo_CBIC(  
@@ -229,7 +230,7 @@ if __name__ == '__main__':
             normalization=opt['normalization'],
             echo_cat=opt['echo_cat']
         )
-        valLoader = data.DataLoader(dataLoader_val, batch_size=batch_size, shuffle=True, num_workers=1)
+        valLoader = data.DataLoader(dataLoader_val, batch_size=batch_size, shuffle=True, num_workers=1, pin_memory=torch.cuda.is_available())
 
         if opt['echo_cat'] == 1:
             netG_dc = Resnet_with_DC2(
@@ -308,7 +309,7 @@ if __name__ == '__main__':
             # training phase
             netG_dc.train()
             metrices_train = Metrices()
-            for idx, (kdatas, targets, csms, csm_lowres, brain_masks, brain_masks_erode) in enumerate(trainLoader):
+            for idx, (kdatas, targets, csms, csm_lowres, brain_masks, brain_masks_erode) in enumerate(Prefetcher(trainLoader, device)):
                 kdatas = kdatas[:, :, :necho, ...]  # temporal undersampling
                 csms = csms[:, :, :necho, ...]  # temporal undersampling
                 # recon_input = recon_input[:, :2*necho, ...]  # temporal undersampling
@@ -350,14 +351,6 @@ if __name__ == '__main__':
 
                     errL2_dc_sum = 0
 
-                kdatas = kdatas.to(device)
-                targets = targets.to(device)
-                # recon_input = recon_input.to(device)
-                csms = csms.to(device)
-                csm_lowres = csm_lowres.to(device)
-                brain_masks = brain_masks.to(device)
-                brain_masks_erode = brain_masks_erode.to(device)
-
                 # operator = Back_forward_multiEcho(csms, masks, flip, lambda_dll2=0, necho=5)
                 # print(targets.size())
                 # test_image = operator.AtA(targets, 0).cpu().detach().numpy()
@@ -430,7 +423,7 @@ if __name__ == '__main__':
             metrices_val = Metrices()
             loss_total_list = []
             with torch.no_grad():  # to solve memory exploration issue
-                for idx, (kdatas, targets, csms, csm_lowres, brain_masks, brain_masks_erode) in enumerate(valLoader):
+                for idx, (kdatas, targets, csms, csm_lowres, brain_masks, brain_masks_erode) in enumerate(Prefetcher(valLoader, device)):
                     kdatas = kdatas[:, :, :necho, ...]  # temporal undersampling
                     csms = csms[:, :, :necho, ...]  # temporal undersampling
                     # recon_input = recon_input[:, :2*necho, ...]  # temporal undersampling
@@ -441,13 +434,6 @@ if __name__ == '__main__':
                     if torch.sum(brain_masks) == 0:
                         continue
 
-                    kdatas = kdatas.to(device)
-                    targets = targets.to(device)
-                    # recon_input = recon_input.to(device)
-                    csms = csms.to(device)
-                    csm_lowres = csm_lowres.to(device)
-                    brain_masks = brain_masks.to(device)
-
                     if opt['temporal_pred'] == 1:
                         Xs = netG_dc(kdatas, csms, csm_lowres, masks, flip, x_input=None)
                     else:
@@ -12,16 +12,21 @@ import numpy as np
 
 from scipy.ndimage import zoom
 from torch.optim.lr_scheduler import MultiStepLR
+from torch.cuda.amp import autocast, GradScaler
 from IPython.display import clear_output
 from torch.utils import data
 from loader.kdata_multi_echo_GE import kdata_multi_echo_GE
 from loader.kdata_multi_echo_CBIC import kdata_multi_echo_CBIC
 from loader.kdata_multi_echo_CBIC_prosp import kdata_multi_echo_CBIC_prosp
+from loader.slice_cache import Slice_cache
+from loader.prefetcher import Prefetcher
+from loader.kdata_dataset import Subject_batch_sampler
 from utils.data import load_nii, r2c, save_mat, readcfl, memory_pre_alloc, save_nii, torch_channel_deconcate, torch_channel_concate, Logger, c2r_kdata
 from utils.loss import lossL1, lossL2, SSIM, snr_gain, CrossEntropyMask, FittingError
 from utils.test import Metrices
+from utils.train import profile_checkpointing
 from utils.operators import backward_multiEcho
-from models.resnet_with_dc import Resnet_with_DC2
+from models.resnet_with_dc import Resnet_with_DC2, compile_recon
 from fits.fits import fit_R2_LM, arlo, fit_complex, fit_complex_all
 from utils.operators import low_rank_approx
 
@@ -86,12 +91,33 @@ if __name__ == '__main__':
     parser.add_argument('--norm_last', type=int, default=0)  # 0: norm+relu, 1: relu+norm
     parser.add_argument('--temporal_conv', type=int, default=0) # 0: no temporal, 1: center, 2: begining
     parser.add_argument('--1d_type', type=str, default='shear')  # 'shear' or 'random' sampling type of 1D mask
-    parser.add_argument('--precond', type=int, default=0)  # flag to use preconsitioning
+    parser.add_argument('--precond', type=int, default=0)  # preconditioning in CG, 0: none, 1: learned, 2: Jacobi, 3: circulant
     parser.add_argument('--att', type=int, default=0)  # flag to use attention-based denoiser
     parser.add_argument('--random', type=int, default=0)  # flag to multiply the input data with a random complex number
     parser.add_argument('--normalization', type=int, default=0)  # 0 for no normalization
+    parser.add_argument('--cplx_engine', type=int, default=0)  # flag to run the forward model with native complex64 tensors
+    parser.add_argument('--ncoil_compress', type=int, default=0)  # number of virtual coils after SVD coil compression, 0 for no compression
+    parser.add_argument('--batch_cg', type=int, default=0)  # flag to run CG with per-sample convergence in the DC layers
+    parser.add_argument('--cg_tol', type=float, default=0)  # relative residual tolerance of batched CG, 0 for rTr > 1e-10
+    parser.add_argument('--cg_max_iter', type=int, default=10)  # maximal number of CG iterations in each DC layer
+    parser.add_argument('--implicit_cg', type=int, default=0)  # flag to backpropagate through CG with an adjoint CG solve
+    parser.add_argument('--packed', type=int, default=0)  # flag to read the slices from the packed folders (convert_packed.py)
+    parser.add_argument('--cache_gb', type=float, default=0)  # GB of shared-memory slice cache for each of the train/val loaders, 0 for no cache
+    parser.add_argument('--num_workers', type=int, default=1)  # number of data loader workers
+    parser.add_argument('--slab', type=int, default=0)  # test volume reconstructed by batches of slab consecutive slices (one read each from the packed folders), 0: slice by slice
+    parser.add_argument('--flag_amp', type=int, default=0)  # 1: fp16 autocast of the denoisers with a GradScaler (operators and CG in fp32)
+    parser.add_argument('--cp_blocks', type=str, default='bcrnn,denoiser')  # checkpointed blocks among bcrnn, denoiser, dc (comma separated)
+    parser.add_argument('--cp_every', type=int, default=1)  # checkpoint the blocks of every cp_every-th unroll
+    parser.add_argument('--cp_unrolls', type=str, default='')  # (0-based) unrolls to checkpoint, comma separated, overrides cp_every
+    parser.add_argument('--flag_trace', type=int, default=0)  # test recon graph for the shapes of the test batches, 0: eager, 1: TorchScript trace, 2: torch.compile (torch >= 2.0)
+    parser.add_argument('--cp_profile', type=int, default=0)  # flag to print the memory/time of a training step under candidate checkpointing policies at startup
     opt = {**vars(parser.parse_args())}
+    if opt['slab'] > 1 and (not opt['batch_cg'] or opt['flag_trace']):
+        # plain and static CG take their step sizes from sums over the whole batch
+        parser.error('--slab > 1 needs the per-slice CG of --batch_cg 1 (and --flag_trace 0)')
     K = opt['K']
+    if opt['ncoil_compress'] > 0:
+        ncoil = opt['ncoil_compress']
     norm_last = opt['norm_last']
     flag_temporal_conv = opt['temporal_conv']
     lambda0 = opt['lambda0']
@@ -110,6 +136,9 @@ if __name__ == '__main__':
         niter = 500
     else:
         niter = 100
+    # checkpointing policy
+    cp_blocks = [block for block in opt['cp_blocks'].split(',') if block]
+    cp_unrolls = [int(i) for i in opt['cp_unrolls'].split(',')] if opt['cp_unrolls'] else None
 
     if opt['scanner'] == 1:
         ncol = 88
@@ -233,9 +262,13 @@ if __name__ == '__main__':
             contrast='MultiEcho', 
             split='train',
             normalization=opt['normalization'],
-            echo_cat=opt['echo_cat']
+            echo_cat=opt['echo_cat'],
+            ncoil_compress=opt['ncoil_compress'],
+            flag_packed=opt['packed']
         )
-        trainLoader = data.DataLoader(dataLoader, batch_size=batch_size, shuffle=True, num_workers=1)
+        if opt['cache_gb'] > 0:
+            dataLoader = Slice_cache(dataLoader, opt['cache_gb'])
+        trainLoader = data.DataLoader(dataLoader, batch_size=batch_size, shuffle=True, num_workers=opt['num_workers'], pin_memory=torch.cuda.is_available())
 
         # dataLoader_val = kdata_multi_echo_GE(
         dataLoader_val = kdata_multi_echo_CBIC(  
@@ -243,9 +276,13 @@ if __name__ == '__main__':
             contrast='MultiEcho', 
             split='val',
             normalization=opt['normalization'],
-            echo_cat=opt['echo_cat']
+            echo_cat=opt['echo_cat'],
+            ncoil_compress=opt['ncoil_compress'],
+            flag_packed=opt['packed']
         )
-        valLoader = data.DataLoader(dataLoader_val, batch_size=batch_size, shuffle=True, num_workers=1)
+        if opt['cache_gb'] > 0:
+            dataLoader_val = Slice_cache(dataLoader_val, opt['cache_gb'])
+        valLoader = data.DataLoader(dataLoader_val, batch_size=batch_size, shuffle=True, num_workers=opt['num_workers'], pin_memory=torch.cuda.is_available())
 
         if opt['echo_cat'] == 1:
             netG_dc = Resnet_with_DC2(
@@ -275,7 +312,15 @@ if __name__ == '__main__':
                 flag_unet=opt['flag_unet'],
                 flag_complexConv=opt['flag_complex'],
                 flag_att=opt['att'],
-                flag_cp=1
+                flag_cp=1,
+                flag_cplx_engine=opt['cplx_engine'],
+                flag_batch_cg=opt['batch_cg'],
+                cg_tol=opt['cg_tol'],
+                cg_max_iter=opt['cg_max_iter'],
+                flag_implicit_cg=opt['implicit_cg'],
+                cp_blocks=cp_blocks,
+                cp_every=opt['cp_every'],
+                cp_unrolls=cp_unrolls
             )
         else:
             netG_dc = Resnet_with_DC2(
@@ -314,6 +359,41 @@ if __name__ == '__main__':
         ms = [0.2, 0.4, 0.6, 0.8]
         ms = [np.floor(m * niter).astype(int) for m in ms]
         scheduler = MultiStepLR(optimizerG_dc, milestones = ms, gamma = 0.2)
+        scaler = GradScaler(enabled=opt['flag_amp'])  # loss scaling of the fp16 gradients (no-op without AMP)
+
+        # memory/time profile of the checkpointing policies on the first training batch
+        if opt['cp_profile']:
+            kdatas, targets, recon_input, csms, csm_lowres, brain_masks, brain_masks_erode = next(iter(Prefetcher(trainLoader, device)))
+            kdatas = kdatas[:, :, :necho, ...]
+            csms = csms[:, :, :necho, ...]
+            recon_input = recon_input[:, :2*necho, ...]
+            if opt['temporal_pred'] == 0:
+                targets = targets[:, :2*necho, ...]
+                brain_masks = brain_masks[:, :2*necho, ...]
+
+            def train_step():
+                with autocast(enabled=opt['flag_amp']):
+                    if opt['temporal_pred'] == 1:
+                        Xs = netG_dc(kdatas, csms, csm_lowres, masks, flip, x_input=recon_input)
+                    else:
+                        Xs = netG_dc(kdatas, csms, csm_lowres, masks, flip)
+                lossl2_sum = 0
+                for i in range(len(Xs)):
+                    if opt['loss'] == 0:
+                        lossl2_sum -= loss(Xs[i]*brain_masks, targets*brain_masks)
+                    else:
+                        lossl2_sum += loss(Xs[i]*brain_masks, targets*brain_masks)
+                scaler.scale(lossl2_sum).backward()
+                optimizerG_dc.zero_grad()
+
+            profile_checkpointing(netG_dc, train_step, [
+                ([], 1, None),
+                (['bcrnn'], 1, None),
+                (['bcrnn', 'denoiser'], 1, None),
+                (['bcrnn', 'denoiser', 'dc'], 1, None),
+                (['bcrnn', 'denoiser', 'dc'], 2, None),
+                (cp_blocks, opt['cp_every'], cp_unrolls)
+            ], device)
 
         # logger
         logger = Logger(rootName+'/'+opt['weights_dir'], opt)
@@ -325,7 +405,7 @@ if __name__ == '__main__':
             # training phase
             netG_dc.train()
             metrices_train = Metrices()
-            for idx, (kdatas, targets, recon_input, csms, csm_lowres, brain_masks, brain_masks_erode) in enumerate(trainLoader):
+            for idx, (kdatas, targets, recon_input, csms, csm_lowres, brain_masks, brain_masks_erode) in enumerate(Prefetcher(trainLoader, device)):
                 kdatas = kdatas[:, :, :necho, ...]  # temporal undersampling
                 csms = csms[:, :, :necho, ...]  # temporal undersampling
                 recon_input = recon_input[:, :2*necho, ...]  # temporal undersampling
@@ -367,23 +447,16 @@ if __name__ == '__main__':
 
                     errL2_dc_sum = 0
 
-                kdatas = kdatas.to(device)
-                targets = targets.to(device)
-                recon_input = recon_input.to(device)
-                csms = csms.to(device)
-                csm_lowres = csm_lowres.to(device)
-                brain_masks = brain_masks.to(device)
-                brain_masks_erode = brain_masks_erode.to(device)
-
                 # operator = Back_forward_multiEcho(csms, masks, 0)
                 # test_image = operator.AtA(targets, 0).cpu().detach().numpy()
                 # save_mat(rootName+'/results/test_image.mat', 'test_image', test_image)
 
                 optimizerG_dc.zero_grad()
-                if opt['temporal_pred'] == 1:
-                    Xs = netG_dc(kdatas, csms, csm_lowres, masks, flip, x_input=recon_input)
-                else:
-                    Xs = netG_dc(kdatas, csms, csm_lowres, masks, flip)
+                with autocast(enabled=opt['flag_amp']):
+                    if opt['temporal_pred'] == 1:
+                        Xs = netG_dc(kdatas, csms, csm_lowres, masks, flip, x_input=recon_input)
+                    else:
+                        Xs = netG_dc(kdatas, csms, csm_lowres, masks, flip)
 
                 if lambda1 == 1:
                     # compute paremeters label
@@ -427,8 +500,9 @@ if __name__ == '__main__':
                 
                 # # maximal cross entropy mask loss
                 # lossl2_sum -= lambda_maskbce * loss_cem(netG_dc.Pmask_rescaled)
-                lossl2_sum.backward()
-                optimizerG_dc.step()
+                scaler.scale(lossl2_sum).backward()
+                scaler.step(optimizerG_dc)
+                scaler.update()
 
                 errL2_dc_sum += lossl2_sum.item()
 
@@ -444,7 +518,7 @@ if __name__ == '__main__':
             metrices_val = Metrices()
             loss_total_list = []
             with torch.no_grad():  # to solve memory exploration issue
-                for idx, (kdatas, targets, recon_input, csms, csm_lowres, brain_masks, brain_masks_erode) in enumerate(valLoader):
+                for idx, (kdatas, targets, recon_input, csms, csm_lowres, brain_masks, brain_masks_erode) in enumerate(Prefetcher(valLoader, device)):
                     kdatas = kdatas[:, :, :necho, ...]  # temporal undersampling
                     csms = csms[:, :, :necho, ...]  # temporal undersampling
                     recon_input = recon_input[:, :2*necho, ...]  # temporal undersampling
@@ -455,17 +529,11 @@ if __name__ == '__main__':
                     if torch.sum(brain_masks) == 0:
                         continue
 
-                    kdatas = kdatas.to(device)
-                    targets = targets.to(device)
-                    recon_input = recon_input.to(device)
-                    csms = csms.to(device)
-                    csm_lowres = csm_lowres.to(device)
-                    brain_masks = brain_masks.to(device)
-
-                    if opt['temporal_pred'] == 1:
-                        Xs = netG_dc(kdatas, csms, csm_lowres, masks, flip, x_input=recon_input)
-                    else:
-                        Xs = netG_dc(kdatas, csms, csm_lowres, masks, flip)
+                    with autocast(enabled=opt['flag_amp']):
+                        if opt['temporal_pred'] == 1:
+                            Xs = netG_dc(kdatas, csms, csm_lowres, masks, flip, x_input=recon_input)
+                        else:
+                            Xs = netG_dc(kdatas, csms, csm_lowres, masks, flip)
 
                     metrices_val.get_metrices(Xs[-1]*brain_masks, targets*brain_masks)
                     # targets = np.asarray(targets.cpu().detach())
@@ -490,6 +558,11 @@ if __name__ == '__main__':
             % (epoch, niter, np.mean(np.asarray(metrices_train.PSNRs))))
             logger.print_and_save('Epoch: [%d/%d], PSNR in validation: %.2f, loss in validation: %.10f' 
             % (epoch, niter, np.mean(np.asarray(metrices_val.PSNRs)), Validation_loss[-1]))
+            if opt['cache_gb'] > 0:
+                logger.print_and_save('Epoch: [%d/%d], slice cache hit rate in training: %.3f, in validation: %.3f'
+                % (epoch, niter, dataLoader.hit_rate(), dataLoader_val.hit_rate()))
+                dataLoader.reset_stats()
+                dataLoader_val.reset_stats()
 
             # save weights
             if Validation_psnr[-1] == max(Validation_psnr):
@@ -528,7 +601,12 @@ if __name__ == '__main__':
                 flag_hidden=flag_hidden,
                 flag_unet=opt['flag_unet'],
                 flag_att=opt['att'],
-                flag_scanner=opt['scanner']
+                flag_scanner=opt['scanner'],
+                flag_cplx_engine=opt['cplx_engine'],
+                flag_batch_cg=opt['batch_cg'],
+                cg_tol=opt['cg_tol'],
+                cg_max_iter=opt['cg_max_iter'],
+                flag_implicit_cg=opt['implicit_cg']
             )
         else:
             netG_dc = Resnet_with_DC2(
@@ -567,6 +645,7 @@ if __name__ == '__main__':
         F0, P = [], []
         Recons = []
         preconds = []
+        CG_niters = []
         
         if opt['prosp'] == 0:
             dataLoader_test = kdata_multi_echo_CBIC(
@@ -577,7 +656,10 @@ if __name__ == '__main__':
                 subject=opt['test_sub'],
                 normalization=opt['normalization'],
                 echo_cat=opt['echo_cat'],
-                scanner=opt['scanner']
+                scanner=opt['scanner'],
+                ncoil_compress=opt['ncoil_compress'],
+                flag_packed=opt['packed'],
+                slab=max(1, opt['slab'])
             )
         elif opt['prosp'] == 1:
             dataLoader_test = kdata_multi_echo_CBIC_prosp(
@@ -590,7 +672,11 @@ if __name__ == '__main__':
                 normalization=opt['normalization'],
                 echo_cat=opt['echo_cat']
             )
-        testLoader = data.DataLoader(dataLoader_test, batch_size=batch_size, shuffle=False)
+        if opt['slab'] > 0:
+            testLoader = data.DataLoader(dataLoader_test, batch_sampler=Subject_batch_sampler(dataLoader_test, opt['slab']),
+                                         num_workers=opt['num_workers'], pin_memory=torch.cuda.is_available())
+        else:
+            testLoader = data.DataLoader(dataLoader_test, batch_size=batch_size, shuffle=False)
 
         with torch.no_grad():
             for idx, (kdatas, targets, recon_input, csms, csm_lowres, brain_masks, brain_masks_erode) in enumerate(testLoader):
@@ -618,11 +704,24 @@ if __name__ == '__main__':
 
                 # inputs = backward_multiEcho(kdatas, csms, masks, flip,
                                             # opt['echo_cat'])
-                if opt['temporal_pred'] == 1:
-                    Xs_1 = netG_dc(kdatas, csms, csm_lowres, masks, flip, x_input=recon_input)[-1]
-                else:
-                    Xs_1 = netG_dc(kdatas, csms, csm_lowres, masks, flip)[-1]
+                with autocast(enabled=opt['flag_amp']):
+                    if opt['temporal_pred'] == 1:
+                        Xs_1 = netG_dc(kdatas, csms, csm_lowres, masks, flip, x_input=recon_input)[-1]
+                    elif opt['flag_trace'] > 0:
+                        lowres = [csm_lowres] if opt['rank'] > 0 else []
+                        if idx == 0:
+                            # graph of the first batch (max_iter CG iterations in the DC layers), batches of other shapes in eager mode
+                            netG_trace = compile_recon(netG_dc, kdatas, csms, masks, flip, *lowres, mode='trace' if opt['flag_trace'] == 1 else 'compile')
+                            trace_shape = kdatas.shape
+                        if kdatas.shape == trace_shape:
+                            Xs_1 = netG_trace(kdatas, csms, masks, flip, *lowres)
+                        else:
+                            Xs_1 = netG_dc(kdatas, csms, csm_lowres, masks, flip)[-1]
+                    else:
+                        Xs_1 = netG_dc(kdatas, csms, csm_lowres, masks, flip)[-1]
                 precond = netG_dc.precond
+                if opt['batch_cg'] and not opt['flag_trace']:
+                    CG_niters.append(torch.stack(netG_dc.cg_niters, dim=1).cpu())  # (batch, number of DC layers)
                 if opt['echo_cat']:
                     targets = torch_channel_deconcate(targets)
                     recon_input = torch_channel_deconcate(recon_input)
@@ -654,6 +753,10 @@ if __name__ == '__main__':
                 F0.append(f0.cpu().detach())
                 P.append(p.cpu().detach())
 
+            if opt['batch_cg'] and not opt['flag_trace']:
+                CG_niters = torch.cat(CG_niters, dim=0).float()
+                print('CG iterations per DC layer: mean {0:.2f}, max {1:.0f}'.format(torch.mean(CG_niters), torch.max(CG_niters)))
+
             # write into .mat file
             Recons_ = np.squeeze(r2c(np.concatenate(Recons, axis=0), opt['echo_cat']))
             Recons_ = np.transpose(Recons_, [0, 2, 3, 1])
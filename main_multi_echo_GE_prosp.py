@@ -225,8 +225,7 @@ if __name__ == '__main__':
 
                 csm = np.concatenate((sens_1echo_3d[idx, :, ncol//2:, :], sens_1echo_3d[idx, :, :ncol//2, :]), axis=1)
                 csm = np.transpose(csm, (2, 0, 1))[:, np.newaxis, ...]  # (coil, 1, row, col)
-                csm = np.repeat(csm, necho, axis=1)  # (coil, echo, row, col)
-                csm = c2r_kdata(csm) # (coil, echo, row, col, 2) with last dimension real&imag
+                csm = c2r_kdata(csm) # (coil, 1, row, col, 2) shared by all echos with last dimension real&imag
                 csms = torch.from_numpy(csm[np.newaxis, ...])
 
                 if idx == 1 and opt['loupe'] > 0:
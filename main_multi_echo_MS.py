@@ -17,6 +17,8 @@ from loader.kdata_multi_echo_GE import kdata_multi_echo_GE
 from loader.kdata_multi_echo_CBIC import kdata_multi_echo_CBIC
 from loader.kdata_multi_echo_MS import kdata_multi_echo_MS
 from loader.kdata_multi_echo_MS075 import kdata_multi_echo_MS075
+from loader.prefetcher import Prefetcher
+from loader.batch_preprocess import Kspace_simu
 from utils.data import r2c, save_mat, save_nii, readcfl, memory_pre_alloc, torch_channel_deconcate, torch_channel_concate, Logger
 from utils.loss import lossL1, lossL2, SSIM, snr_gain, CrossEntropyMask, FittingError
 from utils.test import Metrices
@@ -79,6 +81,7 @@ if __name__ == '__main__':
     parser.add_argument('--att', type=int, default=0)  # flag to use attention-based denoiser
     parser.add_argument('--random', type=int, default=0)  # flag to multiply the input data with a random complex number
     parser.add_argument('--normalization', type=int, default=0)  # 0 for no normalization
+    parser.add_argument('--flag_simu', type=int, default=0)  # flag to simulate the kspace data in batch on the device (Kspace_simu)
     opt = {**vars(parser.parse_args())}
     K = opt['K']
     norm_last = opt['norm_last']
@@ -119,6 +122,7 @@ if __name__ == '__main__':
     QSM_folders = ['0001', '0017', '0018', '0038', '0040', '0042', \
                    '0046', '0048', '0076', '0084', '0087']
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    kspace_simu = Kspace_simu(echo_cat=opt['echo_cat'], device=device)  # kdatas of the loaders with flag_simu = 1
     # torch.manual_seed(0)
 
     if opt['loupe'] == -1:
@@ -202,9 +206,10 @@ if __name__ == '__main__':
             split='train',
             trainset_type=opt['trainset_type'],
             normalization=opt['normalization'],
-            echo_cat=opt['echo_cat']
+            echo_cat=opt['echo_cat'],
+            flag_simu=opt['flag_simu']
         )
-        trainLoader = data.DataLoader(dataLoader, batch_size=batch_size, shuffle=True, num_workers=1)
+        trainLoader = data.DataLoader(dataLoader, batch_size=batch_size, shuffle=True, num_workers=1, pin_memory=torch.cuda.is_available())
 
         dataLoader_val = kdata_multi_echo_MS(
         # dataLoader_val = kdata_multi_echo_MS075(  
@@ -212,9 +217,10 @@ if __name__ == '__main__':
             contrast='MultiEcho', 
             split='val',
             normalization=opt['normalization'],
-            echo_cat=opt['echo_cat']
+            echo_cat=opt['echo_cat'],
+            flag_simu=opt['flag_simu']
         )
-        valLoader = data.DataLoader(dataLoader_val, batch_size=batch_size, shuffle=True, num_workers=1)
+        valLoader = data.DataLoader(dataLoader_val, batch_size=batch_size, shuffle=True, num_workers=1, pin_memory=torch.cuda.is_available())
 
 
         if opt['echo_cat'] == 1:
@@ -285,7 +291,9 @@ if __name__ == '__main__':
             # training phase
             netG_dc.train()
             metrices_train = Metrices()
-            for idx, (kdatas, targets, recon_input, csms, csm_lowres, brain_masks, brain_masks_erode) in enumerate(trainLoader):
+            for idx, (kdatas, targets, recon_input, csms, csm_lowres, brain_masks, brain_masks_erode) in enumerate(Prefetcher(trainLoader, device)):
+                if opt['flag_simu']:
+                    kdatas = kspace_simu(targets, csms, kdatas, epoch)  # k-space simulated in batch from the sample indices
                 kdatas = kdatas[:, :, :necho, ...]  # temporal undersampling
                 csms = csms[:, :, :necho, ...]  # temporal undersampling
                 recon_input = recon_input[:, :2*necho, ...]  # temporal undersampling
@@ -327,14 +335,6 @@ if __name__ == '__main__':
 
                     errL2_dc_sum = 0
 
-                kdatas = kdatas.to(device)
-                targets = targets.to(device)
-                recon_input = recon_input.to(device)
-                csms = csms.to(device)
-                csm_lowres = csm_lowres.to(device)
-                brain_masks = brain_masks.to(device)
-                brain_masks_erode = brain_masks_erode.to(device)
-
                 # operator = Back_forward_MS(csms, masks, flip, 0)
                 # test_image = operator.AtA(targets, 0).cpu().detach().numpy()
                 # kdatas = forward_MS(targets, csms, masks, flip)
@@ -406,7 +406,9 @@ if __name__ == '__main__':
             metrices_val = Metrices()
             loss_total_list = []
             with torch.no_grad():  # to solve memory exploration issue
-                for idx, (kdatas, targets, recon_input, csms, csm_lowres, brain_masks, brain_masks_erode) in enumerate(valLoader):
+                for idx, (kdatas, targets, recon_input, csms, csm_lowres, brain_masks, brain_masks_erode) in enumerate(Prefetcher(valLoader, device)):
+                    if opt['flag_simu']:
+                        kdatas = kspace_simu(targets, csms, kdatas, 0)  # k-space simulated in batch from the sample indices
                     kdatas = kdatas[:, :, :necho, ...]  # temporal undersampling
                     csms = csms[:, :, :necho, ...]  # temporal undersampling
                     recon_input = recon_input[:, :2*necho, ...]  # temporal undersampling
@@ -417,13 +419,6 @@ if __name__ == '__main__':
                     if torch.sum(brain_masks) == 0:
                         continue
 
-                    kdatas = kdatas.to(device)
-                    targets = targets.to(device)
-                    recon_input = recon_input.to(device)
-                    csms = csms.to(device)
-                    csm_lowres = csm_lowres.to(device)
-                    brain_masks = brain_masks.to(device)
-
                     if opt['temporal_pred'] == 1:
                         Xs = netG_dc(kdatas, csms, csm_lowres, masks, flip, x_input=recon_input)
                     else:
@@ -532,12 +527,15 @@ if __name__ == '__main__':
             subject=opt['test_sub'],
             # test_ID=opt['test_ID'],
             normalization=opt['normalization'],
-            echo_cat=opt['echo_cat']
+            echo_cat=opt['echo_cat'],
+            flag_simu=opt['flag_simu']
         )
         testLoader = data.DataLoader(dataLoader_test, batch_size=batch_size, shuffle=False)
 
         with torch.no_grad():
             for idx, (kdatas, targets, recon_input, csms, csm_lowres, brain_masks, brain_masks_erode) in enumerate(testLoader):
+                if opt['flag_simu']:
+                    kdatas = kspace_simu(targets, csms, kdatas, 0)  # k-space simulated in batch from the sample indices
                 if opt['pre_trained_healthy']:
                     kdatas = kdatas[:, :, :necho, ...] / 3
                 else:
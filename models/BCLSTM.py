@@ -77,10 +77,10 @@ class BCLSTMlayer(nn.Module):
         size_h = [nb, self.hidden_size, nx, ny]
         if test:
             with torch.no_grad():
-                hid_init = Variable(torch.zeros(size_h)).cuda()
+                hid_init = Variable(torch.zeros(size_h, device=input.device, dtype=input.dtype))
         else:
-            hid_init = Variable(torch.zeros(size_h)).cuda()
-            cell_init = Variable(torch.zeros(size_h)).cuda()
+            hid_init = Variable(torch.zeros(size_h, device=input.device, dtype=input.dtype))
+            cell_init = Variable(torch.zeros(size_h, device=input.device, dtype=input.dtype))
 
         output_f = []
         output_b = []
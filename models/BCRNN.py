@@ -53,6 +53,26 @@ class CRNNcell(nn.Module):
 
         return hidden
 
+    def input_to_hidden(self, input):
+        '''
+            i2h features of a batch of inputs (e.g. all the time frames stacked in the batch dimension)
+        '''
+        in_to_hid = self.i2h(input)
+        if self.flag_bn:
+            in_to_hid = self.bn_i2h(in_to_hid)
+        return in_to_hid
+
+    def recurrence(self, in_to_hid, hidden):
+        '''
+            hidden state update from the precomputed i2h features (same as forward)
+        '''
+        if self.flag_hidden:
+            hid_to_hid = self.h2h(hidden)
+            if self.flag_bn:
+                hid_to_hid = self.bn_h2h(hid_to_hid)
+            return self.relu(in_to_hid + hid_to_hid)
+        return self.relu(in_to_hid)
+
 
 class BCRNNlayer(nn.Module):
     """
@@ -66,7 +86,7 @@ class BCRNNlayer(nn.Module):
     --------------------
     output: 5d tensor, shape (n_seq, n_batch, hidden_size, width, height)
     """
-    def __init__(self, input_size, hidden_size, kernel_size, flag_convFT=0, flag_bn=1, flag_hidden=1):
+    def __init__(self, input_size, hidden_size, kernel_size, flag_convFT=0, flag_bn=1, flag_hidden=1, flag_time_batch=1):
         super(BCRNNlayer, self).__init__()
         self.hidden_size = hidden_size
         self.kernel_size = kernel_size
@@ -74,18 +94,21 @@ class BCRNNlayer(nn.Module):
         self.flag_convFT = flag_convFT
         self.flag_bn = flag_bn
         self.flag_hidden = flag_hidden
+        self.flag_time_batch = flag_time_batch  # flag to batch i2h over time and the two directions (forward_time_batch)
         # self.CRNN_model1 = CRNNcell(self.input_size, self.hidden_size, self.kernel_size)
         # self.CRNN_model2 = CRNNcell(self.input_size, self.hidden_size, self.kernel_size)
         self.CRNN_model = CRNNcell(self.input_size, self.hidden_size, self.kernel_size, self.flag_convFT, self.flag_bn, self.flag_hidden)
     # def forward(self, input, input_iteration, test=False):
     def forward(self, input, test=False):
+        if self.flag_time_batch:
+            return self.forward_time_batch(input)
         nt, nb, nc, nx, ny = input.shape
         size_h = [nb, self.hidden_size, nx, ny]
         if test:
             with torch.no_grad():
-                hid_init = Variable(torch.zeros(size_h)).cuda()
+                hid_init = Variable(torch.zeros(size_h, device=input.device, dtype=input.dtype))
         else:
-            hid_init = Variable(torch.zeros(size_h)).cuda()
+            hid_init = Variable(torch.zeros(size_h, device=input.device, dtype=input.dtype))
 
         output_f = []
         output_b = []
@@ -115,6 +138,35 @@ class BCRNNlayer(nn.Module):
 
         return output
 
+    def forward_time_batch(self, input):
+        '''
+            same output as the two loops of forward: i2h of the nt time frames in one batched convolution,
+            the forward and backward recurrences stacked in the batch dimension so that only h2h is
+            sequential (nt steps of batch 2*nb instead of 2*nt steps of batch nb)
+        '''
+        nt, nb, nc, nx, ny = input.shape
+        in_to_hid = self.CRNN_model.input_to_hidden(input.reshape(nt*nb, nc, nx, ny))
+        in_to_hid = in_to_hid.view(nt, nb, self.hidden_size, nx, ny)
+        if self.flag_hidden:
+            in_to_hid = torch.cat((in_to_hid, in_to_hid.flip(0)), 1)  # (nt, 2*nb, hidden, nx, ny), backward in reversed time
+            hidden = input.new_zeros(2*nb, self.hidden_size, nx, ny)
+            outputs = []
+            # unbind rather than in_to_hid[i], whose backward would scatter each step into a full size gradient
+            for in_to_hid_t in in_to_hid.unbind(0):
+                hidden = self.CRNN_model.recurrence(in_to_hid_t, hidden)
+                outputs.append(hidden)
+            outputs = torch.stack(outputs)  # (nt, 2*nb, hidden, nx, ny)
+            output = outputs[:, :nb, ...] + outputs[:, nb:, ...].flip(0)
+        else:
+            # no recurrence, both directions give the i2h features
+            output = 2 * self.CRNN_model.relu(in_to_hid)
+
+        output = output.reshape(nt*nb, self.hidden_size, nx, ny)
+        if nb == 1:
+            output = output.view(nt, 1, self.hidden_size, nx, ny)
+
+        return output
+
 
 class MultiLevelBCRNNlayer(nn.Module):
     def __init__(self, input_size, hidden_size, kernel_size, flag_convFT=0):
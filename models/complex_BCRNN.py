@@ -85,9 +85,9 @@ class ComplexBCRNNlayer(nn.Module):
         size_h = [nb, nc, self.hidden_size, nx, ny]
         if test:
             with torch.no_grad():
-                hid_init = Variable(torch.zeros(size_h)).cuda()
+                hid_init = Variable(torch.zeros(size_h, device=input.device, dtype=input.dtype))
         else:
-            hid_init = Variable(torch.zeros(size_h)).cuda()
+            hid_init = Variable(torch.zeros(size_h, device=input.device, dtype=input.dtype))
 
         output_f = []
         output_b = []
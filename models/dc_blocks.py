@@ -1,12 +1,15 @@
 """
 This file contains data consistency blocks in the model
 """
+import copy
 import torch
 import torch.nn as nn
 import numpy as np
+from torch.cuda.amp import autocast
 from utils.data import *
 from utils.loss import *
 from utils.operators import *
+from models.preconditioners import Precond_learned, analytic_preconditioner
 
 def mlpy_in_cg(a, b):
     """
@@ -48,7 +51,7 @@ class DC_layer():
     def __init__(self, A, rhs, flag_precond=0, precond=0, use_dll2=1):
         self.AtA = lambda z: A.AtA(z, use_dll2=use_dll2)
         self.rhs = rhs
-        self.device = rhs.get_device()
+        self.device = rhs.device
         if flag_precond == 0:
             self.flag_precond = flag_precond
         else:
@@ -116,7 +119,7 @@ class DC_layer_real():
     def __init__(self, A, rhs, flag, use_dll2=1, lambda_dll2=1):
         self.AtA = lambda z: A.AtA(z, flag=flag, use_dll2=use_dll2, lambda_dll2=lambda_dll2)
         self.rhs = rhs
-        self.device = rhs.get_device()
+        self.device = rhs.device
 
     def CG_body(self, i, rTr, x, r, p):
         Ap = self.AtA(p)
@@ -140,11 +143,43 @@ class DC_layer_real():
             # print('i = {0}, rTr = {1}'.format(i, rTr))
         return x
 
+class CG_adjoint(torch.autograd.Function):
+    """
+        zero in forward and M^-1 in backward, with M = AtA the self-adjoint system matrix of a
+        DC_layer_multiEcho: x = x* + CG_adjoint(rhs - M x*) has the value of the CG solution x*
+        and the implicit gradients of x* = M^-1 rhs (also w.r.t. lambda_dll2 and the operator through M)
+    """
+    @staticmethod
+    def forward(ctx, residual, dc_layer, max_iter):
+        ctx.dc_layer = dc_layer
+        ctx.max_iter = max_iter
+        return torch.zeros_like(residual)
+
+    @staticmethod
+    def backward(ctx, grad_x):
+        dc_layer = copy.copy(ctx.dc_layer)
+        dc_layer.rhs = grad_x
+        dc_layer.flag_implicit = 0
+        with torch.no_grad():
+            grad_residual = dc_layer.CG_iter(ctx.max_iter)
+        return grad_residual, None, None
+
 # CG layer for (necho, nrow, ncol) data
 class DC_layer_multiEcho():
     def __init__(self, A, rhs, echo_cat=1, necho=10,
-                 flag_precond=0, precond=0, use_dll2=1):
+                 flag_precond=0,  # 0: no preconditioner, 1: learned (precond), 2: Jacobi, 3: circulant
+                 precond=0, use_dll2=1,
+                 flag_batch_cg=0,  # flag to run CG with per-sample alpha/beta and convergence
+                 tol=0,  # relative residual tolerance ||r||/||rhs|| of each sample (0: rTr > 1e-10 as in CG_iter)
+                 flag_implicit=0,  # flag to backpropagate with one adjoint CG solve instead of through the iterations
+                 flag_static=0):  # flag to run max_iter CG iterations without python control flow on the data (traced graphs)
+        self.A = A
+        self.use_dll2 = use_dll2
         self.AtA = lambda z: A.AtA(z, use_dll2=use_dll2)
+        self.flag_batch_cg = flag_batch_cg
+        self.tol = tol
+        self.flag_implicit = flag_implicit
+        self.flag_static = flag_static
         self.echo_cat = echo_cat
         self.necho = necho
         self.flag_precond = flag_precond
@@ -152,10 +187,15 @@ class DC_layer_multiEcho():
             self.rhs = torch_channel_deconcate(rhs) # (batch, 2, echo, row, col)
         else:
             self.rhs = rhs
-        if self.flag_precond:
+        if self.rhs.dtype == torch.float16:
+            # rhs from the fp16 denoiser outputs of AMP, CG runs in fp32
+            self.rhs = self.rhs.float()
+        if self.flag_precond == 1:
             # precond: C^-1, M_inv = C^-TC^-1, size: (batch, 2, echo, row, col)
-            self.M_inv = mlpy_in_cg(conj_in_cg(precond), precond)
-        self.device = rhs.get_device()
+            self.preconditioner = Precond_learned(precond)
+        elif self.flag_precond > 1:
+            self.preconditioner = analytic_preconditioner(A, flag_precond, use_dll2)
+        self.device = rhs.device
 
     def CG_body(self, i, rTr, x, r, p):
         if self.echo_cat:
@@ -184,7 +224,7 @@ class DC_layer_multiEcho():
 
         x = x + mlpy_in_cg(p, alpha)
         r = r + mlpy_in_cg(Ap, alpha)
-        y = mlpy_in_cg(self.M_inv, r)
+        y = self.preconditioner(r)
 
         rTyNew = torch.sum(mlpy_in_cg(conj_in_cg(r), y), dim=(0, 2, 3, 4))
         beta = cplx_dvd(rTyNew, rTy)
@@ -192,21 +232,147 @@ class DC_layer_multiEcho():
         p = -y + mlpy_in_cg(beta, p)
         return i+1, rTyNew, x, r, y, p
 
+    def batch_AtA(self, p, idx):
+        '''
+            AtA applied only to the samples idx of the batch, p: (len(idx), 2, echo, row, col)
+        '''
+        if len(idx) < self.rhs.size()[0]:
+            if self.idx_A is None or not torch.equal(self.idx_A, idx):
+                # operators without batch_select fall back to the full batch
+                self.A_active = self.A.batch_select(idx) if hasattr(self.A, 'batch_select') else None
+                self.idx_A = idx
+            if self.A_active is None:
+                p_full = torch.zeros_like(self.rhs).index_copy(0, idx, p)
+                return self.batch_AtA(p_full, torch.arange(self.rhs.size()[0], device=p.device))[idx]
+            AtA = lambda z: self.A_active.AtA(z, use_dll2=self.use_dll2)
+        else:
+            AtA = self.AtA
+        if self.echo_cat:
+            Ap = AtA(torch_channel_concate(p, self.necho)) # (batch, 2*echo, row, col)
+            return torch_channel_deconcate(Ap) # (batch, 2, echo, row, col)
+        else:
+            return AtA(p)
+
+    def batch_CG_body(self, i, rTy, x, r, p, active):
+        '''
+            one (preconditioned) CG iteration on the active (not yet converged) samples,
+            converged samples are frozen
+        '''
+        idx = torch.nonzero(active, as_tuple=False).view(-1)
+        p_a = p[idx]
+        Ap = self.batch_AtA(p_a, idx)
+        alpha = rTy[idx] / torch.sum(mlpy_in_cg(conj_in_cg(p_a), Ap), dim=(1, 2, 3, 4))
+        alpha = alpha[:, None, None, None, None]
+
+        x = x.index_copy(0, idx, x[idx] + p_a * alpha)
+        r_a = r[idx] - Ap * alpha
+        r = r.index_copy(0, idx, r_a)
+        y_a = self.preconditioner(r_a, idx) if self.flag_precond else r_a
+        rTyNew = rTy.index_copy(0, idx, torch.sum(mlpy_in_cg(conj_in_cg(r_a), y_a), dim=(1, 2, 3, 4)))
+
+        beta = rTyNew[idx] / rTy[idx]
+        p = p.index_copy(0, idx, y_a + p_a * beta[:, None, None, None, None])
+        return i+1, rTyNew, x, r, p
+
     def while_cond(self, i, rTr, max_iter=10):
         return (i<max_iter) and (rTr>1e-10)
 
-    def CG_iter(self, max_iter=10):
-        x = torch.zeros(self.rhs.shape).to(self.device)
+    def batch_CG_iter(self, max_iter=10):
+        '''
+            CG with per-sample step sizes and stopping, slices of a batch stop independently;
+            self.niters: (batch,) number of iterations of each sample,
+            self.rTr_history: list of (batch,) squared residual norms, one per iteration
+        '''
+        x = torch.zeros_like(self.rhs)
+        i, r = 0, self.rhs
+        p = self.preconditioner(r) if self.flag_precond else r
+        rTy = torch.sum(mlpy_in_cg(conj_in_cg(r), p), dim=(1, 2, 3, 4))  # (batch,)
+        rTr = torch.sum(mlpy_in_cg(conj_in_cg(r), r), dim=(1, 2, 3, 4))
+        if self.tol > 0:
+            threshold = rTr.detach() * self.tol**2
+        else:
+            threshold = torch.ones(rTr.shape, device=rTr.device) * 1e-10
+        self.idx_A = None
+        self.niters = torch.zeros(rTr.shape, dtype=torch.long, device=rTr.device)
+        self.rTr_history = [rTr.detach()]
+        active = rTr.detach() > threshold
+        while (i < max_iter) and bool(active.any()):
+            i, rTy, x, r, p = self.batch_CG_body(i, rTy, x, r, p, active)
+            rTr = rTy if not self.flag_precond else torch.sum(mlpy_in_cg(conj_in_cg(r), r), dim=(1, 2, 3, 4))
+            self.niters += active.long()
+            self.rTr_history.append(rTr.detach())
+            active = active & (rTr.detach() > threshold)
+        return x
 
+    def implicit_CG_iter(self, max_iter=10):
+        '''
+            CG solution x = M^-1 rhs (M = AtA) computed without recording the iterations;
+            the gradients w.r.t. rhs, lambda_dll2 and the operator come from one adjoint CG solve
+            in the backward pass (CG_adjoint), so memory does not grow with max_iter
+        '''
+        with torch.no_grad():
+            self.flag_implicit = 0
+            x = self.CG_iter(max_iter)
+            self.flag_implicit = 1
+        if self.echo_cat:
+            Ax = torch_channel_deconcate(self.AtA(torch_channel_concate(x, self.necho))) # (batch, 2, echo, row, col)
+        else:
+            Ax = self.AtA(x)
+        return x + CG_adjoint.apply(self.rhs - Ax, self, max_iter)
+
+    def static_CG_iter(self, max_iter=10):
+        '''
+            CG_iter with exactly max_iter (preconditioned) iterations and the stopping criterion rTr > 1e-10
+            applied with torch.where, so that the graph does not depend on the data (torch.jit.trace of
+            the inference); the iterations after convergence leave x unchanged
+        '''
+        x = torch.zeros_like(self.rhs)
         if self.flag_precond == 0:
+            r, p = self.rhs, self.rhs
+            rTr = torch.sum(mlpy_in_cg(conj_in_cg(r), r))
+            for i in range(max_iter):
+                active = rTr > 1e-10
+                _, rTrNew, xNew, rNew, pNew = self.CG_body(i, rTr, x, r, p)
+                rTr, x, r, p = [torch.where(active, new, old) for new, old in zip([rTrNew, xNew, rNew, pNew], [rTr, x, r, p])]
+        else:
+            r = -self.rhs
+            y = self.preconditioner(r)
+            p = -y
+            rTy = torch.sum(mlpy_in_cg(conj_in_cg(r), y), dim=(0, 2, 3, 4))  #(2,) tensor
+            rTr = torch.sum(mlpy_in_cg(conj_in_cg(r), r))
+            for i in range(max_iter):
+                active = rTr > 1e-10
+                _, rTyNew, xNew, rNew, yNew, pNew = self.precond_CG_body(i, rTy, x, r, y, p)
+                rTrNew = torch.sum(mlpy_in_cg(conj_in_cg(rNew), rNew))
+                rTr, rTy, x, r, y, p = [torch.where(active, new, old) for new, old in zip([rTrNew, rTyNew, xNew, rNew, yNew, pNew], [rTr, rTy, x, r, y, p])]
+        return x
+
+    def CG_iter(self, max_iter=10):
+        '''
+            CG solution of AtA x = rhs, with the operators and the CG reductions in fp32
+            when called under the autocast of AMP (flag_amp in the main scripts)
+        '''
+        with autocast(enabled=False):
+            return self.CG_solve(max_iter)
+
+    def CG_solve(self, max_iter=10):
+        if self.flag_implicit:
+            return self.implicit_CG_iter(max_iter)
+        elif self.flag_static:
+            return self.static_CG_iter(max_iter)
+        elif self.flag_batch_cg:
+            return self.batch_CG_iter(max_iter)
+        elif self.flag_precond == 0:
+            x = torch.zeros_like(self.rhs)
             i, r, p = 0, self.rhs, self.rhs
             rTr = torch.sum(mlpy_in_cg(conj_in_cg(r), r))
             while self.while_cond(i, rTr, max_iter):
                 i, rTr, x, r, p = self.CG_body(i, rTr, x, r, p)
             return x
-        elif self.flag_precond == 1:
+        else:
+            x = torch.zeros_like(self.rhs)
             i, r = 0, -self.rhs
-            y = mlpy_in_cg(self.M_inv, r)
+            y = self.preconditioner(r)
             p = -y
             rTy = torch.sum(mlpy_in_cg(conj_in_cg(r), y), dim=(0, 2, 3, 4))  #(2,) tensor
             rTr = torch.sum(mlpy_in_cg(conj_in_cg(r), r))
@@ -0,0 +1,137 @@
+"""
+    Preconditioners of the multi-echo CG data consistency layer (DC_layer_multiEcho).
+    Each preconditioner is called as y = P^-1(r, idx) on residuals r of size (batch, 2, echo, row, col),
+    idx selects the samples of the batch r belongs to (batched CG), None for the whole batch.
+"""
+import torch
+from utils.data import *
+from utils.operators import fft_shift_col
+
+
+class Precond_learned():
+    '''
+        elementwise preconditioner from the CNN output C^-1 of Resnet_with_DC2, P^-1 = C^-HC^-1
+    '''
+    def __init__(self, precond):
+        # precond: C^-1, size: (batch, 2, echo, row, col)
+        self.M_inv = precond[:, 0:1, ...]*precond[:, 0:1, ...] + precond[:, 1:2, ...]*precond[:, 1:2, ...]
+
+    def __call__(self, r, idx=None):
+        M_inv = self.M_inv if idx is None else self.M_inv[idx]
+        return M_inv * r
+
+
+class Precond_operator():
+    '''
+        base class of the analytic preconditioners, computed from the forward operator A
+        (Back_forward_multiEcho) in its GE k-space convention; for Siemens data the residual
+        is mapped to that convention and back as in A.AhA, subclasses define apply(r, idx)
+    '''
+    def __init__(self, A, use_dll2=1):
+        self.scanner = A.scanner
+        self.ncols = A.ncols
+        # the l2-x0 regularization adds lambda to the diagonal, the TV ones are left out
+        if use_dll2 == 1:
+            if A.rank > 0:
+                raise ValueError('No analytic preconditioner of the low rank regularization (rank > 0)')
+            self.lambda_dll2 = self.echo_lambda(A.lambda_dll2.detach(), A.nechos)
+        else:
+            self.lambda_dll2 = 0
+        # coil sensitivity power sum_coil |csm|^2: (batch, echo or 1, row, col)
+        self.csm_power = torch.sum(A.csm.detach()**2, dim=(1, 5))
+
+    def echo_lambda(self, lambda_dll2, necho):
+        '''
+            lambda_dll2 of each echo, (1, echo, 1, 1), split as in A.AtA: one lambda for all echos,
+            or lambda_dll2[0] for the first echos and lambda_dll2[1:] for the last one (size 2) or two (size 3)
+        '''
+        nlast = lambda_dll2.size()[0] - 1
+        lambdas = torch.cat((lambda_dll2[0:1].expand(necho - nlast), lambda_dll2[1:]))
+        return lambdas.view(1, necho, 1, 1)
+
+    def to_operator(self, r):
+        if self.scanner == 1:
+            r = torch.flip(r, dims=[4])  # for Siemens data
+            r = fft_shift_col(r, self.ncols, 1)  # for Siemens data
+            r = torch.cat((r[:, 0:1, ...], -r[:, 1:2, ...]), dim=1)  # for Siemens data
+        return r
+
+    def from_operator(self, y):
+        if self.scanner == 1:
+            y = fft_shift_col(y, self.ncols, 1)  # for Siemens data
+            y = torch.flip(y, dims=[4])  # for Siemens data
+            y = torch.cat((y[:, 0:1, ...], -y[:, 1:2, ...]), dim=1)  # for Siemens data
+        return y
+
+    def select(self, x, idx):
+        '''
+            samples idx of a per-sample buffer (buffers shared by the batch have batch size 1)
+        '''
+        if idx is None or x.size()[0] == 1:
+            return x
+        return x[idx]
+
+    def __call__(self, r, idx=None):
+        return self.from_operator(self.apply(self.to_operator(r), idx))
+
+
+class Precond_jacobi(Precond_operator):
+    '''
+        diagonal (Jacobi) preconditioner, the diagonal of A^H M A is the sampling density
+        of the mask times the coil sensitivity power sum_coil |csm|^2
+    '''
+    def __init__(self, A, use_dll2=1):
+        super(Precond_jacobi, self).__init__(A, use_dll2)
+        density = torch.mean(A.mask[..., 0].detach(), dim=(1, 3, 4))  # (1, echo)
+        diag = density[..., None, None] * self.csm_power + self.lambda_dll2  # (batch, echo, row, col)
+        self.M_inv = 1 / diag[:, None, ...]  # (batch, 1, echo, row, col)
+
+    def apply(self, r, idx):
+        return self.select(self.M_inv, idx) * r
+
+
+class Precond_circulant(Precond_operator):
+    '''
+        optimal circulant (T. Chan) preconditioner of A^H M A, whose eigenvalues are the
+        sampling mask correlated with the coil power spectrum sum_coil |F(csm*flip)|^2, i.e.
+        the point spread function of the mask blurred by the coil sensitivities
+        (the row shifts of the GE convention cancel for even nrows)
+    '''
+    def __init__(self, A, use_dll2=1):
+        super(Precond_circulant, self).__init__(A, use_dll2)
+        if A.precompute:
+            csm_flip = A.csm_flip.detach()
+        else:
+            csm_flip = cplx_mlpy(A.csm.detach(), A.flip[:, None, ...])
+        nvoxels = A.nrows * A.ncols
+        spectrum = torch.sum(torch.fft(csm_flip, 2)**2, dim=(1, 5)) / nvoxels**2  # (batch, echo or 1, row, col)
+        mask = A.mask[:, 0, ..., 0].detach()  # (1, echo, row, col)
+        # eig(k) = sum_k' mask(k') spectrum(k' - k), as a circular convolution with spectrum(-k)
+        eig = cplx_mlpy(torch.fft(torch.stack((mask, torch.zeros_like(mask)), -1), 2),
+                        cplx_conj(torch.fft(torch.stack((spectrum, torch.zeros_like(spectrum)), -1), 2)))
+        eig = torch.ifft(eig, 2)[..., 0]  # (batch, echo, row, col)
+        self.kernel_inv = 1 / (eig + self.lambda_dll2)
+
+    def apply(self, r, idx):
+        temp = torch.fft(r.permute(0, 2, 3, 4, 1), 2)  # (batch, echo, row, col, 2)
+        temp = temp * self.select(self.kernel_inv, idx)[..., None]
+        return torch.ifft(temp, 2).permute(0, 4, 1, 2, 3)  # (batch, 2, echo, row, col)
+
+
+preconditioners = {
+    2: Precond_jacobi,
+    3: Precond_circulant
+}
+
+
+def analytic_preconditioner(A, flag_precond, use_dll2=1):
+    '''
+        Jacobi (flag_precond = 2) or circulant (flag_precond = 3) preconditioner of A.AtA,
+        cached on the operator so that all DC layers (unrolls) sharing A reuse it
+    '''
+    if not hasattr(A, 'preconds'):
+        A.preconds = {}
+    key = (flag_precond, use_dll2)
+    if key not in A.preconds:
+        A.preconds[key] = preconditioners[flag_precond](A, use_dll2)
+    return A.preconds[key]
@@ -20,6 +20,7 @@ from models.BCLSTM import BCLSTMlayer
 from fits.fits import fit_R2_LM, fit_complex, arlo
 from utils.data import *
 from utils.operators import *
+from utils.operators_complex import Back_forward_multiEcho_complex, backward_multiEcho_complex
 from torch.utils.checkpoint import checkpoint
 
 
@@ -46,7 +47,7 @@ class Resnet_with_DC(nn.Module):
         self.lambda_dll2 = nn.Parameter(torch.ones(1)*lambda_dll2, requires_grad=True)
 
     def forward(self, x, csms, masks):
-        device = x.get_device()
+        device = x.device
         x_start = x
         # self.lambda_dll2 = self.lambda_dll2.to(device)
         A = backward_forward_CardiacQSM(csms, masks, self.lambda_dll2)
@@ -86,7 +87,7 @@ class Resnet_with_DC2(nn.Module):
         flag_2D=1,  # flag to use 2D undersampling (variable density)
         flag_solver=0,  # 0 for deep Quasi-newton, 1 for deep ADMM,
                         # 2 for TV Quasi-newton, 3 for TV ADMM.
-        flag_precond=0, # flag to use the preconditioner in the CG layer
+        flag_precond=0, # preconditioner in the CG layer, 0: none, 1: learned (CNN), 2: Jacobi, 3: circulant
         flag_loupe=0, # 1: same mask across echos, 2: mask for each echo
         flag_temporal_pred=0,  # predict the later echo images from the former echos
         norm_last=0, # put normalization after relu
@@ -109,6 +110,15 @@ class Resnet_with_DC2(nn.Module):
         # random=0, # flag to multiply the input data with a random complex number
         flag_cp=0,
         flag_dataset=1,  # 1: 'CBIC', 0: 'MS'
+        flag_cplx_engine=0,  # 1: run the multi-echo operators with native complex64 tensors
+        flag_batch_cg=0,  # 1: CG with per-sample step sizes and convergence in the DC layers
+        cg_tol=0,  # relative residual tolerance of each sample in batched CG (0: rTr > 1e-10)
+        cg_max_iter=10,  # maximal number of CG iterations in each DC layer
+        flag_implicit_cg=0,  # 1: backpropagate through the DC layers with an adjoint CG solve instead of the unrolled iterations
+        cp_blocks=['bcrnn', 'denoiser'],  # blocks checkpointed with flag_cp = 1: 'bcrnn', 'denoiser' (CNN/unet/ResBlock), 'dc' (CG solve)
+        cp_every=1,  # checkpoint the blocks of every cp_every-th unroll (from the first one)
+        cp_unrolls=None,  # list of the (0-based) unrolls to checkpoint, overrides cp_every
+        flag_static_cg=0,  # 1: max_iter CG iterations in each DC layer without python control flow on the data (traced inference)
     ):
         super(Resnet_with_DC2, self).__init__()
         self.resnet_block = []
@@ -141,6 +151,26 @@ class Resnet_with_DC2(nn.Module):
         # self.random = random
         self.flag_cp = flag_cp
         self.flag_dataset = flag_dataset
+        self.flag_cplx_engine = flag_cplx_engine
+        self.flag_batch_cg = flag_batch_cg
+        self.cg_tol = cg_tol
+        self.cg_max_iter = cg_max_iter
+        self.flag_implicit_cg = flag_implicit_cg
+        self.flag_static_cg = flag_static_cg
+        self.cg_niters = []  # per-sample CG iterations of each DC layer in the last forward (flag_batch_cg = 1)
+        self.set_checkpointing(cp_blocks, cp_every, cp_unrolls)
+        if self.flag_cp:
+            print('Checkpointing of {} in unrolls {}'.format(', '.join(self.cp_blocks),
+                  self.cp_unrolls if self.cp_unrolls is not None else 'i % {} == 0'.format(self.cp_every)))
+
+        # operator backend
+        if self.flag_cplx_engine:
+            print('Use native complex operators')
+            self.Back_forward_multiEcho = Back_forward_multiEcho_complex
+            self.backward_multiEcho = backward_multiEcho_complex
+        else:
+            self.Back_forward_multiEcho = Back_forward_multiEcho
+            self.backward_multiEcho = backward_multiEcho
 
         if self.flag_solver <= 1:
             if self.flag_BCRNN == 0:
@@ -281,6 +311,10 @@ class Resnet_with_DC2(nn.Module):
         self.K = K
         self.U = U
         self.rank = rank
+        if self.rank > 0:
+            self.projector = Subspace_projector(U=U, rank=rank)  # Ur*Ur^H shared by all forward passes
+        else:
+            self.projector = None
         self.flag_compressor = flag_compressor
         self.lambda_lowrank = nn.Parameter(torch.ones(1)*lambda_dll2, requires_grad=True)
 
@@ -336,7 +370,7 @@ class Resnet_with_DC2(nn.Module):
             # keep central calibration region to 1
             masks[self.nrow//2-9:self.nrow//2+9, self.ncol//2-9:self.ncol//2+9, :] = 1
             # to complex data
-            masks = torch.cat((masks, torch.zeros(masks.shape).to('cuda')),-1) # (nrow, ncol, 2)
+            masks = torch.cat((masks, torch.zeros_like(masks)),-1) # (nrow, ncol, 2)
             # add echo dimension
             masks = masks[None, ...] # (1, nrow, ncol, 2)
             masks = torch.cat(self.necho*[masks]) # (necho, nrow, ncol, 2)
@@ -351,7 +385,7 @@ class Resnet_with_DC2(nn.Module):
             # keep central calibration region to 1
             masks[:, self.nrow//2-9:self.nrow//2+9, self.ncol//2-9:self.ncol//2+9, :] = 1
             # to complex data
-            masks = torch.cat((masks, torch.zeros(masks.shape).to('cuda')),-1) # (necho, nrow, ncol, 2)
+            masks = torch.cat((masks, torch.zeros_like(masks)),-1) # (necho, nrow, ncol, 2)
             # add coil dimension
             masks = masks[None, ...] # (1, necho, nrow, ncol, 2)
             masks = torch.cat(self.ncoil*[masks]) # (ncoil, necho, nrow, ncol, 2)
@@ -385,7 +419,7 @@ class Resnet_with_DC2(nn.Module):
             if self.stochasticSampling:
                 Mask = bernoulliSample.apply(Pmask_rescaled)
             else:
-                thresh = torch.rand(Pmask_rescaled.shape).to('cuda')
+                thresh = torch.rand_like(Pmask_rescaled)
                 Mask = 1/(1+torch.exp(-12*(Pmask_rescaled-thresh)))
         else:
             if self.stochasticSampling:
@@ -395,7 +429,7 @@ class Resnet_with_DC2(nn.Module):
                 else:
                     Mask = Mask1D[..., None].repeat(1, 1, self.ncol)
             else:
-                thresh = torch.rand(Pmask_rescaled.shape).to('cuda')
+                thresh = torch.rand_like(Pmask_rescaled)
                 Mask1D = 1/(1+torch.exp(-12*(Pmask_rescaled-thresh)))
                 if self.flag_loupe == 1:
                     Mask = Mask1D[..., None].repeat(1, self.ncol)
@@ -403,6 +437,60 @@ class Resnet_with_DC2(nn.Module):
                     Mask = Mask1D[..., None].repeat(1, 1, self.ncol)
         return Mask
 
+    def set_checkpointing(self, blocks, every=1, unrolls=None):
+        '''
+            checkpointing policy of flag_cp = 1: the activations of the blocks ('bcrnn', 'denoiser', 'dc')
+            of the selected unrolls are recomputed in the backward pass instead of being stored
+        '''
+        blocks = list(blocks)
+        if 'dc' in blocks and (self.flag_loupe > 0 or self.flag_precond == 1):
+            # the DC layers see the learned masks / preconditioner through the operator,
+            # whose graph would be backpropagated twice by the recomputation
+            print('No checkpointing of the DC layers with learned masks or preconditioner')
+            blocks.remove('dc')
+        self.cp_blocks = blocks
+        self.cp_every = every
+        self.cp_unrolls = None if unrolls is None else list(unrolls)
+
+    def checkpointed(self, block, i):
+        if not self.flag_cp or block not in self.cp_blocks:
+            return False
+        if self.cp_unrolls is not None:
+            return i in self.cp_unrolls
+        return i % self.cp_every == 0
+
+    def run_block(self, block, i, function, *inputs):
+        '''
+            function(*inputs) of block in unroll i, checkpointed if selected by the policy and if any input requires grad
+        '''
+        if self.checkpointed(block, i) and any(x.requires_grad for x in inputs):
+            if block == 'bcrnn' and self.flag_multi_level:
+                # multi-level features as a tuple of tensors for the checkpoint
+                return list(checkpoint_amp(lambda *x: tuple(function(*x)), *inputs))
+            return checkpoint_amp(function, *inputs)
+        return function(*inputs)
+
+    def CNN_block(self, x0):
+        '''
+            conv1_x..conv4_x denoiser of the BCRNN features
+        '''
+        x1 = self.relu(self.bn1_x(self.conv1_x(x0)))
+        x2 = self.relu(self.bn2_x(self.conv2_x(x1)))
+        x3 = self.relu(self.bn3_x(self.conv3_x(x2)))
+        return self.conv4_x(x3)
+
+    def DC_block(self, i, dc_layer):
+        '''
+            CG solve of dc_layer in unroll i, with dc_layer.rhs as the checkpoint input
+        '''
+        def CG_solve(rhs):
+            dc_layer.rhs = rhs
+            return dc_layer.CG_iter(max_iter=self.cg_max_iter)
+        x = self.run_block('dc', i, CG_solve, dc_layer.rhs)
+        if self.flag_batch_cg:
+            self.cg_niters.append(dc_layer.niters)
+        return x
+
     def forward(self, kdatas, csms, csm_lowres, masks, flip, test=False, x_input=None):
         # generate sampling mask
         if self.flag_loupe == 1:
@@ -417,7 +505,7 @@ class Resnet_with_DC2(nn.Module):
             self.Mask = masks[0, 0, 0, :, :, 0]
         # input
         if self.flag_dataset:
-            x = backward_multiEcho(kdatas, csms, masks, flip, self.echo_cat, self.necho, self.flag_scanner)
+            x = self.backward_multiEcho(kdatas, csms, masks, flip, self.echo_cat, self.necho, self.flag_scanner)
             # if self.rank:
             #     x = backward_multiEcho_compressor(kdatas, csms, masks, flip, self.U, self.rank,
             #                                       self.flag_compressor, self.echo_cat, self.necho)
@@ -446,12 +534,13 @@ class Resnet_with_DC2(nn.Module):
             self.precond = precond
         else:
             self.precond = 0
+        self.cg_niters = []
 
         # Deep Quasi-newton
         if self.flag_solver == 0:
             if self.flag_BCRNN == 0:
                 if self.flag_dataset:
-                    A = Back_forward_multiEcho(csms, masks, flip, self.lambda_dll2, echo_cat=self.echo_cat, necho=self.necho, scanner=self.flag_scanner)
+                    A = self.Back_forward_multiEcho(csms, masks, flip, self.lambda_dll2, echo_cat=self.echo_cat, necho=self.necho, scanner=self.flag_scanner)
                 else:
                     A = Back_forward_MS(csms, masks, flip, self.lambda_dll2, echo_cat=self.echo_cat, necho=self.necho)
                 Xs = []
@@ -474,7 +563,7 @@ class Resnet_with_DC2(nn.Module):
                     #     else:
                     #         x_block = self.resnet_block(x)
 
-                    x_block = self.resnet_block(x)
+                    x_block = self.run_block('denoiser', i, self.resnet_block, x)
                     x_block1 = x - x_block
 
                     # if self.random:
@@ -486,8 +575,10 @@ class Resnet_with_DC2(nn.Module):
 
                     rhs = x_start + self.lambda_dll2*x_block1
                     dc_layer = DC_layer_multiEcho(A, rhs, echo_cat=self.echo_cat, necho=self.necho,
-                                                  flag_precond=self.flag_precond, precond=self.precond)
-                    x = dc_layer.CG_iter()
+                                                  flag_precond=self.flag_precond, precond=self.precond,
+                                                  flag_batch_cg=self.flag_batch_cg, tol=self.cg_tol, flag_implicit=self.flag_implicit_cg,
+                                                  flag_static=self.flag_static_cg)
+                    x = self.DC_block(i, dc_layer)
 
                     if self.echo_cat:
                         x = torch_channel_concate(x, self.necho)
@@ -496,18 +587,9 @@ class Resnet_with_DC2(nn.Module):
             elif self.flag_BCRNN > 0:
                 x = torch_channel_deconcate(x).permute(0, 1, 3, 4, 2)  # (n, 2, nx, ny, n_seq)
                 x = x.contiguous()
-                net = {}
                 n_batch, n_ch, width, height, n_seq = x.size()
-                size_h = [n_seq*n_batch, self.nf, width, height]
-                if test:
-                    with torch.no_grad():
-                        hid_init = Variable(torch.zeros(size_h)).cuda()
-                else:
-                    hid_init = Variable(torch.zeros(size_h)).cuda()
-                for j in range(self.nd-1):
-                    net['t0_x%d'%j]=hid_init
                 if self.flag_dataset:
-                    A = Back_forward_multiEcho(csms, masks, flip, self.lambda_dll2, echo_cat=self.echo_cat, necho=self.necho, scanner=self.flag_scanner)
+                    A = self.Back_forward_multiEcho(csms, masks, flip, self.lambda_dll2, echo_cat=self.echo_cat, necho=self.necho, scanner=self.flag_scanner)
                 else:
                     A = Back_forward_MS(csms, masks, flip, self.lambda_dll2, echo_cat=self.echo_cat, necho=self.necho)
                 Xs = []
@@ -517,51 +599,32 @@ class Resnet_with_DC2(nn.Module):
                     x_ = x_.contiguous()
                     # net['t%d_x0'%(i-1)] = net['t%d_x0'%(i-1)].view(n_seq, n_batch, self.nf, width, height)
                     # net['t%d_x0'%i] = self.bcrnn(x_, net['t%d_x0'%(i-1)], test)
-                    if x_.requires_grad and self.flag_cp:
-                        net['t%d_x0'%i] = checkpoint(self.bcrnn, x_)
-                    else:
-                        net['t%d_x0'%i] = self.bcrnn(x_, test)
+                    feat = self.run_block('bcrnn', i-1, lambda x_: self.bcrnn(x_, test), x_)
                     if self.flag_att == 1:
                         # net['t%d_x0'%i] = net['t%d_x0'%i].permute(1, 2, 0, 3, 4)  # (nt, 1, nf, nx, ny) to (1, nf, nt, nx, ny)
                         # net['t%d_x0'%i] = self.attBlock(net['t%d_x0'%i])
                         # net['t%d_x0'%i] = net['t%d_x0'%i].permute(2, 0, 1, 3, 4)  # (1, nf, nt, nx, ny) to (nt, 1, nf, nx, ny)
                         
-                        net['t%d_x0'%i] = net['t%d_x0'%i].permute(1, 0, 2, 3, 4).view(n_batch, n_seq, self.nf, width*height)  # (nt, 1, nf, nx, ny) to (1, nt, nf, nx*ny)
-                        net['t%d_x0'%i] = self.attBlock(net['t%d_x0'%i])
-                        net['t%d_x0'%i].view(n_batch, n_seq, self.nf, width, height).permute(1, 0, 2, 3, 4)
-
-                    net['t%d_x0'%i] = net['t%d_x0'%i].view(-1, self.nf, width, height)
-
-                    net['t%d_x1'%i] = self.conv1_x(net['t%d_x0'%i])
-                    net['t%d_x1'%i] = self.bn1_x(net['t%d_x1'%i])
-                    # net['t%d_h1'%i] = self.conv1_h(net['t%d_x1'%(i-1)])
-                    # net['t%d_x1'%i] = self.relu(net['t%d_h1'%i]+net['t%d_x1'%i])
-                    net['t%d_x1'%i] = self.relu(net['t%d_x1'%i])
+                        feat = feat.permute(1, 0, 2, 3, 4).view(n_batch, n_seq, self.nf, width*height)  # (nt, 1, nf, nx, ny) to (1, nt, nf, nx*ny)
+                        feat = self.attBlock(feat)
+                        feat.view(n_batch, n_seq, self.nf, width, height).permute(1, 0, 2, 3, 4)
 
-                    net['t%d_x2'%i] = self.conv2_x(net['t%d_x1'%i])
-                    net['t%d_x2'%i] = self.bn2_x(net['t%d_x2'%i])
-                    # net['t%d_h2'%i] = self.conv2_h(net['t%d_x2'%(i-1)])
-                    # net['t%d_x2'%i] = self.relu(net['t%d_h2'%i]+net['t%d_x2'%i])
-                    net['t%d_x2'%i] = self.relu(net['t%d_x2'%i])
+                    feat = feat.view(-1, self.nf, width, height)
 
-                    net['t%d_x3'%i] = self.conv3_x(net['t%d_x2'%i])
-                    net['t%d_x3'%i] = self.bn3_x(net['t%d_x3'%i])
-                    # net['t%d_h3'%i] = self.conv3_h(net['t%d_x3'%(i-1)])
-                    # net['t%d_x3'%i] = self.relu(net['t%d_h3'%i]+net['t%d_x3'%i])
-                    net['t%d_x3'%i] = self.relu(net['t%d_x3'%i])
-
-                    net['t%d_x4'%i] = self.conv4_x(net['t%d_x3'%i])
+                    res = self.run_block('denoiser', i-1, self.CNN_block, feat)
 
                     x_ = x_.view(-1, n_ch, width, height)
-                    net['t%d_out'%i] = x_ - net['t%d_x4'%i]
+                    out = x_ - res
 
                     # update x using CG block
-                    x0 = net['t%d_out'%i] # (n_seq, 2, nx, ny)
-                    x0_ = torch_channel_concate(x0[None, ...].permute(0, 2, 1, 3, 4), self.necho).contiguous()
+                    x0 = out # (n_seq*n, 2, nx, ny)
+                    x0_ = torch_channel_concate(x0.view(n_seq, n_batch, n_ch, width, height).permute(1, 2, 0, 3, 4), self.necho).contiguous()
                     rhs = x_start + self.lambda_dll2*x0_
                     dc_layer = DC_layer_multiEcho(A, rhs, echo_cat=self.echo_cat, necho=self.necho,
-                                                  flag_precond=self.flag_precond, precond=self.precond)
-                    x = dc_layer.CG_iter()
+                                                  flag_precond=self.flag_precond, precond=self.precond,
+                                                  flag_batch_cg=self.flag_batch_cg, tol=self.cg_tol, flag_implicit=self.flag_implicit_cg,
+                                                  flag_static=self.flag_static_cg)
+                    x = self.DC_block(i-1, dc_layer)
                     if self.echo_cat:
                         x = torch_channel_concate(x, self.necho)
                     if self.flag_temporal_pred:
@@ -569,16 +632,16 @@ class Resnet_with_DC2(nn.Module):
                         Xs.append(torch.cat((x, x_last_echos), 1))
                     else:
                         Xs.append(x)
-                    x = torch_channel_deconcate(x).permute(0, 2, 1, 3, 4).view(-1, n_ch, width, height) # (n_seq, 2, nx, ny)
-                    x = x[None, ...].permute(0, 2, 3, 4, 1).contiguous()
+                    x = torch_channel_deconcate(x).permute(0, 1, 3, 4, 2).contiguous()  # (n, 2, nx, ny, n_seq)
                 return Xs
         # Deep ADMM
         elif self.flag_solver == 1:
             if self.flag_BCRNN == 0:
                 if self.flag_dataset:
-                    A = Back_forward_multiEcho(csms, masks, flip, self.lambda_dll2, 
+                    A = self.Back_forward_multiEcho(csms, masks, flip, self.lambda_dll2, 
                                             self.lambda_lowrank, self.echo_cat, self.necho,
-                                            kdata=kdatas, csm_lowres=csm_lowres, U=self.U, rank=self.rank, scanner=self.flag_scanner)
+                                            kdata=kdatas, csm_lowres=csm_lowres, U=self.U, rank=self.rank, scanner=self.flag_scanner,
+                                            projector=self.projector)
                     # if self.rank:
                     #     A = Back_forward_multiEcho_compressor(csms, masks, flip, self.lambda_dll2, 
                     #                         self.echo_cat, self.necho, kdata=kdatas, 
@@ -588,17 +651,19 @@ class Resnet_with_DC2(nn.Module):
                                         self.lambda_lowrank, self.echo_cat, self.necho,
                                         kdata=kdatas, csm_lowres=csm_lowres, rank=self.rank)
                 Xs = []
-                uk = torch.zeros(x_start.size()).to('cuda')
+                uk = torch.zeros_like(x_start)
                 for i in range(self.K):
                     # update auxiliary variable v
-                    v_block = self.resnet_block(x+uk/self.lambda_dll2)
+                    v_block = self.run_block('denoiser', i, self.resnet_block, x+uk/self.lambda_dll2)
                     v_block1 = x + uk/self.lambda_dll2 - v_block
                     # update x using CG block
                     x0 = v_block1 - uk/self.lambda_dll2
                     rhs = x_start + self.lambda_dll2*x0
                     dc_layer = DC_layer_multiEcho(A, rhs, echo_cat=self.echo_cat, necho=self.necho,
-                                                  flag_precond=self.flag_precond, precond=self.precond)
-                    x = dc_layer.CG_iter()
+                                                  flag_precond=self.flag_precond, precond=self.precond,
+                                                  flag_batch_cg=self.flag_batch_cg, tol=self.cg_tol, flag_implicit=self.flag_implicit_cg,
+                                                  flag_static=self.flag_static_cg)
+                    x = self.DC_block(i, dc_layer)
                     if self.echo_cat:
                         x = torch_channel_concate(x, self.necho)
                     Xs.append(x)
@@ -610,7 +675,7 @@ class Resnet_with_DC2(nn.Module):
                 if self.necho_pred > 0:
                     with torch.no_grad():
                         x_under = x.contiguous().permute(0, 2, 3, 1, 4)[..., :self.necho]
-                        x_pred = torch.zeros(1, 2, self.nrow, self.ncol, self.necho_pred).to('cuda')
+                        x_pred = x.new_zeros(1, 2, self.nrow, self.ncol, self.necho_pred)
                         [_, water] = fit_R2_LM(x_under)
                         r2s = arlo(range(self.necho), torch.sqrt(x_under[:, :, :, 0, :]**2 + x_under[:, :, :, 1, :]**2))
                         [p1, p0] = fit_complex(x_under)
@@ -625,21 +690,13 @@ class Resnet_with_DC2(nn.Module):
                     x[torch.isnan(x)] = 0
                     x[x > 1] = 0
                 x = x.contiguous()
-                net = {}
                 n_batch, n_ch, width, height, n_seq = x.size()
                 n_seq = self.necho + self.necho_pred
-                size_h = [n_seq*n_batch, self.nf, width, height]
-                if test:
-                    with torch.no_grad():
-                        hid_init = Variable(torch.zeros(size_h)).cuda()
-                else:
-                    hid_init = Variable(torch.zeros(size_h)).cuda()
-                for j in range(self.nd-1):
-                    net['t0_x%d'%j]=hid_init
                 if self.flag_dataset:
-                    A = Back_forward_multiEcho(csms, masks, flip, self.lambda_dll2, 
+                    A = self.Back_forward_multiEcho(csms, masks, flip, self.lambda_dll2, 
                                             self.lambda_lowrank, self.echo_cat, self.necho,
-                                            kdata=kdatas, csm_lowres=csm_lowres, U=self.U, rank=self.rank, scanner=self.flag_scanner)
+                                            kdata=kdatas, csm_lowres=csm_lowres, U=self.U, rank=self.rank, scanner=self.flag_scanner,
+                                            projector=self.projector)
                     # if self.rank:
                     #     A = Back_forward_multiEcho_compressor(csms, masks, flip, self.lambda_dll2, 
                     #                         self.echo_cat, self.necho, kdata=kdatas, 
@@ -649,13 +706,13 @@ class Resnet_with_DC2(nn.Module):
                                         self.lambda_lowrank, self.echo_cat, self.necho,
                                         kdata=kdatas, csm_lowres=csm_lowres, rank=self.rank)
                 Xs = []
-                uk = torch.zeros(n_batch, n_ch, width, height, n_seq).to('cuda')
+                uk = x.new_zeros(n_batch, n_ch, width, height, n_seq)
                 for i in range(1, self.K+1):
                     # # predict later echos using the first several echos
                     # if self.necho_pred > 0:
                     #     with torch.no_grad():
                     #         x_under = x.contiguous().permute(0, 2, 3, 1, 4)[..., :self.necho]
-                    #         x_pred = torch.zeros(1, 2, self.nrow, self.ncol, self.necho_pred).to('cuda')
+                    #         x_pred = x.new_zeros(1, 2, self.nrow, self.ncol, self.necho_pred)
                     #         [_, water] = fit_R2_LM(x_under)
                     #         r2s = arlo(range(self.necho), torch.sqrt(x_under[:, :, :, 0, :]**2 + x_under[:, :, :, 1, :]**2)) 
                     #         [p1, p0] = fit_complex(x_under)
@@ -674,63 +731,42 @@ class Resnet_with_DC2(nn.Module):
                     x_ = x_.contiguous()
                     # net['t%d_x0'%(i-1)] = net['t%d_x0'%(i-1)].view(n_seq, n_batch, self.nf, width, height)
                     # net['t%d_x0'%i] = self.bcrnn(x_, net['t%d_x0'%(i-1)], test)
-                    if x_.requires_grad and self.flag_cp and not self.flag_multi_level:
-                        net['t%d_x0'%i] = checkpoint(self.bcrnn, x_)
-                    else:
-                        net['t%d_x0'%i] = self.bcrnn(x_, test)
+                    feat = self.run_block('bcrnn', i-1, lambda x_: self.bcrnn(x_, test), x_)
                     if self.flag_att == 1:
                         # net['t%d_x0'%i] = net['t%d_x0'%i].permute(1, 2, 0, 3, 4)  # (nt, 1, nf, nx, ny) to (1, nf, nt, nx, ny)
                         # net['t%d_x0'%i] = self.attBlock(net['t%d_x0'%i])
                         # net['t%d_x0'%i] = net['t%d_x0'%i].permute(2, 0, 1, 3, 4)  # (1, nf, nt, nx, ny) to (nt, 1, nf, nx, ny)
                         
-                        net['t%d_x0'%i] = net['t%d_x0'%i].permute(1, 0, 2, 3, 4).view(n_batch, n_seq, self.nf, width*height)  # (nt, 1, nf, nx, ny) to (1, nt, nf, nx*ny)
-                        net['t%d_x0'%i] = self.attBlock(net['t%d_x0'%i])
-                        net['t%d_x0'%i].view(n_batch, n_seq, self.nf, width, height).permute(1, 0, 2, 3, 4)
+                        feat = feat.permute(1, 0, 2, 3, 4).view(n_batch, n_seq, self.nf, width*height)  # (nt, 1, nf, nx, ny) to (1, nt, nf, nx*ny)
+                        feat = self.attBlock(feat)
+                        feat.view(n_batch, n_seq, self.nf, width, height).permute(1, 0, 2, 3, 4)
                     if not self.flag_complexConv:
-                        net['t%d_x0'%i] = net['t%d_x0'%i].view(-1, self.nf, width, height)
+                        feat = feat.view(-1, self.nf, width, height)
 
                     if self.flag_unet == 0:
-                        net['t%d_x1'%i] = self.conv1_x(net['t%d_x0'%i])
-                        net['t%d_x1'%i] = self.bn1_x(net['t%d_x1'%i])
-                        # net['t%d_h1'%i] = self.conv1_h(net['t%d_x1'%(i-1)])
-                        # net['t%d_x1'%i] = self.relu(net['t%d_h1'%i]+net['t%d_x1'%i])
-                        net['t%d_x1'%i] = self.relu(net['t%d_x1'%i])
-
-                        net['t%d_x2'%i] = self.conv2_x(net['t%d_x1'%i])
-                        net['t%d_x2'%i] = self.bn2_x(net['t%d_x2'%i])
-                        # net['t%d_h2'%i] = self.conv2_h(net['t%d_x2'%(i-1)])
-                        # net['t%d_x2'%i] = self.relu(net['t%d_h2'%i]+net['t%d_x2'%i])
-                        net['t%d_x2'%i] = self.relu(net['t%d_x2'%i])
-
-                        net['t%d_x3'%i] = self.conv3_x(net['t%d_x2'%i])
-                        net['t%d_x3'%i] = self.bn3_x(net['t%d_x3'%i])
-                        # net['t%d_h3'%i] = self.conv3_h(net['t%d_x3'%(i-1)])
-                        # net['t%d_x3'%i] = self.relu(net['t%d_h3'%i]+net['t%d_x3'%i])
-                        net['t%d_x3'%i] = self.relu(net['t%d_x3'%i])
-
-                        net['t%d_x4'%i] = self.conv4_x(net['t%d_x3'%i])
+                        res = self.run_block('denoiser', i-1, self.CNN_block, feat)
 
                     elif self.flag_unet == 1:
-                        if x_.requires_grad and self.flag_cp and not self.flag_multi_level:
-                            net['t%d_x4'%i] = checkpoint(self.denoiser, net['t%d_x0'%i])
-                        else:
-                            net['t%d_x4'%i] = self.denoiser(net['t%d_x0'%i])
+                        res = self.run_block('denoiser', i-1, self.denoiser, feat)
 
                     x_ = x_.view(-1, n_ch, width, height)
                     if self.flag_complexConv:
-                        net['t%d_x4'%i] = net['t%d_x4'%i].view(-1, n_ch, width, height)
-                    net['t%d_out'%i] = x_ - net['t%d_x4'%i]
+                        res = res.view(-1, n_ch, width, height)
+                    out = x_ - res
 
                     # update x using CG block
-                    uk_ = uk.permute(4, 0, 1, 2, 3).view(-1, n_ch, width, height)
-                    x0 = net['t%d_out'%i] - uk_/self.lambda_dll2  # (n_seq, 2, nx, ny)
-                    x0_ = torch_channel_concate(x0[None, ...].permute(0, 2, 1, 3, 4), self.necho+self.necho_pred).contiguous()
+                    uk_ = uk.permute(4, 0, 1, 2, 3).reshape(-1, n_ch, width, height)
+                    x0 = out - uk_/self.lambda_dll2  # (n_seq*n, 2, nx, ny)
+                    x0_ = torch_channel_concate(x0.view(n_seq, n_batch, n_ch, width, height).permute(1, 2, 0, 3, 4),
+                                                self.necho+self.necho_pred).contiguous()
                     rhs = x_start + self.lambda_dll2*x0_[:, :self.necho*2, ...]
                     dc_layer = DC_layer_multiEcho(A, rhs, echo_cat=self.echo_cat, necho=self.necho,
-                                                  flag_precond=self.flag_precond, precond=self.precond)
-                    x = dc_layer.CG_iter()
+                                                  flag_precond=self.flag_precond, precond=self.precond,
+                                                  flag_batch_cg=self.flag_batch_cg, tol=self.cg_tol, flag_implicit=self.flag_implicit_cg,
+                                                  flag_static=self.flag_static_cg)
+                    x = self.DC_block(i-1, dc_layer)
                     if self.necho_pred > 0:
-                        x = torch.cat((x, net['t%d_out'%i][None, self.necho:, ...].permute(0, 2, 1, 3, 4)), dim=2)
+                        x = torch.cat((x, out.view(n_seq, n_batch, n_ch, width, height)[self.necho:].permute(1, 2, 0, 3, 4)), dim=2)
                     if self.echo_cat:
                         x = torch_channel_concate(x, self.necho+self.necho_pred)
                     if self.flag_temporal_pred:
@@ -740,24 +776,29 @@ class Resnet_with_DC2(nn.Module):
                         Xs.append(x)
                         # Xs.append(x0_)
                         # Xs.append(torch_channel_concate(net['t%d_out'%i][None, ...].permute(0, 2, 1, 3, 4), self.necho+self.necho_pred))
-                    x = torch_channel_deconcate(x).permute(0, 2, 1, 3, 4).view(-1, n_ch, width, height) # (n_seq, 2, nx, ny)
+                    x = torch_channel_deconcate(x).permute(2, 0, 1, 3, 4).reshape(-1, n_ch, width, height) # (n_seq*n, 2, nx, ny)
                     # update dual variable uk
-                    uk = uk_ + self.lambda_dll2*(x - net['t%d_out'%i])
+                    uk = uk_ + self.lambda_dll2*(x - out)
 
-                    x = x[None, ...].permute(0, 2, 3, 4, 1).contiguous()
-                    uk = uk[None, ...].permute(0, 2, 3, 4, 1).contiguous()
+                    # (n_seq*n, 2, nx, ny) to (n, 2, nx, ny, n_seq)
+                    x = x.view(n_seq, n_batch, n_ch, width, height).permute(1, 2, 3, 4, 0).contiguous()
+                    uk = uk.view(n_seq, n_batch, n_ch, width, height).permute(1, 2, 3, 4, 0).contiguous()
                 return Xs
 
         # TV Quasi-newton
         elif self.flag_solver == 2:
-            A = Back_forward_multiEcho(csms, masks, flip, 
+            A = self.Back_forward_multiEcho(csms, masks, flip, 
                                     self.lambda_dll2, self.echo_cat, scanner=self.flag_scanner)
             Xs = []
             for i in range(self.K):
                 rhs = x_start - A.AtA(x, use_dll2=3)
                 dc_layer = DC_layer_multiEcho(A, rhs, echo_cat=self.echo_cat,
-                    flag_precond=self.flag_precond, precond=self.precond, use_dll2=3)
-                delta_x = dc_layer.CG_iter(max_iter=10)
+                    flag_precond=self.flag_precond, precond=self.precond, use_dll2=3,
+                    flag_batch_cg=self.flag_batch_cg, tol=self.cg_tol, flag_implicit=self.flag_implicit_cg,
+                    flag_static=self.flag_static_cg)
+                delta_x = dc_layer.CG_iter(max_iter=self.cg_max_iter)
+                if self.flag_batch_cg:
+                    self.cg_niters.append(dc_layer.niters)
                 if self.echo_cat:
                     delta_x = torch_channel_concate(delta_x)
                 x = x + delta_x
@@ -766,12 +807,12 @@ class Resnet_with_DC2(nn.Module):
 
         # TV ADMM
         elif self.flag_solver == 3:
-            A = Back_forward_multiEcho(csms, masks, flip, 
+            A = self.Back_forward_multiEcho(csms, masks, flip, 
                                     self.rho_penalty, self.echo_cat, scanner=self.flag_scanner)
             Xs = []
-            wk = torch.zeros(x_start.size()+(2,)).to('cuda')
-            etak = torch.zeros(x_start.size()+(2,)).to('cuda')
-            zeros_ = torch.zeros(x_start.size()+(2,)).to('cuda')
+            wk = x_start.new_zeros(x_start.size()+(2,))
+            etak = x_start.new_zeros(x_start.size()+(2,))
+            zeros_ = x_start.new_zeros(x_start.size()+(2,))
             for i in range(self.K):
                 # update auxiliary variable wk through threshold
                 ek = gradient(x) + etak/self.rho_penalty
@@ -781,8 +822,12 @@ class Resnet_with_DC2(nn.Module):
                 # update x using CG block
                 rhs = x_start + self.rho_penalty*divergence(wk) - divergence(etak)
                 dc_layer = DC_layer_multiEcho(A, rhs, echo_cat=self.echo_cat,
-                            flag_precond=self.flag_precond, precond=self.precond, use_dll2=2)
-                x = dc_layer.CG_iter(max_iter=10)
+                            flag_precond=self.flag_precond, precond=self.precond, use_dll2=2,
+                            flag_batch_cg=self.flag_batch_cg, tol=self.cg_tol, flag_implicit=self.flag_implicit_cg,
+                            flag_static=self.flag_static_cg)
+                x = dc_layer.CG_iter(max_iter=self.cg_max_iter)
+                if self.flag_batch_cg:
+                    self.cg_niters.append(dc_layer.niters)
                 if self.echo_cat:
                     x = torch_channel_concate(x)
                 Xs.append(x)
@@ -814,3 +859,43 @@ class DenseBlock(nn.Module):
         x4 = self.relu(self.conv4(torch.cat((x0, x1, x2, x3), 1)))
         x5 = self.relu(self.conv5(torch.cat((x0, x1, x2, x3, x4), 1)))
         return self.conv_final(x5)
+
+
+class Recon_inference(nn.Module):
+    '''
+        recon of the last unroll of a Resnet_with_DC2 as a single output, the module traced / compiled by compile_recon;
+        netG_dc runs in eval mode with max_iter CG iterations (flag_static_cg = 1) during the call only
+    '''
+    def __init__(self, netG_dc):
+        super(Recon_inference, self).__init__()
+        self.netG_dc = netG_dc
+
+    def forward(self, kdatas, csms, masks, flip, csm_lowres=None):
+        flag_static_cg, training = self.netG_dc.flag_static_cg, self.netG_dc.training
+        self.netG_dc.flag_static_cg = 1
+        self.netG_dc.train(False)
+        try:
+            return self.netG_dc(kdatas, csms, csm_lowres, masks, flip, test=True)[-1]
+        finally:
+            self.netG_dc.flag_static_cg = flag_static_cg
+            self.netG_dc.train(training)
+
+
+def compile_recon(netG_dc, kdatas, csms, masks, flip, csm_lowres=None, mode='trace'):
+    '''
+        inference graph of netG_dc for the shapes of the example inputs (one protocol), the DC layers
+        running max_iter CG iterations (flag_static_cg = 1) so that the graph does not depend on the data:
+            mode = 'trace': TorchScript module of torch.jit.trace (.save() / torch.jit.load)
+            mode = 'compile': torch.compile (torch >= 2.0)
+        netG_dc itself is left as it is (eager use after tracing runs the early-stopped CG)
+    '''
+    model = Recon_inference(netG_dc)
+    if mode == 'trace':
+        inputs = (kdatas, csms, masks, flip) + ((csm_lowres,) if csm_lowres is not None else ())
+        with torch.no_grad():
+            return torch.jit.trace(model, inputs, check_trace=False)
+    elif mode == 'compile':
+        if not hasattr(torch, 'compile'):
+            raise ValueError('torch.compile needs torch >= 2.0')
+        return torch.compile(model)
+    raise ValueError('Unknown mode {}'.format(mode))
@@ -44,7 +44,7 @@ class Resnet_with_DC(nn.Module):
         self.lambda_dll2 = nn.Parameter(torch.ones(1)*lambda_dll2, requires_grad=True)
 
     def forward(self, x, csms, masks):
-        device = x.get_device()
+        device = x.device
         x_start = x
         # self.lambda_dll2 = self.lambda_dll2.to(device)
         A = backward_forward_CardiacQSM(csms, masks, self.lambda_dll2)
@@ -298,7 +298,7 @@ class Resnet_with_DC2(nn.Module):
             # keep central calibration region to 1
             masks[self.nrow//2-9:self.nrow//2+9, self.ncol//2-9:self.ncol//2+9, :] = 1
             # to complex data
-            masks = torch.cat((masks, torch.zeros(masks.shape).to('cuda')),-1) # (nrow, ncol, 2)
+            masks = torch.cat((masks, torch.zeros_like(masks)),-1) # (nrow, ncol, 2)
             # add echo dimension
             masks = masks[None, ...] # (1, nrow, ncol, 2)
             masks = torch.cat(self.necho*[masks]) # (necho, nrow, ncol, 2)
@@ -313,7 +313,7 @@ class Resnet_with_DC2(nn.Module):
             # keep central calibration region to 1
             masks[:, self.nrow//2-9:self.nrow//2+9, self.ncol//2-9:self.ncol//2+9, :] = 1
             # to complex data
-            masks = torch.cat((masks, torch.zeros(masks.shape).to('cuda')),-1) # (necho, nrow, ncol, 2)
+            masks = torch.cat((masks, torch.zeros_like(masks)),-1) # (necho, nrow, ncol, 2)
             # add coil dimension
             masks = masks[None, ...] # (1, necho, nrow, ncol, 2)
             masks = torch.cat(self.ncoil*[masks]) # (ncoil, necho, nrow, ncol, 2)
@@ -347,7 +347,7 @@ class Resnet_with_DC2(nn.Module):
             if self.stochasticSampling:
                 Mask = bernoulliSample.apply(Pmask_rescaled)
             else:
-                thresh = torch.rand(Pmask_rescaled.shape).to('cuda')
+                thresh = torch.rand_like(Pmask_rescaled)
                 Mask = 1/(1+torch.exp(-12*(Pmask_rescaled-thresh)))
         else:
             if self.stochasticSampling:
@@ -357,7 +357,7 @@ class Resnet_with_DC2(nn.Module):
                 else:
                     Mask = Mask1D[..., None].repeat(1, 1, self.ncol)
             else:
-                thresh = torch.rand(Pmask_rescaled.shape).to('cuda')
+                thresh = torch.rand_like(Pmask_rescaled)
                 Mask1D = 1/(1+torch.exp(-12*(Pmask_rescaled-thresh)))
                 if self.flag_loupe == 1:
                     Mask = Mask1D[..., None].repeat(1, self.ncol)
@@ -469,9 +469,9 @@ class Resnet_with_DC2(nn.Module):
                 size_h = [n_seq*n_batch, self.nf, width, height]
                 if test:
                     with torch.no_grad():
-                        hid_init = Variable(torch.zeros(size_h)).cuda()
+                        hid_init = Variable(torch.zeros(size_h, device=x.device, dtype=x.dtype))
                 else:
-                    hid_init = Variable(torch.zeros(size_h)).cuda()
+                    hid_init = Variable(torch.zeros(size_h, device=x.device, dtype=x.dtype))
                 for j in range(self.nd-1):
                     net['t0_x%d'%j]=hid_init
                 if self.flag_dataset:
@@ -556,7 +556,7 @@ class Resnet_with_DC2(nn.Module):
                                         self.lambda_lowrank, self.echo_cat, self.necho,
                                         kdata=kdatas, csm_lowres=csm_lowres, rank=self.rank)
                 Xs = []
-                uk = torch.zeros(x_start.size()).to('cuda')
+                uk = torch.zeros_like(x_start)
                 for i in range(self.K):
                     # update auxiliary variable v
                     v_block = self.resnet_block(x+uk/self.lambda_dll2)
@@ -578,7 +578,7 @@ class Resnet_with_DC2(nn.Module):
                 if self.necho_pred > 0:
                     with torch.no_grad():
                         x_under = x.contiguous().permute(0, 2, 3, 1, 4)[..., :self.necho]
-                        x_pred = torch.zeros(1, 2, self.nrow, self.ncol, self.necho_pred).to('cuda')
+                        x_pred = x.new_zeros(1, 2, self.nrow, self.ncol, self.necho_pred)
                         [_, water] = fit_R2_LM(x_under)
                         r2s = arlo(range(self.necho), torch.sqrt(x_under[:, :, :, 0, :]**2 + x_under[:, :, :, 1, :]**2))
                         [p1, p0] = fit_complex(x_under)
@@ -599,9 +599,9 @@ class Resnet_with_DC2(nn.Module):
                 size_h = [n_seq*n_batch, self.nf, width, height]
                 if test:
                     with torch.no_grad():
-                        hid_init = Variable(torch.zeros(size_h)).cuda()
+                        hid_init = Variable(torch.zeros(size_h, device=x.device, dtype=x.dtype))
                 else:
-                    hid_init = Variable(torch.zeros(size_h)).cuda()
+                    hid_init = Variable(torch.zeros(size_h, device=x.device, dtype=x.dtype))
                 for j in range(self.nd-1):
                     net['t0_x%d'%j]=hid_init
                 if self.flag_dataset:
@@ -617,13 +617,13 @@ class Resnet_with_DC2(nn.Module):
                                         self.lambda_lowrank, self.echo_cat, self.necho,
                                         kdata=kdatas, csm_lowres=csm_lowres, rank=self.rank)
                 Xs = []
-                uk = torch.zeros(n_batch, n_ch, width, height, n_seq).to('cuda')
+                uk = x.new_zeros(n_batch, n_ch, width, height, n_seq)
                 for i in range(1, self.K+1):
                     # # predict later echos using the first several echos
                     # if self.necho_pred > 0:
                     #     with torch.no_grad():
                     #         x_under = x.contiguous().permute(0, 2, 3, 1, 4)[..., :self.necho]
-                    #         x_pred = torch.zeros(1, 2, self.nrow, self.ncol, self.necho_pred).to('cuda')
+                    #         x_pred = x.new_zeros(1, 2, self.nrow, self.ncol, self.necho_pred)
                     #         [_, water] = fit_R2_LM(x_under)
                     #         r2s = arlo(range(self.necho), torch.sqrt(x_under[:, :, :, 0, :]**2 + x_under[:, :, :, 1, :]**2)) 
                     #         [p1, p0] = fit_complex(x_under)
@@ -742,9 +742,9 @@ class Resnet_with_DC2(nn.Module):
             A = Back_forward_multiEcho(csms, masks, flip, 
                                     self.rho_penalty, self.echo_cat)
             Xs = []
-            wk = torch.zeros(x_start.size()+(2,)).to('cuda')
-            etak = torch.zeros(x_start.size()+(2,)).to('cuda')
-            zeros_ = torch.zeros(x_start.size()+(2,)).to('cuda')
+            wk = x_start.new_zeros(x_start.size()+(2,))
+            etak = x_start.new_zeros(x_start.size()+(2,))
+            zeros_ = x_start.new_zeros(x_start.size()+(2,))
             for i in range(self.K):
                 # update auxiliary variable wk through threshold
                 ek = gradient(x) + etak/self.rho_penalty
@@ -44,7 +44,7 @@ class Resnet_with_DC(nn.Module):
         self.lambda_dll2 = nn.Parameter(torch.ones(1)*lambda_dll2, requires_grad=True)
 
     def forward(self, x, csms, masks):
-        device = x.get_device()
+        device = x.device
         x_start = x
         # self.lambda_dll2 = self.lambda_dll2.to(device)
         A = backward_forward_CardiacQSM(csms, masks, self.lambda_dll2)
@@ -337,7 +337,7 @@ class Resnet_with_DC2(nn.Module):
             # keep central calibration region to 1
             masks[self.nrow//2-9:self.nrow//2+9, self.ncol//2-9:self.ncol//2+9, :] = 1
             # to complex data
-            masks = torch.cat((masks, torch.zeros(masks.shape).to('cuda')),-1) # (nrow, ncol, 2)
+            masks = torch.cat((masks, torch.zeros_like(masks)),-1) # (nrow, ncol, 2)
             # add echo dimension
             masks = masks[None, ...] # (1, nrow, ncol, 2)
             masks = torch.cat(self.necho*[masks]) # (necho, nrow, ncol, 2)
@@ -356,7 +356,7 @@ class Resnet_with_DC2(nn.Module):
                 masks[:, self.nrow//2-9:self.nrow//2+9, self.ncol//2-9:self.ncol//2+9, :-2] = 1
                 masks[:, self.nrow//2-6:self.nrow//2+6, self.ncol//2-6:self.ncol//2+6, -2:] = 1
             # to complex data
-            masks = torch.cat((masks, torch.zeros(masks.shape).to('cuda')),-1) # (necho, nrow, ncol, 2)
+            masks = torch.cat((masks, torch.zeros_like(masks)),-1) # (necho, nrow, ncol, 2)
             # add coil dimension
             masks = masks[None, ...] # (1, necho, nrow, ncol, 2)
             masks = torch.cat(self.ncoil*[masks]) # (ncoil, necho, nrow, ncol, 2)
@@ -390,7 +390,7 @@ class Resnet_with_DC2(nn.Module):
             if self.stochasticSampling:
                 Mask = bernoulliSample.apply(Pmask_rescaled)
             else:
-                thresh = torch.rand(Pmask_rescaled.shape).to('cuda')
+                thresh = torch.rand_like(Pmask_rescaled)
                 Mask = 1/(1+torch.exp(-12*(Pmask_rescaled-thresh)))
         else:
             if self.stochasticSampling:
@@ -400,7 +400,7 @@ class Resnet_with_DC2(nn.Module):
                 else:
                     Mask = Mask1D[..., None].repeat(1, 1, self.ncol)
             else:
-                thresh = torch.rand(Pmask_rescaled.shape).to('cuda')
+                thresh = torch.rand_like(Pmask_rescaled)
                 Mask1D = 1/(1+torch.exp(-12*(Pmask_rescaled-thresh)))
                 if self.flag_loupe == 1:
                     Mask = Mask1D[..., None].repeat(1, self.ncol)
@@ -506,9 +506,9 @@ class Resnet_with_DC2(nn.Module):
                 size_h = [n_seq*n_batch, self.nf, width, height]
                 if test:
                     with torch.no_grad():
-                        hid_init = Variable(torch.zeros(size_h)).cuda()
+                        hid_init = Variable(torch.zeros(size_h, device=x.device, dtype=x.dtype))
                 else:
-                    hid_init = Variable(torch.zeros(size_h)).cuda()
+                    hid_init = Variable(torch.zeros(size_h, device=x.device, dtype=x.dtype))
                 for j in range(self.nd-1):
                     net['t0_x%d'%j]=hid_init
                 if self.flag_dataset:
@@ -523,7 +523,7 @@ class Resnet_with_DC2(nn.Module):
                     # net['t%d_x0'%(i-1)] = net['t%d_x0'%(i-1)].view(n_seq, n_batch, self.nf, width, height)
                     # net['t%d_x0'%i] = self.bcrnn(x_, net['t%d_x0'%(i-1)], test)
                     if x_.requires_grad and self.flag_cp:
-                        net['t%d_x0'%i] = checkpoint(self.bcrnn, x_)
+                        net['t%d_x0'%i] = checkpoint_amp(self.bcrnn, x_)
                     else:
                         net['t%d_x0'%i] = self.bcrnn(x_, test)
                     if self.flag_att == 1:
@@ -593,7 +593,7 @@ class Resnet_with_DC2(nn.Module):
                                         self.lambda_lowrank, self.echo_cat, self.necho,
                                         kdata=kdatas, csm_lowres=csm_lowres, rank=self.rank)
                 Xs = []
-                uk = torch.zeros(x_start.size()).to('cuda')
+                uk = torch.zeros_like(x_start)
                 for i in range(self.K):
                     # update auxiliary variable v
                     v_block = self.resnet_block(x+uk/self.lambda_dll2)
@@ -619,9 +619,9 @@ class Resnet_with_DC2(nn.Module):
                 size_h = [n_seq*n_batch, self.nf, width, height]
                 if test:
                     with torch.no_grad():
-                        hid_init = Variable(torch.zeros(size_h)).cuda()
+                        hid_init = Variable(torch.zeros(size_h, device=x.device, dtype=x.dtype))
                 else:
-                    hid_init = Variable(torch.zeros(size_h)).cuda()
+                    hid_init = Variable(torch.zeros(size_h, device=x.device, dtype=x.dtype))
                 for j in range(self.nd-1):
                     net['t0_x%d'%j]=hid_init
                 if self.flag_dataset:
@@ -633,7 +633,7 @@ class Resnet_with_DC2(nn.Module):
                                         self.lambda_lowrank, self.echo_cat, self.necho,
                                         kdata=kdatas, csm_lowres=csm_lowres, rank=self.rank)
                 Xs = []
-                uk = torch.zeros(n_batch, n_ch, width, height, n_seq+2).to('cuda')
+                uk = x.new_zeros(n_batch, n_ch, width, height, n_seq+2)
                 for i in range(1, self.K+1):
                     # update auxiliary variable v
                     if self.lambda_dll2.size()[0] == 1:
@@ -647,9 +647,9 @@ class Resnet_with_DC2(nn.Module):
                     if x_.requires_grad and self.flag_cp:
                         # net['t%d_x0'%i] = checkpoint(self.bcrnn, x_[2:, ...])
                         if self.flag_t1w_only <= 0:
-                            net['t%d_x0'%i] = checkpoint(self.bcrnn, x_[:-2+self.flag_t1w_only, ...])
+                            net['t%d_x0'%i] = checkpoint_amp(self.bcrnn, x_[:-2+self.flag_t1w_only, ...])
                         else:
-                            net['t%d_x0'%i] = checkpoint(self.bcrnn, x_[:-1, ...])
+                            net['t%d_x0'%i] = checkpoint_amp(self.bcrnn, x_[:-1, ...])
                     else:
                         # net['t%d_x0'%i] = self.bcrnn(x_[2:, ...], test)
                         if self.flag_t1w_only <= 0:
@@ -677,23 +677,23 @@ class Resnet_with_DC2(nn.Module):
                                 # concatenate t1t2 features to all multi-echo recurrent features
                                 # net['t%d_x4'%i] = checkpoint(self.denoiser, net['t%d_x0'%i] + net['t%d_t1t2_0'%i])
                                 if self.flag_t1w_only <= 0:
-                                    net['t%d_x4'%i] = checkpoint(self.denoiser, net['t%d_x0'%i] + torch.sum(net['t%d_t1_0'%i], dim=0, keepdim=True) + net['t%d_t2_0'%i])
+                                    net['t%d_x4'%i] = checkpoint_amp(self.denoiser, net['t%d_x0'%i] + torch.sum(net['t%d_t1_0'%i], dim=0, keepdim=True) + net['t%d_t2_0'%i])
                                 else:
-                                    net['t%d_x4'%i] = checkpoint(self.denoiser, net['t%d_x0'%i] + net['t%d_t1_0'%i])
+                                    net['t%d_x4'%i] = checkpoint_amp(self.denoiser, net['t%d_x0'%i] + net['t%d_t1_0'%i])
                                 # concatenate 1st echo features to t1t2 features
                                 # net['t%d_t1t2_4'%i] = checkpoint(self.denoiser_t1t2, net['t%d_x0'%i][0:1, ...] + net['t%d_t1t2_0'%i])
                                 if self.flag_t1w_only <= 0:
-                                    net['t%d_t1_4'%i] = checkpoint(self.denoiser_t1, net['t%d_x0'%i][0:1, ...] + net['t%d_t1_0'%i] + net['t%d_t2_0'%i])
-                                    net['t%d_t2_4'%i] = checkpoint(self.denoiser_t2, net['t%d_x0'%i][0:1, ...] + torch.sum(net['t%d_t1_0'%i], dim=0, keepdim=True) + net['t%d_t2_0'%i])
+                                    net['t%d_t1_4'%i] = checkpoint_amp(self.denoiser_t1, net['t%d_x0'%i][0:1, ...] + net['t%d_t1_0'%i] + net['t%d_t2_0'%i])
+                                    net['t%d_t2_4'%i] = checkpoint_amp(self.denoiser_t2, net['t%d_x0'%i][0:1, ...] + torch.sum(net['t%d_t1_0'%i], dim=0, keepdim=True) + net['t%d_t2_0'%i])
                                 else:
-                                    net['t%d_t1_4'%i] = checkpoint(self.denoiser_t1t2, net['t%d_x0'%i][0:1, ...] + net['t%d_t1_0'%i])
+                                    net['t%d_t1_4'%i] = checkpoint_amp(self.denoiser_t1t2, net['t%d_x0'%i][0:1, ...] + net['t%d_t1_0'%i])
                             else:
-                                net['t%d_x4'%i] = checkpoint(self.denoiser, net['t%d_x0'%i])
+                                net['t%d_x4'%i] = checkpoint_amp(self.denoiser, net['t%d_x0'%i])
                                 if self.flag_t1w_only <= 0:
-                                    net['t%d_t1_4'%i] = checkpoint(self.denoiser_t1, net['t%d_t1_0'%i])
-                                    net['t%d_t2_4'%i] = checkpoint(self.denoiser_t2, net['t%d_t2_0'%i])
+                                    net['t%d_t1_4'%i] = checkpoint_amp(self.denoiser_t1, net['t%d_t1_0'%i])
+                                    net['t%d_t2_4'%i] = checkpoint_amp(self.denoiser_t2, net['t%d_t2_0'%i])
                                 else:
-                                    net['t%d_t1_4'%i] = checkpoint(self.denoiser_t1t2, net['t%d_t1_0'%i])
+                                    net['t%d_t1_4'%i] = checkpoint_amp(self.denoiser_t1t2, net['t%d_t1_0'%i])
                         else:
                             if self.flag_mc_fusion == 1:
                                 # net['t%d_x4'%i] = self.denoiser(net['t%d_x0'%i] + net['t%d_t1t2_0'%i])
@@ -795,9 +795,9 @@ class Resnet_with_DC2(nn.Module):
             A = Back_forward_multiEcho(csms, masks, flip, 
                                     self.rho_penalty, self.echo_cat)
             Xs = []
-            wk = torch.zeros(x_start.size()+(2,)).to('cuda')
-            etak = torch.zeros(x_start.size()+(2,)).to('cuda')
-            zeros_ = torch.zeros(x_start.size()+(2,)).to('cuda')
+            wk = x_start.new_zeros(x_start.size()+(2,))
+            etak = x_start.new_zeros(x_start.size()+(2,))
+            zeros_ = x_start.new_zeros(x_start.size()+(2,))
             for i in range(self.K):
                 # update auxiliary variable wk through threshold
                 ek = gradient(x) + etak/self.rho_penalty
@@ -8,7 +8,7 @@ import math
 class passThroughSigmoid(torch.autograd.Function):
     @staticmethod
     def forward(ctx, x):
-        device = x.get_device()
+        device = x.device
         return (1 / (1 + torch.exp(-x))).to(device)
     @staticmethod
     def backward(ctx, g):
@@ -18,7 +18,7 @@ class passThroughSigmoid(torch.autograd.Function):
 class binaryRound(torch.autograd.Function):
     @staticmethod
     def forward(ctx, x):
-        device = x.get_device()
+        device = x.device
         return x.round().to(device)
     @staticmethod
     def backward(ctx, g):
@@ -28,7 +28,7 @@ class binaryRound(torch.autograd.Function):
 class bernoulliSample(torch.autograd.Function):
     @staticmethod
     def forward(ctx, x):
-        device = x.get_device()
+        device = x.device
         samples = torch.rand(x.shape).to(device)
         return (torch.ceil(x - samples)).to(device)
     @staticmethod
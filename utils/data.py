@@ -1,5 +1,6 @@
 import os
 import time
+import collections
 import numpy as np
 import scipy.io as sio
 import random
@@ -7,6 +8,8 @@ import torch
 import datetime
 import nibabel as nib
 
+from torch.cuda.amp import autocast
+from torch.utils.checkpoint import checkpoint
 from IPython.display import display
 from PIL import Image
 
@@ -34,8 +37,15 @@ def listFilesWithSuffix(rootDir = '.', suffix = None):
     return res
 
 
-def load_nii(filename):
-    return nib.load(filename).get_data()
+def load_nii(filename, block=None, dtype=None):
+    '''
+        nifti image, block: index of a sub-block to read (e.g. np.s_[..., 0:68]) through the array proxy of
+        the image (memory-mapped when uncompressed) without loading the rest, dtype: type of the returned array
+    '''
+    data = nib.load(filename).dataobj
+    if block is not None:
+        data = data[block]
+    return np.asanyarray(data) if dtype is None else np.asarray(data, dtype=dtype)
 
 
 def save_nii(data, filename, filename_sample=''):
@@ -52,18 +62,117 @@ def load_h5(filename, varname='data'):
     return data
 
 
-def load_mat(filename, varname='data'):
+mat_files = collections.OrderedDict()  # open h5py handles of the v7.3 .mat files, keyed by (pid, file name)
+max_mat_files = 16  # number of handles kept open on top of the lazy files, the least recently used are closed first
+lazy_mat_files = set()  # files of the variables returned as Lazy_mat, each kept open by the cache
+
+
+def open_mat(filename):
+    '''
+        cached h5py handle of a v7.3 (HDF5) .mat file, None for the older formats read by scipy.io.loadmat;
+        handles are per process, the data loader workers open their own; the cache holds max_mat_files
+        handles plus one per file of the Lazy_mat variables, so that the loaders keeping them do not thrash it
+    '''
+    key = (os.getpid(), filename)
+    if key in mat_files:
+        mat_files.move_to_end(key)
+        return mat_files[key]
     try:
-        f = sio.loadmat(filename)
-        data = f[varname]
-    except:
-        print(filename)
-        data = load_h5(filename, varname=varname)
-        if data.ndim == 4:
-            data = data.transpose(3,2,1,0)
-        elif data.ndim == 3:
-            data = data.transpose(2,1,0)
-    return data
+        import h5py
+    except ImportError:
+        return None
+    f = h5py.File(filename, 'r') if h5py.is_hdf5(filename) else None
+    mat_files[key] = f
+    while len(mat_files) > max_mat_files + len(lazy_mat_files):
+        (pid, name), f_old = mat_files.popitem(last=False)
+        if f_old is not None and pid == os.getpid():
+            f_old.close()
+    return f
+
+
+class Lazy_mat():
+    '''
+        variable of a v7.3 .mat file read on indexing: a[key] only reads the indexed block from the file,
+        in the axis order of load_mat (3d and 4d variables transposed to the MATLAB order),
+        complex variables (real&imag compound) returned as complex arrays, converted to dtype if not None;
+        keys of integers, slices, Ellipsis and index arrays (applied after the read), np.asarray(a) reads all
+    '''
+
+    def __init__(self, filename, varname='data', dtype=None):
+
+        self.filename = filename
+        self.varname = varname
+        dataset = open_mat(filename)[varname]
+        self.ndim = len(dataset.shape)
+        if self.ndim in [3, 4]:
+            self.axes = tuple(range(self.ndim))[::-1]  # axis of the file of each axis
+        else:
+            self.axes = tuple(range(self.ndim))
+        self.shape = tuple(dataset.shape[axis] for axis in self.axes)
+        if dtype is None:
+            if dataset.dtype.names is None:
+                dtype = dataset.dtype
+            else:
+                dtype = np.result_type(dataset.dtype['real'], np.complex64)
+        self.dtype = np.dtype(dtype)
+
+    def __len__(self):
+
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+
+        data = self[...]
+        return data if dtype is None else data.astype(dtype, copy=False)
+
+    def __getitem__(self, key):
+
+        if not isinstance(key, tuple):
+            key = (key,)
+        for i, k in enumerate(key):
+            if k is Ellipsis:
+                key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i+1:]
+                break
+        if len(key) > self.ndim:
+            raise IndexError('too many indices for a variable of {} dimensions'.format(self.ndim))
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        # integers and slices are read from the file (hyperslab), index arrays applied to the block
+        file_key = [slice(None)] * self.ndim
+        block_key, kept = [], []
+        for axis, k in enumerate(key):
+            if isinstance(k, (int, np.integer)):
+                file_key[self.axes[axis]] = int(k) % self.shape[axis]
+            elif isinstance(k, slice) and (k.step is None or k.step > 0):
+                file_key[self.axes[axis]] = k
+                block_key.append(slice(None))
+                kept.append(self.axes[axis])
+            else:
+                block_key.append(k)
+                kept.append(self.axes[axis])
+        data = open_mat(self.filename)[self.varname][tuple(file_key)]
+        data = np.transpose(data, [sorted(kept).index(axis) for axis in kept])
+        if data.dtype.names is not None:
+            data = data['real'] + 1j * data['imag']
+        return data[tuple(block_key)].astype(self.dtype, copy=False)
+
+
+def load_mat(filename, varname='data', block=None, dtype=None, lazy=0):
+    '''
+        variable of a .mat file, block: index of a sub-block to read (e.g. np.s_[..., 0:68]), only read
+        from the file for the v7.3 files, dtype: type of the returned array (converted on read),
+        lazy: flag to return the v7.3 variables as Lazy_mat read on indexing (arrays for the other formats)
+    '''
+    if open_mat(filename) is not None:
+        data = Lazy_mat(filename, varname, dtype)
+        if lazy:
+            lazy_mat_files.add(filename)
+            return data
+        return np.asarray(data) if block is None else data[block]
+    data = sio.loadmat(filename)[varname]
+    if block is not None:
+        data = data[block]
+    return data if dtype is None else data.astype(dtype, copy=False)
 
 
 def save_mat(filename, varname, data):
@@ -72,38 +181,82 @@ def save_mat(filename, varname, data):
     sio.savemat(filename, adict)
 
 
-def readcfl(name):
-    # get dims from .hdr
-    h = open(name + ".hdr", "r")
-    h.readline() # skip
-    l = h.readline()
-    h.close()
-    dims = [int(i) for i in l.split( )]
+cfl_dims = {}  # dims of the .hdr files already parsed, keyed by file name
 
-    # remove singleton dimensions from the end
-    n = np.prod(dims)
-    dims_prod = np.cumprod(dims)
-    dims = dims[:np.searchsorted(dims_prod, n)+1]
 
-    # load data and reshape into dims
-    d = open(name + ".cfl", "r")
-    a = np.fromfile(d, dtype=np.complex64, count=n)
-    d.close()
-    return a.reshape(dims, order='F') # column-major
+def read_hdr(name):
+    '''
+        dims of a cfl file from its .hdr (cached), with singleton dimensions removed from the end
+    '''
+    if name not in cfl_dims:
+        h = open(name + ".hdr", "r")
+        h.readline() # skip
+        l = h.readline()
+        h.close()
+        dims = [int(i) for i in l.split( )]
+
+        # remove singleton dimensions from the end
+        n = np.prod(dims)
+        dims_prod = np.cumprod(dims)
+        cfl_dims[name] = dims[:np.searchsorted(dims_prod, n)+1]
+    return cfl_dims[name]
+
+
+def readcfl(name, block=None):
+    '''
+        memory-mapped cfl file: a lazy (copy-on-write) view whose pages are only read when accessed,
+        block: index of a sub-block to read (e.g. np.s_[..., :necho] or np.s_[:, :, coils]),
+        returned as an in-memory array without touching the rest of the file
+    '''
+    dims = read_hdr(name)
+    a = np.memmap(name + ".cfl", dtype=np.complex64, mode='c', shape=tuple(dims), order='F') # column-major
+    if block is None:
+        return np.asarray(a)
+    return np.array(a[block])
 
 	
-def writecfl(name, array):
+def writecfl(name, array, chunk_size=2**26):
+    '''
+        write array in column-major order, streamed in chunks of about chunk_size bytes
+        along the last dimension so that no transposed copy of the whole array is made
+    '''
+    array = np.atleast_1d(array)
     h = open(name + ".hdr", "w")
     h.write('# Dimensions\n')
     for i in (array.shape):
             h.write("%d " % i)
     h.write('\n')
     h.close()
-    d = open(name + ".cfl", "w")
-    array.T.astype(np.complex64).tofile(d) # tranpose for column-major order
+    cfl_dims.pop(name, None)
+    step = max(1, chunk_size // (8 * max(1, int(np.prod(array.shape[:-1])))))
+    d = open(name + ".cfl", "wb")
+    for i in range(0, array.shape[-1], step):
+        array[..., i:i+step].T.astype(np.complex64).tofile(d) # tranpose for column-major order
     d.close()
 
 
+def coil_compress(kdata, csm, ncoil_v, csm_lowres=None):
+    """
+    SVD coil compression of one slice to ncoil_v virtual coils (no batch dim)
+    kdata: (coil, echo, row, col) complex kspace data
+    csm: (coil, echo, row, col) or (coil, 1, row, col) complex sensitivity maps
+    csm_lowres: optional low resolution sensitivity maps with the same coil dim
+    the compression matrix W (ncoil_v, coil) has orthonormal rows, so W*csm are the
+    sensitivity maps matching the compressed data W*kdata
+    """
+    ncoil = kdata.shape[0]
+    data = kdata.reshape(ncoil, -1)
+    # principal coil directions from the coil covariance, sorted by decreasing energy
+    eigvals, eigvecs = np.linalg.eigh(data @ data.conj().T)
+    W = eigvecs[:, ::-1][:, :ncoil_v].conj().T.astype(kdata.dtype)
+    kdata_cc = np.tensordot(W, kdata, axes=1)
+    csm_cc = np.tensordot(W, csm, axes=1)
+    if csm_lowres is None:
+        return kdata_cc, csm_cc
+    else:
+        return kdata_cc, csm_cc, np.tensordot(W, csm_lowres, axes=1)
+
+
 def div0(a, b):
     """handling division by zero"""
     c = np.divide(a, b, out=np.zeros_like(a), where=b!=0)
@@ -368,6 +521,18 @@ def memory_pre_alloc(gpu_id):
     x = torch.rand((2, 2)).cuda()
 
 
+def checkpoint_amp(function, *args):
+    '''
+        checkpoint of function(*args) recomputed in backward under the autocast state of the forward pass
+        (AMP training, torch.utils.checkpoint recomputes in fp32 otherwise)
+    '''
+    enabled = torch.is_autocast_enabled()
+    def run_function(*inputs):
+        with autocast(enabled=enabled):
+            return function(*inputs)
+    return checkpoint(run_function, *args)
+
+
 class Logger():
     def __init__(
         self, 
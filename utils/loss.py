@@ -27,7 +27,7 @@ class CrossEntropyMask(torch.nn.Module):
         self.necho = necho
         self.nrow = nrow
         self.ncol = ncol
-        self.non_calib = torch.tensor(self.gen_pattern(radius=radius)).to('cuda')
+        self.register_buffer('non_calib', torch.tensor(self.gen_pattern(radius=radius)))
 
 
     def gen_pattern(self, num_row=206, num_col=80, radius=30):
@@ -44,13 +44,14 @@ class CrossEntropyMask(torch.nn.Module):
 
     def forward(self, pmask):
         loss = 0
+        non_calib = self.non_calib.to(pmask.device)
         for i in range(self.necho):
             for j in range(self.necho):
                 if j == i:
                     continue
                 else:
-                    a = torch.clamp(pmask[i][self.non_calib==1], min=1e-12, max=1-1e-12)
-                    b = pmask[j][self.non_calib==1]
+                    a = torch.clamp(pmask[i][non_calib==1], min=1e-12, max=1-1e-12)
+                    b = pmask[j][non_calib==1]
                     loss -= torch.sum(b*torch.log(a+1e-9)) / b.size()[0]
         return loss
 
@@ -68,7 +69,7 @@ class FittingError(torch.nn.Module):
         x = torch_channel_deconcate(x)
         # compute parameters
         x_ = x.clone().detach().permute(0, 3, 4, 1, 2)
-        x_pred = torch.zeros((1, 2, self.necho, self.nrow, self.ncol), requires_grad=True).to('cuda')
+        x_pred = torch.zeros((1, 2, self.necho, self.nrow, self.ncol), requires_grad=True, device=x.device, dtype=x.dtype)
         with torch.no_grad():
             [_, water] = fit_R2_LM(x_)
             r2s = arlo(range(self.necho), torch.sqrt(x_[:, :, :, 0, :]**2 + x_[:, :, :, 1, :]**2))
@@ -160,7 +161,7 @@ def snr_gain(r2s, te, weighting=0):
     '''
         SNR gain from multi-echo acquisition with or without weighted combination (not helping)
     '''
-    tmp = torch.zeros(r2s.size()).to('cuda')
+    tmp = torch.zeros_like(r2s)
 
     if weighting == 0:
         N = len(te)
@@ -1,4 +1,5 @@
 from numpy.matrixlib.defmatrix import matrix
+import copy
 import torch
 import torch.nn as nn
 import numpy as np
@@ -15,6 +16,7 @@ class Back_forward():
         csm,
         mask,
         lambda_dll2,
+        precompute = 1, # flag to fold the GE flip and row shifts into the csm and mask once for all AtA calls
     ):
         self.ncoil = csm.shape[1]
         self.nrow = csm.shape[2] 
@@ -22,12 +24,23 @@ class Back_forward():
         self.csm = csm
         self.mask = mask
         self.lambda_dll2 = lambda_dll2
+        self.precompute = precompute
 
-        device = self.csm.get_device()   
+        device = self.csm.device
         self.flip = torch.ones([self.nrow, self.ncol, 1]) 
         self.flip = torch.cat((self.flip, torch.zeros(self.flip.shape)), -1).to(device)
         self.flip[::2, ...] = - self.flip[::2, ...] 
         self.flip[:, ::2, ...] = - self.flip[:, ::2, ...]
+        if self.precompute:
+            # flip is real (+1/-1), so conj(csm*flip) = conj(csm)*flip
+            self.csm_flip = cplx_mlpy(self.csm, self.flip)
+            self.csm_flip_conj = cplx_conj(self.csm_flip)
+            # the row shifts before fft and after ifft fold into one phase ramp on the mask,
+            # which is identically one for even nrow
+            if self.nrow % 2:
+                self.mask_AtA = cplx_mlpy(self.mask, row_shift_ramp(self.nrow, 2*(self.nrow//2), device))
+            else:
+                self.mask_AtA = self.mask
 
     def AtA(
         self, 
@@ -37,27 +50,40 @@ class Back_forward():
         # forward
         img_new = img.permute(0, 2, 3, 1)
         img_new = img_new[:, None, ...]  # multiply order matters (in torch implementation)
-        coilImages = cplx_mlpy(self.csm, img_new)
-        coilImages = cplx_mlpy(coilImages, self.flip) # for GE kdata
-        coilImages = fft_shift_row(coilImages, self.nrow) # for GE kdata
-        kspace = torch.fft(coilImages, 2)  
-        temp = cplx_mlpy(kspace, self.mask)
-        # inverse
-        coilImgs = torch.ifft(temp, 2)
-        coilImgs = fft_shift_row(coilImgs, self.nrow) # for GE kdata
-        coilImgs = cplx_mlpy(coilImgs, self.flip) # for GE kdata
-        coilComb = torch.sum(
-            cplx_mlpy(coilImgs, cplx_conj(self.csm)),
-            dim=1,
-            keepdim=False
-        )
+        if self.precompute:
+            coilImages = cplx_mlpy(self.csm_flip, img_new)
+            kspace = torch.fft(coilImages, 2)
+            temp = cplx_mlpy(kspace, self.mask_AtA)
+            # inverse
+            coilImgs = torch.ifft(temp, 2)
+            coilComb = torch.sum(
+                cplx_mlpy(coilImgs, self.csm_flip_conj),
+                dim=1,
+                keepdim=False
+            )
+        else:
+            coilImages = cplx_mlpy(self.csm, img_new)
+            coilImages = cplx_mlpy(coilImages, self.flip) # for GE kdata
+            coilImages = fft_shift_row(coilImages, self.nrow) # for GE kdata
+            kspace = torch.fft(coilImages, 2)  
+            temp = cplx_mlpy(kspace, self.mask)
+            # inverse
+            coilImgs = torch.ifft(temp, 2)
+            coilImgs = fft_shift_row(coilImgs, self.nrow) # for GE kdata
+            coilImgs = cplx_mlpy(coilImgs, self.flip) # for GE kdata
+            coilComb = torch.sum(
+                cplx_mlpy(coilImgs, cplx_conj(self.csm)),
+                dim=1,
+                keepdim=False
+            )
         coilComb = coilComb.permute(0, 3, 1, 2)
         if use_dll2 == 1:
             coilComb = coilComb + self.lambda_dll2*img
         elif use_dll2 == 2:
             coilComb = coilComb + self.lambda_dll2*divergence(gradient(img))
         elif use_dll2 == 3:
-            coilComb = coilComb + self.lambda_dll2*divergence(gradient(img)/torch.sqrt(gradient(img)**2+3e-5))  #1e-4 best, 5e-5 to have consistent result to ADMM
+            grad = gradient(img)
+            coilComb = coilComb + self.lambda_dll2*divergence(grad/torch.sqrt(grad**2+3e-5))  #1e-4 best, 5e-5 to have consistent result to ADMM
             # print(torch.mean(gradient(img)**2))
         return coilComb
 
@@ -78,18 +104,48 @@ def backward_operator(kspaceUnder, csm, mask, ncoil, nrow, ncol):
     return coilComb
 
 
-def gradient(x):
+def row_shift_ramp(nrows, nshift, device):
     """
-        for 4d data: (batchsize, real/imag dim, row dim, col dim)
+        k-space phase ramp (nrows, 1, 2) equivalent to circularly shifting the image rows
+        by nshift as in fft_shift_row (nshift = nrows//2): F(shift(x)) = ramp * F(x)
     """
-    dx = torch.cat((x[:, :, :, 1:], x[:, :, :, -1:]), dim=3) - x
-    dy = torch.cat((x[:, :, 1:, :], x[:, :, -1:, :]), dim=2) - x
-    return torch.cat((dx[..., None], dy[..., None]), dim=-1)
+    phase = 2 * np.pi * torch.arange(nrows, dtype=torch.float64) * nshift / nrows
+    ramp = torch.stack((torch.cos(phase), torch.sin(phase)), dim=-1)[:, None, :]
+    return ramp.float().to(device)
+
+
+def kspace_shift_row(kspace, nrows):
+    """
+        fft_shift_row (nshift = nrows//2) of the images as a modulation of their k-space (..., row, col, 2):
+        F(shift(x)) = ramp * F(x) and ifft(ramp * y) = shift(ifft(y)). The ramp is (-1)^k for even nrows,
+        applied in place on the odd rows without any copy (kspace must not be needed by autograd)
+    """
+    if nrows % 2:
+        return cplx_mlpy(kspace, row_shift_ramp(nrows, nrows//2, kspace.device))
+    kspace[..., 1::2, :, :].neg_()
+    return kspace
+
+
+def gradient(x, ndims=2):
+    """
+        forward differences (Neumann boundary) over the last ndims spatial dims of x:
+        for 4d data: (batchsize, real/imag dim, row dim, col dim), ndims = 2
+        for 5d data: (batchsize, real/imag dim, slice dim, row dim, col dim), ndims = 3
+        return (..., gradient dim) with gradient dim ordered as (col, row, slice)
+    """
+    d = torch.zeros(x.size() + (ndims,), dtype=x.dtype, device=x.device)
+    for i in range(ndims):
+        dim = x.dim() - 1 - i
+        n = x.size()[dim]
+        d[..., i].narrow(dim, 0, n-1).copy_(x.narrow(dim, 1, n-1) - x.narrow(dim, 0, n-1))
+    return d
 
 
 def divergence(d):
     """
+        negative backward differences of d (..., gradient dim) from gradient(),
         for 5d data: (batchsize, real/imag dim, row dim, col dim, gradient dim)
+        and for 6d data: (batchsize, real/imag dim, slice dim, row dim, col dim, gradient dim)
     """
     # device = d.get_device()
     # dx = d[..., 0]
@@ -99,11 +155,14 @@ def divergence(d):
     # dxx = torch.cat((dx[:, :, :, :-1], zerox), dim=3) - torch.cat((zerox, dx[:, :, :, :-1]), dim=3) 
     # dyy = torch.cat((dy[:, :, :-1, :], zeroy), dim=2) - torch.cat((zeroy, dy[:, :, :-1, :]), dim=2)
 
-    dx = d[..., 0]
-    dy = d[..., 1]
-    dxx = dx - torch.cat((dx[:, :, :, :1], dx[:, :, :, :-1]), dim=3) 
-    dyy = dy - torch.cat((dy[:, :, :1, :], dy[:, :, :-1, :]), dim=2)
-    return  - dxx - dyy
+    ndims = d.size()[-1]
+    div = torch.zeros(d.size()[:-1], dtype=d.dtype, device=d.device)
+    for i in range(ndims):
+        dim = d.dim() - 2 - i
+        n = d.size()[dim]
+        di = d[..., i]
+        div.narrow(dim, 1, n-1).sub_(di.narrow(dim, 1, n-1) - di.narrow(dim, 0, n-1))
+    return div
 
 def backward_CardiacQSM(kdata, csm, mask, flip):
     """
@@ -157,7 +216,7 @@ class backward_forward_CardiacQSM():
         self.mask = mask
         self.lambda_dll2 = lambda_dll2
 
-        device = self.csm.get_device()
+        device = self.csm.device
         self.flip = torch.ones([self.nrow, self.ncol, 1]) 
         self.flip = torch.cat((self.flip, torch.zeros(self.flip.shape)), -1).to(device)
         self.flip[::2, ...] = - self.flip[::2, ...] 
@@ -211,10 +270,12 @@ class Back_forward_multiEcho():
         U = None, 
         rank = 0,
         scanner = 0,
+        precompute = 1, # flag to precompute the sensitivity-weighted buffers shared by all AtA calls
+        projector = None, # Subspace_projector of the low rank regularization (built from U and rank if None)
     ):
         self.nrows = csm.size()[3]
         self.ncols = csm.size()[4]
-        self.nechos = csm.size()[2]
+        self.nechos = mask.size()[2]  # csm may be shared by all echos, (batch, coil, 1, row, col, 2)
         self.csm = csm
         self.mask = mask
         self.lambda_dll2 = lambda_dll2
@@ -226,8 +287,23 @@ class Back_forward_multiEcho():
         self.csm_lowres = csm_lowres
         self.rank = rank
         self.scanner = scanner
+        self.precompute = precompute
         if self.rank > 0:
-            self.Ur = U[:, :self.rank, :]  # (echo, rank, 2)
+            self.projector = projector if projector is not None else Subspace_projector(U=U, rank=self.rank)
+        if self.precompute:
+            # flip is real (+1/-1), so conj(csm*flip) = conj(csm)*flip
+            flip = self.flip
+            if self.csm.size()[2] == 1 and torch.equal(flip, flip[:, :1, ...].expand_as(flip)):
+                flip = flip[:, :1, ...]  # keep the buffers echo-shared when both csm and flip are
+            self.csm_flip = cplx_mlpy(self.csm, flip[:, None, ...])  # (batch, coil, echo or 1, row, col, 2)
+            self.csm_flip_conj = cplx_conj(self.csm_flip)
+            # the row shifts before fft and after ifft fold into one phase ramp on the mask,
+            # which is identically one for even nrows
+            if self.nrows % 2:
+                ramp = row_shift_ramp(self.nrows, 2*(self.nrows//2), csm.device)
+                self.mask_AtA = cplx_mlpy(self.mask, ramp)
+            else:
+                self.mask_AtA = self.mask[..., 0:1]  # real sampling mask
 
         # device = self.csm.get_device()   
         # self.flip = torch.ones([self.nechos, self.nrows, self.ncols, 1]) 
@@ -235,11 +311,26 @@ class Back_forward_multiEcho():
         # self.flip[:, ::2, ...] = - self.flip[:, ::2, ...] 
         # self.flip[:, :, ::2, ...] = - self.flip[:, :, ::2, ...]
 
-    def AtA(
-        self, 
-        img, 
-        use_dll2=1  # 1 for l2-x0 reg, 2 for l2-TV reg, 3 for l1-TV reg
+    def batch_select(self, idx):
+        '''
+            shallow copy of the operator restricted to the samples idx of the batch
+            (used by the batched CG to skip AtA on converged samples)
+        '''
+        A = copy.copy(self)
+        nbatch = self.csm.size()[0]
+        for key, value in vars(self).items():
+            if torch.is_tensor(value) and value.dim() >= 5 and value.size()[0] == nbatch:
+                setattr(A, key, value[idx])
+        return A
+
+    def AhA(
+        self,
+        img
     ):
+        '''
+            data consistency term A^H*A(img) without regularization,
+            returned in the same layout as img
+        '''
         # forward
         if self.echo_cat:
             image = torch_channel_deconcate(img)  # (batch, 2, echo, row, col)
@@ -250,21 +341,36 @@ class Back_forward_multiEcho():
             image = fft_shift_col(image, self.ncols, 1)  # for Siemens data
             image[:, 1, ...] = - image[:, 1, ...]  # for Siemens data
         image = image.permute(0, 2, 3, 4, 1) # (batch, echo, row, col, 2)
-        temp = cplx_mlpy(image, self.flip) # for GE kdata
-        temp = temp[:, None, ...] # multiply order matters (in torch implementation)
-        temp = cplx_mlpy(self.csm, temp) # (batch, coil, echo, row, col, 2)
-        temp = fft_shift_row(temp, self.nrows, 1) # for GE kdata
-        temp = torch.fft(temp, 2) 
-        temp = cplx_mlpy(temp, self.mask)
-        # inverse
-        coilImgs = torch.ifft(temp, 2)
-        coilImgs = fft_shift_row(coilImgs, self.nrows, 1) # for GE kdata
-        coilComb = torch.sum(
-            cplx_mlpy(coilImgs, cplx_conj(self.csm)),
-            dim=1,
-            keepdim=False
-        )
-        coilComb = cplx_mlpy(coilComb, self.flip) # for GE kdata
+        if self.precompute:
+            temp = cplx_mlpy(self.csm_flip, image[:, None, ...]) # (batch, coil, echo, row, col, 2)
+            temp = torch.fft(temp, 2)
+            if self.mask_AtA.size()[-1] == 1:
+                temp = temp * self.mask_AtA
+            else:
+                temp = cplx_mlpy(temp, self.mask_AtA)
+            # inverse
+            coilImgs = torch.ifft(temp, 2)
+            coilComb = torch.sum(
+                cplx_mlpy(coilImgs, self.csm_flip_conj),
+                dim=1,
+                keepdim=False
+            )
+        else:
+            temp = cplx_mlpy(image, self.flip) # for GE kdata
+            temp = temp[:, None, ...] # multiply order matters (in torch implementation)
+            temp = cplx_mlpy(self.csm, temp) # (batch, coil, echo, row, col, 2)
+            temp = fft_shift_row(temp, self.nrows, 1) # for GE kdata
+            temp = torch.fft(temp, 2) 
+            temp = cplx_mlpy(temp, self.mask)
+            # inverse
+            coilImgs = torch.ifft(temp, 2)
+            coilImgs = fft_shift_row(coilImgs, self.nrows, 1) # for GE kdata
+            coilComb = torch.sum(
+                cplx_mlpy(coilImgs, cplx_conj(self.csm)),
+                dim=1,
+                keepdim=False
+            )
+            coilComb = cplx_mlpy(coilComb, self.flip) # for GE kdata
         coilComb = coilComb.permute(0, 4, 1, 2, 3) # (batch, 2, echo, row, col)
         if self.scanner == 1:
             coilComb = fft_shift_col(coilComb, self.ncols, 1)  # for Siemens data
@@ -272,6 +378,14 @@ class Back_forward_multiEcho():
             coilComb[:, 1, ...] = - coilComb[:, 1, ...]  # for Siemens data
         if self.echo_cat:
             coilComb = torch_channel_concate(coilComb, self.necho) # (batch, 2*echo, row, col)
+        return coilComb
+
+    def AtA(
+        self, 
+        img, 
+        use_dll2=1  # 1 for l2-x0 reg, 2 for l2-TV reg, 3 for l1-TV reg
+    ):
+        coilComb = self.AhA(img)
         if use_dll2 == 1:
             if self.rank == 0:
                 if self.lambda_dll2.size()[0] == 1:
@@ -286,16 +400,9 @@ class Back_forward_multiEcho():
 
                 # for low rank regularization
                 if self.echo_cat:
-                    image = torch_channel_deconcate(img)  # (batch, 2, echo, row, col)
-                image = image.permute(0, 3, 4, 2, 1)  # (batch, row, col, echo, 2)
-                image = image.view(-1, self.nechos, 2).permute(1, 0, 2)  # (batch*row*col, echo, 2) => (echo, batch*row*col, 2)
-                UrHx = cplx_matmlpy(cplx_matconj(self.Ur), image)  # (rank, echo, 2) * (echo, batch*row*col, 2) => (rank, batch*row*col, 2)
-                image = cplx_matmlpy(self.Ur, UrHx)   # (echo, rank, 2) * (rank, batch*row*col, 2) => (echo, batch*row*col, 2)
-                image = image.permute(1, 0, 2)  # (echo, batch*row*col, 2) => (batch*row*col, echo, 2)
-                image = image.view(-1, self.nrows, self.ncols, self.nechos, 2)  # (batch, row, col, echo, 2)
-                low_rank_approx = image.permute(0, 4, 3, 1, 2)  # (batch, 2, echo, row, col)
-                if self.echo_cat:
-                    low_rank_approx = torch_channel_concate(low_rank_approx, self.necho) # (batch, 2*echo, row, col)
+                    low_rank_approx = self.projector(img)  # UrUr^H(img), (batch, 2*echo, row, col)
+                else:
+                    low_rank_approx = torch_channel_deconcate(self.projector(torch_channel_concate(img, self.necho)))
                 low_rank_reg = img - low_rank_approx
                 # combine together
                 coilComb += self.lambda_lowrank * low_rank_reg
@@ -303,7 +410,8 @@ class Back_forward_multiEcho():
         elif use_dll2 == 2:
             coilComb = coilComb + self.lambda_dll2 * divergence(gradient(img))
         elif use_dll2 == 3:
-            coilComb = coilComb + self.lambda_dll2 * divergence(gradient(img) / torch.sqrt(gradient(img)**2+5e-4))  #1e-4 best, 5e-5 to have consistent result to ADMM
+            grad = gradient(img)
+            coilComb = coilComb + self.lambda_dll2 * divergence(grad / torch.sqrt(grad**2+5e-4))  #1e-4 best, 5e-5 to have consistent result to ADMM
         return coilComb
 
     def low_rank_approx(self, img):
@@ -319,6 +427,36 @@ class Back_forward_multiEcho():
         img_low_rank = tmp.permute(0, 3, 1, 2)  # (batch, 2*echo, row, col)
         return img_low_rank
 
+class Subspace_projector():
+    '''
+        projector onto a low rank temporal (echo) subspace, applied over the channel dim of
+        (batch, 2*echo, row, col) images (real&imag of each echo interleaved as in torch_channel_concate)
+        as one batched matmul with a (2*echo, 2*echo) real matrix; build it once per subject (or once
+        for a fixed dictionary U) and reuse it for all slices and unrolls
+    '''
+    def __init__(
+        self,
+        U = None,  # complex temporal basis (echo, nbasis, 2), projector Ur*Ur^H with Ur = U[:, :rank]
+        rank = 0,
+        V = None  # real principal directions (2*echo, k) from compute_V, projector V*V^T
+    ):
+        if V is not None:
+            self.P = torch.matmul(V, V.permute(1, 0))
+        else:
+            Ur = U[:, :rank, :]  # (echo, rank, 2)
+            P = cplx_matmlpy(Ur, cplx_matconj(Ur))  # (echo, echo, 2)
+            nechos = P.size()[0]
+            # real representation of the complex matrix in the interleaved channel layout
+            self.P = torch.stack((torch.stack((P[..., 0], -P[..., 1]), -1),
+                                  torch.stack((P[..., 1], P[..., 0]), -1)), 1).view(2*nechos, 2*nechos)
+        self.rank = rank if V is None else V.size()[1]
+
+    def __call__(self, img):
+        s0 = img.size()
+        out = torch.matmul(self.P, img.reshape(s0[0], s0[1], -1))  # (2*echo, 2*echo) * (batch, 2*echo, row*col)
+        return out.view(s0)
+
+
 def compute_V(kdata, csm, k=10):
     '''
         Compute PCA from 25*25 central kspace "training data" and apply low rank approximation of the whole image
@@ -326,48 +464,44 @@ def compute_V(kdata, csm, k=10):
         csm: low resolution sensitivity maps (batch, coil, echo, row, col, 2)
         k: rank (number of principle directions)
     '''
+    device = kdata.device
     nrow, ncol = kdata.size()[3], kdata.size()[4]
     M = 2 * kdata.size()[2]
     kdata = kdata[:, :, :, nrow//2-13:nrow//2+12, ncol//2-13:ncol//2+12, :]  # central fully sampled kspace
     ncoil, necho, nrow, ncol = kdata.size()[1], kdata.size()[2], kdata.size()[3], kdata.size()[4]
     # flip matrix
     flip = torch.ones([necho, nrow, ncol, 1]) 
-    flip = torch.cat((flip, torch.zeros(flip.shape)), -1).to('cuda')
+    flip = torch.cat((flip, torch.zeros(flip.shape)), -1).to(device, kdata.dtype)
     flip[:, ::2, ...] = - flip[:, ::2, ...] 
     flip[:, :, ::2, ...] = - flip[:, :, ::2, ...]
     flip = flip[None, ...] # (1, necho, nrow, ncol, 2)
     # sampling mask (all ones)
-    mask = torch.ones([ncoil, necho, nrow, ncol, 2]).to('cuda')
+    mask = torch.ones([ncoil, necho, nrow, ncol, 2]).to(device, kdata.dtype)
     mask[..., 1] = 0
     mask = mask[None, ...] # (1, ncoil, necho, nrow, ncol, 2)
 
     # generate low res fully sampled image
-    low_res_img = backward_multiEcho(kdata, csm, mask, flip).permute(0, 2, 3, 1)  # (batch, row, col, 2*echo)
-    low_res_img = low_res_img.view(-1, M)  # (N * M) with N voxels (samples) and M echos (features) 
-    (_, _, V) = torch.pca_lowrank(low_res_img.cpu().detach(), q=k)  # V: (M * k) matrix
-    V = V.to('cuda')
+    low_res_img = backward_multiEcho(kdata, csm, mask, flip, necho=necho).permute(0, 2, 3, 1)  # (batch, row, col, 2*echo)
+    low_res_img = low_res_img.reshape(-1, M).detach()  # (N * M) with N voxels (samples) and M echos (features) 
+    # principal directions from the (M * M) covariance of the centered samples, on the device of kdata
+    low_res_img = low_res_img - torch.mean(low_res_img, dim=0, keepdim=True)
+    (V, _, _) = torch.svd(torch.matmul(low_res_img.permute(1, 0), low_res_img))
+    V = V[:, :k]  # V: (M * k) matrix
     return V
 
-def low_rank_approx(img, kdata, csm, k=10):
+def low_rank_approx(img, kdata, csm, k=10, projector=None):
     '''
         Compute PCA from 25*25 central kspace "training data" and apply low rank approximation of the whole image
         img: full resolution multi-echo image to do low rank approximation (batch, 2*echo, row, col)
         kdata: auto-calibrated undersampled data (batch, coil, echo, row, col, 2)
         csm: low resolution sensitivity maps (batch, coil, echo, row, col, 2)
         k: rank (number of principle directions)
+        projector: Subspace_projector of the subject built once by the caller, Subspace_projector(V=compute_V(kdata, csm, k=k)),
+                   and reused across its slices (computed here from kdata and csm if None)
     '''
-    img = img.permute(0, 2, 3, 1)  # (batch, row, col, 2*echo)
-    s0 = img.size()
-    M = s0[-1]  # M different contrast weighted images
-    img = img.view(-1, M).permute(1, 0) # (M * N) with N voxels (samples) and M echos (features) 
-
-    V = compute_V(kdata, csm, k=k)
-
-    # row rank approximation of full resolution img
-    tmp = torch.matmul(V.permute(1, 0), img)  # (k * M) * (M * N) => (k * N)
-    tmp = torch.matmul(V, tmp)  # (M * k) * (k * N) => (M * N)
-    tmp = tmp.permute(1, 0).view(s0[0], s0[1], s0[2], s0[3])  # (N * M) => (batch, row, col, 2*echo)
-    img_low_rank = tmp.permute(0, 3, 1, 2)  # (batch, 2*echo, row, col)
+    if projector is None:
+        projector = Subspace_projector(V=compute_V(kdata, csm, k=k))
+    img_low_rank = projector(img)  # (batch, 2*echo, row, col)
     return img_low_rank
 
 class Back_forward_multiEcho_compressor():
@@ -392,7 +526,7 @@ class Back_forward_multiEcho_compressor():
     ):
         self.nrows = csm.size()[3]
         self.ncols = csm.size()[4]
-        self.nechos = csm.size()[2]
+        self.nechos = mask.size()[2]  # csm may be shared by all echos, (batch, coil, 1, row, col, 2)
         self.csm = csm
         self.mask = mask
         self.lambda_dll2 = lambda_dll2
@@ -472,8 +606,8 @@ def backward_multiEcho(kdata, csm, mask, flip, echo_cat=1, necho=10, scanner=0):
     ncols = kdata.size()[4]
     nechos = kdata.size()[2]
     temp = cplx_mlpy(kdata, mask)
+    temp = kspace_shift_row(temp, nrows)  # for GE kdata, row shift of the coil images after ifft
     temp = torch.ifft(temp, 2)
-    temp = fft_shift_row(temp, nrows, 1)
     coilComb = torch.sum(
         cplx_mlpy(temp, cplx_conj(csm)),
         dim=1,
@@ -545,9 +679,9 @@ def forward_multiEcho(image, csm, mask, flip, echo_cat=1, scanner=0):
     temp = cplx_mlpy(image, flip)
     temp = temp[:, None, ...]
     temp = cplx_mlpy(csm, temp)
-    temp = fft_shift_row(temp, nrows, 1)
     temp = torch.fft(temp, 2)
-    return cplx_mlpy(temp, mask)
+    temp = cplx_mlpy(temp, mask)
+    return kspace_shift_row(temp, nrows)  # for GE kdata, row shift of the coil images before fft
 
 
 class Back_forward_MS():
@@ -570,7 +704,7 @@ class Back_forward_MS():
     ):
         self.nrows = csm.size()[3]
         self.ncols = csm.size()[4]
-        self.nechos = csm.size()[2]
+        self.nechos = mask.size()[2]  # csm may be shared by all echos, (batch, coil, 1, row, col, 2)
         self.csm = csm
         self.mask = mask
         self.lambda_dll2 = lambda_dll2
@@ -614,7 +748,8 @@ class Back_forward_MS():
         elif use_dll2 == 2:
             coilComb = coilComb + self.lambda_dll2 * divergence(gradient(img))
         elif use_dll2 == 3:
-            coilComb = coilComb + self.lambda_dll2 * divergence(gradient(img) / torch.sqrt(gradient(img)**2+5e-4))  #1e-4 best, 5e-5 to have consistent result to ADMM
+            grad = gradient(img)
+            coilComb = coilComb + self.lambda_dll2 * divergence(grad / torch.sqrt(grad**2+5e-4))  #1e-4 best, 5e-5 to have consistent result to ADMM
         return coilComb
 
     def low_rank_approx(self, img):
@@ -819,7 +954,7 @@ class OperatorsMultiEcho():
         te1=0.003224, # 0.0043 for Siemens, 0.003224 for GE
         delta_te=0.003884  # 0.0048 for Siemens, 0.003884 for GE
     ):
-        self.device = M_0.get_device()
+        self.device = M_0.device
         self.num_samples = M_0.shape[0]
         self.num_coils = 1
         self.num_echos = num_echos
@@ -920,7 +1055,7 @@ class OperatorsMultiEcho():
         img = self.forward_operator(flag=flag)
         if use_dll2 == 1:
             return self.jacobian_conj(img=img, flag=flag) + lambda_dll2 * torch.ones(
-                                 self.num_samples, 1, self.num_rows, self.num_cols).cuda()
+                                 self.num_samples, 1, self.num_rows, self.num_cols).to(self.device)
         else:
             return self.jacobian_conj(img=img, flag=flag)
 
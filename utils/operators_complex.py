@@ -0,0 +1,164 @@
+"""
+    Native complex-dtype (torch.complex64) imaging operators for multi-echo GRE data.
+    Same interface and layouts as the real-valued operators in utils/operators.py,
+    but all coil/echo products and FFTs run on complex tensors.
+"""
+import importlib
+import types
+import torch
+
+from utils.data import *
+from utils.operators import Back_forward_multiEcho, fft_shift_row, fft_shift_col
+
+
+def _load_fft_module():
+    '''
+        torch 1.7 only exposes the torch.fft module after an explicit import,
+        which then shadows the legacy torch.fft(x, 2) function used by the
+        real-valued operators, so restore it after the import
+    '''
+    legacy_fft = torch.fft
+    fft_module = importlib.import_module('torch.fft')
+    if not isinstance(legacy_fft, types.ModuleType):
+        torch.fft = legacy_fft
+    return fft_module
+
+_fft = _load_fft_module()
+
+
+def fft2(x):
+    """
+        unnormalized 2D fft over the last two (row, col) dims of a complex tensor
+    """
+    return _fft.fftn(x, dim=(-2, -1))
+
+
+def ifft2(x):
+    """
+        2D ifft over the last two (row, col) dims of a complex tensor (scaled by 1/N)
+    """
+    return _fft.ifftn(x, dim=(-2, -1))
+
+
+def real_to_complex(x):
+    """
+        (..., 2) real tensor with real&imag in the last dim to a complex tensor (...)
+    """
+    return torch.view_as_complex(x.contiguous())
+
+
+def conj(x):
+    """
+        materialized complex conjugate (also safe for view_as_real on newer torch versions)
+    """
+    return torch.complex(x.real, -x.imag)
+
+
+def image_to_complex(img, echo_cat=1):
+    """
+        echo_cat == 1: (batch, 2*echo, row, col) => (batch, echo, row, col) complex
+        echo_cat == 0: (batch, 2, echo, row, col) => (batch, echo, row, col) complex
+    """
+    if echo_cat:
+        return torch.complex(img[:, 0::2, ...], img[:, 1::2, ...])
+    else:
+        return torch.complex(img[:, 0, ...], img[:, 1, ...])
+
+
+def complex_to_image(x, echo_cat=1):
+    """
+        inverse of image_to_complex
+    """
+    if echo_cat:
+        out = torch.view_as_real(x).permute(0, 1, 4, 2, 3)  # (batch, echo, 2, row, col)
+        return out.reshape(x.size()[0], -1, x.size()[2], x.size()[3])
+    else:
+        return torch.view_as_real(x).permute(0, 4, 1, 2, 3).contiguous()
+
+
+class Back_forward_multiEcho_complex(Back_forward_multiEcho):
+    '''
+        forward and backward imaging model operator for multi echo GRE data (scanner: 0 (GE) / 1 (Siemens))
+        computed with native complex tensors, numerically equivalent to Back_forward_multiEcho
+        (echo dim as in the channel dim in CNN model)
+    '''
+    def __init__(
+        self,
+        csm,
+        mask,
+        flip,
+        lambda_dll2,
+        *args,
+        **kwargs
+    ):
+        super(Back_forward_multiEcho_complex, self).__init__(csm, mask, flip, lambda_dll2, *args, **kwargs)
+        self.csm_c = real_to_complex(csm)  # (batch, coil, echo, row, col)
+        self.mask_r = mask[..., 0]  # real sampling mask (1, coil, echo, row, col)
+        self.flip_r = flip[..., 0]  # real checkerboard (1, echo, row, col)
+        if self.precompute:
+            self.csm_flip_c = real_to_complex(self.csm_flip)
+            self.csm_flip_conj_c = conj(self.csm_flip_c)
+            if self.mask_AtA.size()[-1] == 1:
+                self.mask_AtA_c = self.mask_AtA[..., 0]
+            else:
+                self.mask_AtA_c = real_to_complex(self.mask_AtA)
+
+    def AhA(
+        self,
+        img
+    ):
+        image = image_to_complex(img, self.echo_cat)  # (batch, echo, row, col)
+        if self.scanner == 1:
+            image = torch.flip(image, dims=[3])  # for Siemens data
+            image = fft_shift_col(image, self.ncols)  # for Siemens data
+            image = conj(image)  # for Siemens data
+        if self.precompute:
+            temp = fft2(self.csm_flip_c * image[:, None, ...]) * self.mask_AtA_c  # (batch, coil, echo, row, col)
+            coilComb = torch.sum(ifft2(temp) * self.csm_flip_conj_c, dim=1)  # (batch, echo, row, col)
+        else:
+            temp = self.csm_c * (image * self.flip_r)[:, None, ...]  # (batch, coil, echo, row, col)
+            temp = fft_shift_row(temp, self.nrows, 1)  # for GE kdata
+            temp = fft2(temp) * self.mask_r
+            # inverse
+            coilImgs = fft_shift_row(ifft2(temp), self.nrows, 1)  # for GE kdata
+            coilComb = torch.sum(coilImgs * self.csm_c.conj(), dim=1) * self.flip_r  # (batch, echo, row, col)
+        if self.scanner == 1:
+            coilComb = fft_shift_col(coilComb, self.ncols)  # for Siemens data
+            coilComb = torch.flip(coilComb, dims=[3])  # for Siemens data
+            coilComb = conj(coilComb)  # for Siemens data
+        return complex_to_image(coilComb, self.echo_cat)
+
+
+def backward_multiEcho_complex(kdata, csm, mask, flip, echo_cat=1, necho=10, scanner=0):
+    """
+    complex-dtype backward operator for multi-echo GRE data, same layouts as backward_multiEcho
+    scanner: 0 (GE) / 1 (Siemens)
+    """
+    nrows = kdata.size()[3]
+    ncols = kdata.size()[4]
+    temp = ifft2(real_to_complex(kdata) * mask[..., 0])
+    temp = fft_shift_row(temp, nrows, 1)
+    coilComb = torch.sum(temp * real_to_complex(csm).conj(), dim=1) * flip[..., 0]  # (batch, echo, row, col)
+    if scanner == 1:
+        coilComb = fft_shift_col(coilComb, ncols)  # for Siemens data
+        coilComb = torch.flip(coilComb, dims=[3])  # for Siemens data
+        coilComb = conj(coilComb)  # for Siemens data
+    return complex_to_image(coilComb, echo_cat)
+
+
+def forward_multiEcho_complex(image, csm, mask, flip, echo_cat=1, scanner=0):
+    """
+        complex-dtype forward operator for multi-echo GRE data, same layouts as forward_multiEcho
+        scanner: 0 (GE) / 1 (Siemens)
+    """
+    nrows = csm.size()[3]
+    ncols = csm.size()[4]
+    image = image_to_complex(image, echo_cat)  # (batch, echo, row, col)
+    if scanner == 1:
+        image = torch.flip(image, dims=[3])  # for Siemens data
+        image = fft_shift_col(image, ncols)  # for Siemens data
+        image = conj(image)  # for Siemens data
+    temp = real_to_complex(csm) * (image * flip[..., 0])[:, None, ...]
+    temp = fft_shift_row(temp, nrows, 1)
+    temp = fft2(temp) * mask[..., 0]
+    return torch.view_as_real(temp)
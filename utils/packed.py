@@ -0,0 +1,124 @@
+"""
+    Packed slice folders: all cfl files of a slice folder (e.g. fully_slice_, sensMaps_slice_, kdata_slice_,
+    mask_slice_) in one flat binary file per folder (subject), folder.pack, with a json index folder.json.
+    The arrays of one slice are stored contiguously (column-major complex64 as in the cfl files),
+    so reading a slice is one seek and one read instead of opening 4 x 2 files.
+"""
+import os
+import json
+import numpy as np
+from utils.data import readcfl, read_hdr
+
+
+def pack_name(dataFD):
+    return dataFD.rstrip('/')
+
+
+def list_slices(dataFD):
+    '''
+        names ('kdata_slice_', ...) and slice indices of the cfl files in dataFD,
+        the indices are the ones available for all names
+    '''
+    slices = {}
+    for filename in os.listdir(dataFD):
+        if filename.endswith('.hdr') and '_slice_' in filename:
+            name, idx = filename[:-4].rsplit('_slice_', 1)
+            if idx.isdigit():
+                slices.setdefault(name + '_slice_', set()).add(int(idx))
+    names = sorted(slices)
+    idxs = sorted(set.intersection(*[slices[name] for name in names])) if names else []
+    return names, idxs
+
+
+def pack_slices(dataFD, names=None, idxs=None):
+    '''
+        convert the cfl slice folder dataFD into dataFD.pack and dataFD.json,
+        names and idxs default to all the slices found in the folder
+    '''
+    if names is None or idxs is None:
+        names_found, idxs_found = list_slices(dataFD)
+        names = names_found if names is None else names
+        idxs = idxs_found if idxs is None else idxs
+    dims = [read_hdr(dataFD + name + str(idxs[0])) for name in names]
+    packName = pack_name(dataFD)
+    d = open(packName + '.pack', 'wb')
+    for idx in idxs:
+        for name, dim in zip(names, dims):
+            a = readcfl(dataFD + name + str(idx))
+            assert list(a.shape) == dim, 'dims of {0}{1} differ from slice {2}'.format(name, idx, idxs[0])
+            a.T.astype(np.complex64).tofile(d)  # column-major order
+    d.close()
+    index = {'names': names, 'dims': dims, 'slices': idxs}
+    with open(packName + '.json', 'w') as h:
+        json.dump(index, h)
+    return index
+
+
+class Packed_slices():
+    '''
+        reader of a packed slice folder, one read of the whole slice record per slice, or of the records
+        of the nslab consecutive slices from the requested one when reading a volume slab by slab
+        (the last records are kept until a name of one of their slices is read twice, so that reading all
+        names of a slice costs at most one read and arrays modified in place are never returned again)
+    '''
+    def __init__(self, dataFD):
+        self.packName = pack_name(dataFD)
+        with open(self.packName + '.json', 'r') as h:
+            index = json.load(h)
+        self.dims = dict(zip(index['names'], index['dims']))
+        self.nbytes = {name: 8 * int(np.prod(dim)) for name, dim in self.dims.items()}
+        self.offsets = dict(zip(index['names'], np.cumsum([0] + [self.nbytes[name] for name in index['names']])))
+        self.record_bytes = sum(self.nbytes.values())
+        self.positions = {idx: i for i, idx in enumerate(index['slices'])}
+        self.file = None
+        self.pid = None  # the file is reopened in each data loader worker
+        self.slab = (0, 0, None)  # first position, number of records and buffer of the last read
+        self.names_read = {}  # names read of each slice of the last read
+
+    def read_record(self, idx, name, nslab=1):
+        position = self.positions[idx]
+        first, nrecord, buf = self.slab
+        if not first <= position < first + nrecord or name in self.names_read.get(idx, ()):
+            if self.pid != os.getpid():
+                self.file = open(self.packName + '.pack', 'rb', buffering=0)
+                self.pid = os.getpid()
+            self.slab = (0, 0, None)
+            first = position
+            nrecord = min(nslab, len(self.positions) - first)
+            # one seek and one read of the slab into a new buffer (os.preadv needs python >= 3.7), the
+            # arrays returned from the previous buffers may still be in use (e.g. by torch.from_numpy)
+            buf = np.empty(nrecord * self.record_bytes, dtype=np.uint8)
+            self.file.seek(first * self.record_bytes)
+            if self.file.readinto(buf) != buf.nbytes:
+                raise IOError('short read of records {0} to {1} of {2}.pack'.format(first, first + nrecord - 1, self.packName))
+            self.slab = (first, nrecord, buf)
+            self.names_read = {}
+        self.names_read.setdefault(idx, set()).add(name)
+        return buf[(position - first) * self.record_bytes:(position - first + 1) * self.record_bytes]
+
+    def read(self, name, idx, block=None, nslab=1):
+        '''
+            array of name for slice idx as returned by readcfl (writable, sharing the slice record)
+        '''
+        offset = self.offsets[name]
+        a = self.read_record(idx, name, nslab)[offset:offset+self.nbytes[name]].view(np.complex64)
+        a = a.reshape(self.dims[name], order='F')
+        if block is None:
+            return a
+        return a[block]
+
+
+packed_folders = {}  # Packed_slices readers opened by read_slice, keyed by folder
+
+
+def read_slice(dataFD, name, idx, block=None, flag_packed=0, nslab=1, slice_name='{}'):
+    '''
+        name (e.g. 'kdata_slice_') of slice idx in folder dataFD, from the cfl files (slice numbers
+        of the file names formatted with slice_name, e.g. '{:03d}') or from the packed folder
+        (flag_packed = 1) read by slabs of nslab slices
+    '''
+    if flag_packed:
+        if dataFD not in packed_folders:
+            packed_folders[dataFD] = Packed_slices(dataFD)
+        return packed_folders[dataFD].read(name, idx, block, nslab)
+    return readcfl(dataFD + name + slice_name.format(idx), block)
@@ -1,3 +1,4 @@
+import time
 import numpy as np
 import torch
 import torch.optim as optim
@@ -218,4 +219,36 @@ def netG_dc_train_pmask(
         # lossl2_sum += lossl1(Xs[-1]*brain_masks, targets*brain_masks)
         lossl2_sum.backward()
         optimizerG_dc.step()
-        return  lossl2_sum.item(), Xs[-1]
\ No newline at end of file
+        return  lossl2_sum.item(), Xs[-1]
+
+
+def profile_checkpointing(netG_dc, step, policies, device):
+    '''
+        peak memory and time of one training step (step(), forward + backward) of netG_dc (Resnet_with_DC2)
+        under each checkpointing policy (blocks, every, unrolls), printed and returned; the policy of
+        netG_dc is restored after
+    '''
+    device = torch.device(device)
+    policy = (netG_dc.flag_cp, netG_dc.cp_blocks, netG_dc.cp_every, netG_dc.cp_unrolls)
+    netG_dc.flag_cp = 1
+    profiles = []
+    for blocks, every, unrolls in policies:
+        netG_dc.set_checkpointing(blocks, every, unrolls)
+        step()  # warm-up
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+        t0 = time.time()
+        step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+            memory = torch.cuda.max_memory_allocated(device) / 2**20
+        else:
+            memory = float('nan')
+        duration = time.time() - t0
+        profiles.append((blocks, every, unrolls, memory, duration))
+        print('checkpointing: {}, every: {}, unrolls: {} --- peak memory: {:.0f} MB, step time: {:.3f} s'.format(
+              '+'.join(blocks) if len(blocks) else 'none', every, unrolls, memory, duration))
+    netG_dc.flag_cp = policy[0]
+    netG_dc.set_checkpointing(*policy[1:])
+    return profiles